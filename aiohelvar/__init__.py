@@ -2,3 +2,7 @@
 from .router import Router
 from .parser.address import HelvarAddress, SceneAddress
 from .exceptions import *
+from .cache import TopologyCache
+from .workgroup import Workgroup
+from .cluster import HelvarCluster
+from .sharding import ShardedCluster
@@ -0,0 +1,254 @@
+from .devices import Device
+from .groups import Group
+from .parser.address import HelvarAddress, SceneAddress
+
+from collections import namedtuple
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+CACHE_FORMAT = "aiohelvar-topology"
+CACHE_FORMAT_VERSION = 1
+
+
+# A cache payload decoded and checked in full, ready to restore.
+CachedTopology = namedtuple(
+    "CachedTopology",
+    [
+        "cluster_id",
+        "router_id",
+        "workgroup_name",
+        "devices",
+        "groups",
+        "scenes",
+        "subnet_fingerprints",
+        "groups_fingerprint",
+        "names_fingerprint",
+    ],
+)
+
+
+def address_from_string(string):
+    return HelvarAddress(*[int(part) for part in string.strip("@").split(".")])
+
+
+def encode_device(device):
+    return [
+        str(device.address),
+        device.raw_type,
+        device.name,
+        device.state,
+        device.target_load_level,
+        device.last_load_level,
+        ",".join(device.levels) if device.levels else None,
+    ]
+
+
+def encode_group(group):
+    return [
+        int(group.group_id),
+        group.name,
+        [str(address) for address in group.devices],
+        str(group.last_scene_address) if group.last_scene_address else None,
+    ]
+
+
+def encode_scene(scene):
+    return [str(scene.address), scene.name]
+
+
+def decode_payload(payload: dict) -> CachedTopology:
+    """
+    Decode a whole cache payload. Raises KeyError, ValueError, TypeError or
+    AttributeError on anything malformed, so a bad cache is rejected before any
+    of it is registered.
+    """
+
+    devices = []
+    for address, raw_type, name, state, load_level, last_load_level, levels in payload[
+        "devices"
+    ]:
+        if levels is not None and not isinstance(levels, str):
+            raise TypeError(f"Scene levels of {address} aren't a string.")
+        device = Device(address_from_string(address), raw_type, name)
+        device.state = state
+        device.load_level = float(load_level)
+        device.last_load_level = float(last_load_level)
+        devices.append((device, levels))
+
+    groups = [
+        (
+            int(group_id),
+            name,
+            [address_from_string(a) for a in members],
+            SceneAddress.fromString(last_scene) if last_scene is not None else None,
+        )
+        for group_id, name, members, last_scene in payload["groups"]
+    ]
+
+    scenes = [
+        (SceneAddress.fromString(scene_address), name)
+        for scene_address, name in payload["scenes"]
+    ]
+
+    fingerprints = payload.get("fingerprints") or {}
+    return CachedTopology(
+        int(payload["cluster_id"]),
+        int(payload["router_id"]),
+        payload.get("workgroup_name"),
+        devices,
+        groups,
+        scenes,
+        {
+            int(subnet): digest
+            for subnet, digest in (fingerprints.get("subnets") or {}).items()
+        },
+        fingerprints.get("groups"),
+        fingerprints.get("scene_names"),
+    )
+
+
+class TopologyCache:
+    """
+    On-disk cache of a router's discovered topology, state and scene levels.
+
+    Stored as gzipped JSON with a format version. Entities are written as compact
+    positional lists rather than objects, and scene tables keep the router's own
+    comma separated encoding. A cache from another format version, or for another
+    router, is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def dump(self, router) -> dict:
+        """Serialise the router's current state. Must be called on the event loop."""
+
+        devices = [encode_device(device) for device in router.devices.devices.values()]
+
+        groups = [encode_group(group) for group in router.groups.groups.values()]
+
+        scenes = [
+            encode_scene(scene)
+            for scene in router.scenes.scenes.values()
+            if scene.name is not None
+        ]
+
+        return {
+            "format": CACHE_FORMAT,
+            "version": CACHE_FORMAT_VERSION,
+            "saved": time.time(),
+            "cluster_id": router.cluster_id,
+            "router_id": router.router_id,
+            "workgroup_name": router.workgroup_name,
+            "devices": devices,
+            "groups": groups,
+            "scenes": scenes,
+            "fingerprints": {
+                "subnets": {
+                    str(subnet): digest
+                    for subnet, digest in router.devices.subnet_fingerprints.items()
+                },
+                "groups": router.groups.fingerprint,
+                "scene_names": router.scenes.names_fingerprint,
+            },
+        }
+
+    def write(self, payload: dict):
+        """Write a payload atomically. Blocking; safe to run in an executor."""
+
+        tmp_path = f"{self.path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(payload, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+    def read(self):
+        """Return the cached payload, or None if there's no usable cache."""
+
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            _LOGGER.warning(f"Ignoring unreadable topology cache {self.path}: {e}")
+            return None
+
+        if (
+            not isinstance(payload, dict)
+            or payload.get("format") != CACHE_FORMAT
+            or payload.get("version") != CACHE_FORMAT_VERSION
+        ):
+            _LOGGER.info(f"Ignoring topology cache {self.path} from another format version.")
+            return None
+
+        return payload
+
+    def restore(self, router, payload: dict) -> bool:
+        """
+        Populate a router's Devices, Groups and Scenes from a payload. Nothing is
+        registered unless the whole payload decodes, see decode_payload().
+        """
+
+        try:
+            cached = decode_payload(payload)
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            _LOGGER.warning(f"Topology cache {self.path} is corrupt, ignoring it: {e!r}")
+            return False
+
+        if (cached.cluster_id, cached.router_id) != (
+            router.cluster_id,
+            router.router_id,
+        ):
+            _LOGGER.info(
+                f"Ignoring topology cache for router @{cached.cluster_id}.{cached.router_id}."
+            )
+            return False
+
+        for device, levels in cached.devices:
+            router.devices.register_device(device)
+            if levels is not None:
+                router.devices.update_device_scene_level(device.address, levels)
+
+        for group_id, name, members, last_scene in cached.groups:
+            router.groups.register_group(Group(group_id))
+            router.groups.update_group_name(group_id, name)
+            router.groups.update_group_device_members(group_id, members)
+            router.groups.groups[group_id].last_scene_address = last_scene
+            router.scenes.register_group_scenes(group_id)
+
+        for scene_address, name in cached.scenes:
+            router.scenes.update_scene_name(scene_address, name)
+
+        router.devices.subnet_fingerprints = cached.subnet_fingerprints
+        router.groups.fingerprint = cached.groups_fingerprint
+        router.scenes.names_fingerprint = cached.names_fingerprint
+
+        if router.workgroup_name is None:
+            router.workgroup_name = cached.workgroup_name
+
+        _LOGGER.info(
+            f"Restored {len(cached.devices)} devices and {len(cached.groups)} groups from {self.path}."
+        )
+        return True
+
+    async def load(self, router) -> bool:
+        """Read and parse the cache in an executor, then restore it on the loop."""
+
+        payload = await asyncio.get_running_loop().run_in_executor(None, self.read)
+        if payload is None:
+            return False
+        return self.restore(router, payload)
+
+    async def save(self, router):
+        """Snapshot the router's state on the loop, then write it out in an executor."""
+
+        payload = self.dump(router)
+        await asyncio.get_running_loop().run_in_executor(None, self.write, payload)
+        _LOGGER.debug(f"Saved topology cache to {self.path}.")
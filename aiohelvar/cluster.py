@@ -0,0 +1,250 @@
+from .control import WritePriority
+from .discovery import DEFAULT_DISCOVERY_CONCURRENCY, Discovery
+from .lib import settle
+from .parser.address import HelvarAddress, SceneAddress
+from .parser.parser import CommandParser
+from .router import KEEP_ALIVE_PERIOD, WRITE_INTERVAL, Router
+from .static import DEFAULT_FADE_TIME
+from .workgroup import (
+    WorkgroupReport,
+    WorkgroupTopology,
+    Workgroup,
+    connect_routers,
+    discover_routers,
+    merge_topology,
+    workgroup_router,
+)
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class WriteScheduler:
+    """
+    Writes queued commands for many router connections from a single task.
+
+    Each router keeps its own queue, FIFO within each WritePriority, and is
+    written to at most once every `interval` seconds, as Router's own writer does,
+    without one router's pacing holding up the others.
+    """
+
+    def __init__(self, interval=WRITE_INTERVAL):
+        self.interval = interval
+        self._queues = {}
+        self._next_write = {}
+        # (due time, sequence, router) for every router with queued writes.
+        self._due = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def enqueue(
+        self,
+        router,
+        data: bytes,
+        written: asyncio.Future = None,
+        priority=WritePriority.NORMAL,
+    ):
+        if not router.connected:
+            _LOGGER.error(f"Not writing to router {router.host}: it isn't connected.")
+            settle(written, ConnectionError("Router isn't connected."))
+            return
+
+        queue = self._queues.get(router)
+        if queue is None:
+            queue = self._queues[router] = []
+        heapq.heappush(queue, (priority, next(self._sequence), data, written))
+
+        if len(queue) == 1:
+            self._schedule(router)
+
+    def forget(self, router):
+        """Drop anything still queued for a router, e.g. once it's disconnected."""
+        for _, _, _, written in self._queues.pop(router, ()):
+            settle(written, ConnectionError("Disconnected before the command was sent."))
+        self._next_write.pop(router, None)
+
+    def _schedule(self, router):
+        due = max(time.monotonic(), self._next_write.get(router, 0))
+        heapq.heappush(self._due, (due, next(self._sequence), router))
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            if not self._due:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            due, _, router = self._due[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._due)
+            queue = self._queues.get(router)
+            if not queue:
+                continue
+
+            _, _, data, written = heapq.heappop(queue)
+            _LOGGER.info(f"Sending command '{data}' to {router.host}...")
+            try:
+                router._writer.write(data)
+                await router._writer.drain()
+            except Exception as e:
+                # One router's failure mustn't stop writes to the others.
+                _LOGGER.error(f"Couldn't write to router {router.host}: {e!r}")
+                settle(written, e)
+            else:
+                settle(written)
+
+            self._next_write[router] = time.monotonic() + self.interval
+            if queue:
+                self._schedule(router)
+
+
+class HelvarCluster:
+    """
+    Manages many Router connections on one event loop.
+
+    Routers added to the cluster share one command parser, one write scheduler and
+    one keep alive timer instead of each running their own writer and keep alive
+    tasks. Control calls are routed to the router that owns the address, and
+    topology() gives one merged view of every router's devices, groups and scenes.
+    """
+
+    def __init__(self, concurrency=DEFAULT_DISCOVERY_CONCURRENCY):
+        self.concurrency = concurrency
+        self.routers = {}
+        self.parser = CommandParser()
+        self.scheduler = WriteScheduler()
+        self.discovery = None
+        self.workgroup_name = None
+
+        self._scheduler_task = None
+        self._keep_alive_task = None
+
+    def add_router(self, router: Router) -> Router:
+        """Add a (not yet connected) router to the cluster."""
+
+        router.parser = self.parser
+        router.scheduler = self.scheduler
+        router.keep_alive = False
+        self.routers[(router.cluster_id, router.router_id)] = router
+        return router
+
+    async def add_workgroup(self, seed: Router, router_factory=None):
+        """Add the seed and every other router in its workgroup. See Workgroup."""
+
+        if (seed.cluster_id, seed.router_id) not in self.routers:
+            self.add_router(seed)
+        self._start()
+
+        for key in await Workgroup(seed).enumerate():
+            if key not in self.routers:
+                factory = router_factory or (lambda c, r: workgroup_router(seed, c, r))
+                self.add_router(factory(*key))
+
+        return list(self.routers)
+
+    def _start(self):
+        if self._scheduler_task is None:
+            self._scheduler_task = asyncio.create_task(self.scheduler.run())
+        if self._keep_alive_task is None:
+            self._keep_alive_task = asyncio.create_task(self._keep_alive())
+
+    async def _keep_alive(self):
+        while True:
+            await asyncio.sleep(KEEP_ALIVE_PERIOD)
+            for router in list(self.routers.values()):
+                if router.connected:
+                    await router.ping()
+
+    async def initialize(self, timeout=None, progress=None) -> WorkgroupReport:
+        """
+        Connect to every router and discover them all through one shared Discovery,
+        so `concurrency` bounds discovery queries across the whole cluster.
+        """
+
+        self._start()
+
+        unreachable = await connect_routers(self.routers)
+        connected = {k: r for k, r in self.routers.items() if k not in unreachable}
+
+        for router in connected.values():
+            if self.workgroup_name is None:
+                self.workgroup_name = router.workgroup_name
+
+        self.discovery = Discovery(self.concurrency, progress)
+        report = await discover_routers(connected, self.discovery, timeout)
+
+        return WorkgroupReport(list(connected), unreachable, report)
+
+    async def disconnect(self):
+        for task in (self._scheduler_task, self._keep_alive_task):
+            if task is not None:
+                task.cancel()
+        self._scheduler_task = self._keep_alive_task = None
+
+        await asyncio.gather(
+            *[router.disconnect() for router in self.routers.values() if router.connected]
+        )
+
+    def router_for(self, address: HelvarAddress) -> Router:
+        """The router that owns a device address."""
+        try:
+            return self.routers[(address.block, address.router)]
+        except KeyError:
+            raise KeyError(f"No router in the cluster for {address}.")
+
+    def routers_for_group(self, group_id: int):
+        """The routers that know about a group."""
+        return [
+            router
+            for router in self.routers.values()
+            if int(group_id) in router.groups.groups
+        ]
+
+    def topology(self) -> WorkgroupTopology:
+        return merge_topology(self.workgroup_name, self.routers)
+
+    def get_device(self, address: HelvarAddress):
+        return self.router_for(address).devices.devices.get(address)
+
+    def get_group_devices(self, group_id: int):
+        """Member devices of a group across every router."""
+        return [
+            device
+            for router in self.routers_for_group(group_id)
+            for device in router.groups.get_group_devices(group_id)
+        ]
+
+    def register_device_subscription(self, address: HelvarAddress, func):
+        return self.router_for(address).devices.register_subscription(address, func)
+
+    async def set_device_load_level(
+        self, address: HelvarAddress, load_level, fade_time=DEFAULT_FADE_TIME
+    ):
+        await self.router_for(address).devices.set_device_load_level(
+            address, load_level, fade_time
+        )
+
+    async def set_scene(self, scene_address: SceneAddress, fade_time=DEFAULT_FADE_TIME):
+        """
+        Recall a scene through one router that knows its group. Every router that
+        has members in the group updates them from the router's recall notification.
+        """
+
+        routers = self.routers_for_group(scene_address.group)
+        if not routers:
+            raise KeyError(f"No router in the cluster knows group {scene_address.group}.")
+        await routers[0].groups.set_scene(scene_address, fade_time)
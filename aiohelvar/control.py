@@ -0,0 +1,413 @@
+from .lib import settle
+from .parser.command import Command
+from .parser.command_parameter import CommandParameter, CommandParameterType
+from .parser.command_type import CommandType
+from .static import fade_seconds
+
+from collections import namedtuple
+from enum import IntEnum
+import asyncio
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class WritePriority(IntEnum):
+    """
+    Order in which queued writes go out to a router. Control commands jump ahead
+    of queries, and background polls only go out when nothing else is waiting.
+    """
+
+    CONTROL = 0
+    NORMAL = 1
+    POLL = 2
+
+
+# Seconds level writes are held for, so rapid changes to one device (e.g. from a
+# slider) are collapsed into the latest.
+DEFAULT_COALESCE_WINDOW = 0.05
+
+
+# Seconds after a fade ends before the level is read back. Verifications due within
+# this long of each other are sent as one batch.
+VERIFY_DELAY = 0.5
+
+# Outcome of a batch of writes: the keys (device or scene addresses) that were sent,
+# and {key: exception} for those that couldn't be.
+BatchReport = namedtuple("BatchReport", ["sent", "failed"])
+
+
+def write_error(future):
+    """The exception a completed write future failed with, or None if it was written."""
+    if future.cancelled():
+        return ConnectionError("The write was cancelled.")
+    return future.exception()
+
+
+async def wait_for_writes(waiters) -> BatchReport:
+    """Wait for every future in {key: future} and report which writes went out."""
+
+    if waiters:
+        await asyncio.wait(list(waiters.values()))
+
+    sent, failed = [], {}
+    for key, waiter in waiters.items():
+        error = write_error(waiter)
+        if error is None:
+            sent.append(key)
+        else:
+            failed[key] = error
+    return BatchReport(sent, failed)
+
+
+def direct_level_command(address, load_level, fade_time):
+    return Command(
+        CommandType.DIRECT_LEVEL_DEVICE,
+        [
+            CommandParameter(CommandParameterType.LEVEL, load_level),
+            CommandParameter(CommandParameterType.FADE_TIME, str(fade_time)),
+        ],
+        command_address=address,
+    )
+
+
+def proportion_command(address, proportion, fade_time, modify=False):
+    return Command(
+        CommandType.MODIFY_PROPORTION_DEVICE
+        if modify
+        else CommandType.DIRECT_PROPORTION_DEVICE,
+        [
+            CommandParameter(CommandParameterType.PROPORTION, proportion),
+            CommandParameter(CommandParameterType.FADE_TIME, fade_time),
+        ],
+        command_address=address,
+    )
+
+
+def direct_level_group_command(group_id, load_level, fade_time):
+    return Command(
+        CommandType.DIRECT_LEVEL_GROUP,
+        [
+            CommandParameter(CommandParameterType.GROUP, group_id),
+            CommandParameter(CommandParameterType.LEVEL, load_level),
+            CommandParameter(CommandParameterType.FADE_TIME, fade_time),
+        ],
+    )
+
+
+def aggregate_group_writes(groups, addresses):
+    """
+    Find groups whose members are all among `addresses`, so one group command can
+    replace their per-device writes. Returns ([(group_id, addresses)], remaining).
+
+    Larger groups are tried first and each address is covered at most once. A group
+    only qualifies if every member is known: an unresolved member may be a load on
+    another router that the group command would change too.
+    """
+
+    remaining = dict.fromkeys(addresses)
+    membership = groups.membership
+
+    candidates = {
+        group_id
+        for address in remaining
+        for group_id in membership.groups_for_device(address)
+    }
+    candidates = sorted(
+        candidates, key=lambda g: (-len(membership.addresses_for_group(g)), g)
+    )
+
+    aggregated = []
+    for group_id in candidates:
+        if membership.unresolved_for_group(group_id):
+            continue
+        members = [
+            device.address
+            for device in membership.devices_for_group(group_id)
+            if device.is_load
+        ]
+        if len(members) < 2 or not all(a in remaining for a in members):
+            continue
+        for address in members:
+            del remaining[address]
+        aggregated.append((group_id, members))
+
+    return aggregated, list(remaining)
+
+
+def recall_scene_command(scene_address, fade_time):
+    return Command(
+        CommandType.RECALL_SCENE,
+        [
+            CommandParameter(CommandParameterType.GROUP, scene_address.group),
+            CommandParameter(CommandParameterType.BLOCK, scene_address.block),
+            CommandParameter(CommandParameterType.SCENE, scene_address.scene),
+            CommandParameter(CommandParameterType.FADE_TIME, fade_time),
+        ],
+    )
+
+
+class LevelCoalescer:
+    """
+    Last-write-wins stage in front of the router's writer for device load levels.
+
+    A write opens a window of `window` seconds. Writes to the same address within
+    it replace the pending level and fade, and when the window closes only the
+    latest for each address is sent. A window of 0 coalesces writes made in the
+    same event loop iteration.
+
+    When the writes of a window set every load in a group to the same level and
+    fade, they're sent as one Direct Level Group command instead (see
+    aggregate_group_writes()). Partial matches are sent per device.
+
+    With `elide` set, writes that wouldn't change anything (the device is already
+    at, or fading to, that level over the same time) are dropped. This trusts the
+    known or predicted levels, so only use it once they've been discovered.
+    """
+
+    def __init__(self, devices, window=DEFAULT_COALESCE_WINDOW):
+        self.devices = devices
+        self.window = window
+        # Writes replaced by a later one before they were sent.
+        self.coalesced = 0
+        # Device writes sent as part of a group command instead.
+        self.aggregated = 0
+        self.elide = False
+        # Writes dropped because they wouldn't have changed anything.
+        self.elided = 0
+
+        self._pending = {}
+        # Futures waiting on the pending writes, by address.
+        self._waiters = {}
+        self._flush_task = None
+
+    @property
+    def pending(self):
+        return dict(self._pending)
+
+    def is_pending(self, address):
+        return address in self._pending
+
+    def submit(self, address, load_level, fade_time, written: asyncio.Future = None):
+        """
+        Queue a level write. `written`, if given, completes once the write that
+        carries it (or a later one for the same address) is on the wire.
+        """
+
+        if self.elide and self._is_noop(address, load_level, fade_time):
+            _LOGGER.debug(f"Device {address} is already at {load_level}, not writing.")
+            self.elided += 1
+            settle(written)
+            return
+
+        if address in self._pending:
+            self.coalesced += 1
+            # Re-insert, so writes go out in the order they were last made.
+            del self._pending[address]
+        self._pending[address] = (load_level, fade_time)
+        if written is not None:
+            self._waiters.setdefault(address, []).append(written)
+
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after_window())
+
+    def _is_noop(self, address, load_level, fade_time):
+        device = self.devices.devices.get(address)
+        if device is None or not device.is_load or address in self._pending:
+            return False
+        try:
+            level = float(load_level)
+        except (ValueError, TypeError):
+            return False
+        if device.target_load_level != level:
+            return False
+        return not device.is_fading or device.fade[2] == fade_seconds(fade_time)
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window)
+        self._flush_task = None
+        await self._write(*self._take())
+
+    async def flush(self):
+        """Send whatever is pending now, without waiting for the window to close."""
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write(*self._take())
+
+    async def supersede(self, command, addresses):
+        """
+        Send `command`, which sets every one of `addresses` (e.g. a group level),
+        in place of their pending writes. Those are dropped, and their waiters
+        complete once the command is on the wire.
+        """
+
+        waiters = {}
+        for address in addresses:
+            if self._pending.pop(address, None) is not None:
+                self.coalesced += 1
+            if address in self._waiters:
+                waiters[address] = self._waiters.pop(address)
+        await self._send(command, addresses, waiters)
+
+    def _take(self):
+        pending, self._pending = self._pending, {}
+        waiters, self._waiters = self._waiters, {}
+        return pending, waiters
+
+    async def _write(self, pending, waiters):
+        router = self.devices.router
+
+        batches = {}
+        for address, level_and_fade in pending.items():
+            batches.setdefault(level_and_fade, []).append(address)
+
+        for (load_level, fade_time), addresses in batches.items():
+            groups = []
+            if len(addresses) > 1:
+                groups, addresses = aggregate_group_writes(router.groups, addresses)
+
+            for group_id, members in groups:
+                await self._send(
+                    direct_level_group_command(group_id, load_level, fade_time),
+                    members,
+                    waiters,
+                )
+                _LOGGER.debug(
+                    f"Sent {len(members)} device writes as group {group_id} level {load_level}."
+                )
+                self.aggregated += len(members)
+                await self._update_levels(members, load_level, fade_time)
+
+            for address in addresses:
+                # Routers don't seem to respond to these messages.
+                await self._send(
+                    direct_level_command(address, load_level, fade_time),
+                    [address],
+                    waiters,
+                )
+                _LOGGER.debug(f"Updated device {address} load level to {load_level}.")
+                await self._update_levels([address], load_level, fade_time)
+
+    async def _send(self, command, addresses, waiters):
+        waiting = [w for address in addresses for w in waiters.get(address, ())]
+        if not waiting:
+            await self.devices.router._send_command_task(command)
+            return
+
+        written = asyncio.get_running_loop().create_future()
+
+        def done(future):
+            for waiter in waiting:
+                settle(waiter, write_error(future))
+
+        written.add_done_callback(done)
+        try:
+            await self.devices.router._send_command_task(command, written)
+        except Exception as e:
+            settle(written, e)
+
+    async def _update_levels(self, addresses, load_level, fade_time):
+        for address in addresses:
+            await self.devices.fade_device_load_level(address, load_level, fade_time)
+
+
+class FadeVerifier:
+    """
+    Reads device load levels back once the fades of our writes have ended.
+
+    Reading a level during a fade races it, so each written device gets one
+    QUERY_DEVICE_LOAD_LEVEL, `delay` seconds after its fade ends. A device has at
+    most one verification scheduled; another write replaces it. Verifications
+    falling due within `delay` of each other are sent together, and a reply only
+    notifies subscribers if it differs from the level we expected.
+    """
+
+    def __init__(self, devices, delay=VERIFY_DELAY):
+        self.devices = devices
+        self.delay = delay
+        self.enabled = True
+        # Verifications whose reply differed from the expected level.
+        self.corrected = 0
+
+        self._due = {}
+        self._task = None
+        self._wake_at = None
+
+    def schedule(self, address, fade_seconds):
+        if not self.enabled:
+            return
+
+        due = time.monotonic() + fade_seconds + self.delay
+        self._due[address] = due
+
+        if self._task is not None and self._wake_at is not None and due < self._wake_at:
+            # Due before the batch we're waiting for; start over.
+            self._task.cancel()
+            self._task = None
+        if self._task is None:
+            self._wake_at = None
+            self._task = asyncio.create_task(self._run())
+
+    def forget(self, address):
+        self._due.pop(address, None)
+
+    def is_due(self, address):
+        return address in self._due
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._task = None
+        self._due = {}
+
+    async def _run(self):
+        while self._due:
+            self._wake_at = min(self._due.values())
+            await asyncio.sleep(max(0, self._wake_at - time.monotonic()))
+
+            cutoff = time.monotonic() + self.delay
+            batch = [address for address, due in self._due.items() if due <= cutoff]
+            for address in batch:
+                del self._due[address]
+
+            await self.verify(batch)
+
+        self._task = None
+
+    async def verify(self, addresses):
+        """Query the load levels of a batch of devices and correct any that differ."""
+
+        devices = self.devices
+        responses = await asyncio.gather(
+            *[
+                devices.router._send_command_task(
+                    Command(CommandType.QUERY_DEVICE_LOAD_LEVEL, command_address=address)
+                )
+                for address in addresses
+            ],
+            return_exceptions=True,
+        )
+
+        for address, response in zip(addresses, responses):
+            if isinstance(response, Exception):
+                _LOGGER.error(f"Couldn't verify load level of {address}: {response!r}")
+                continue
+            device = devices.devices.get(address)
+            if (
+                device is None
+                or address in self._due
+                or devices.coalescer.is_pending(address)
+            ):
+                # Gone, or written to again since the query was sent.
+                continue
+            try:
+                level = float(response.result)
+            except (ValueError, TypeError):
+                _LOGGER.error(f"Invalid load level for {address}: {response.result}")
+                continue
+            if level != device.target_load_level:
+                self.corrected += 1
+                await devices.update_device_load_level(address, level)
@@ -1,6 +1,8 @@
-from aiohelvar.lib import Subscribable
+from aiohelvar.lib import Subscribable, TrafficBudget, fingerprint, intern_string
 from .static import (
     DALI_TYPES,
+    DEFAULT_FADE_TIME,
+    fade_seconds,
     DEVICE_STATE_FLAGS,
     DIGIDIM_TYPES,
     DigidimType,
@@ -10,14 +12,22 @@ from .static import (
     UNKNOWN_PROTOCOL,
     h_2_d,
 )
+from .control import (
+    BatchReport,
+    FadeVerifier,
+    LevelCoalescer,
+    proportion_command,
+    wait_for_writes,
+)
+from .discovery import DiscoveryPhase
 from .exceptions import ParserError, UnrecognizedCommand
 from .parser.address import HelvarAddress, SceneAddress
-from .parser.command_parameter import CommandParameter, CommandParameterType
 from .parser.command_type import CommandType
 from .parser.command import Command
 
 from copy import copy
 import asyncio
+import time
 
 import logging
 
@@ -28,11 +38,37 @@ def d_2_h(d):
     return [hex(d >> shift & 0xFF) for shift in [0, 8, 16, 24]]
 
 
+def proportion_level(base: float, proportion: float) -> float:
+    """
+    The load level a proportion gives a device at `base`. Proportions run from -100
+    (off) through 0 (base) to 100 (full), scaling the distance to off or full.
+    """
+
+    proportion = max(-100.0, min(100.0, float(proportion)))
+    if proportion >= 0:
+        return base + (100.0 - base) * proportion / 100.0
+    return base * (100.0 + proportion) / 100.0
+
+
 class Device(Subscribable):
     """
     Represents a Helvar device. These map to sensors, drivers, relays etc.
     """
 
+    __slots__ = (
+        "address",
+        "name",
+        "state",
+        "_load_level",
+        "fade",
+        "last_load_level",
+        "last_scene",
+        "protocol",
+        "type",
+        "raw_type",
+        "levels",
+    )
+
     def __init__(self, address: HelvarAddress, raw_type=None, name=None):
         super(Device, self).__init__()
 
@@ -40,12 +76,16 @@ class Device(Subscribable):
         self.name = name
         self.state = 0
         # Helvar stores brightness as a float between 0 and 100.
-        self.load_level: float = 0.0
+        self._load_level: float = 0.0
+        # (start level, start time, seconds) while fading to _load_level, see fade_to().
+        self.fade = None
         self.last_load_level: float = 0.0
         self.last_scene = None
         self.protocol = None
         self.type = None
-        self.levels = []
+        self.raw_type = None
+        # Scene levels are only held once QUERY_SCENE_INFO has been answered.
+        self.levels = ()
 
         if raw_type:
             self.decode_raw_type_bytecode(raw_type)
@@ -53,6 +93,46 @@ class Device(Subscribable):
     def __str__(self):
         return f"Device {self.address}: {self.name}. Protocol: {self.protocol}. Type: {self.type}. State: {self.state}. Load: {self.load_level}."
 
+    @property
+    def load_level(self) -> float:
+        """The load level, interpolated while a fade is in progress."""
+        if self.fade is None:
+            return self._load_level
+
+        start, started, duration = self.fade
+        progress = (time.monotonic() - started) / duration
+        if progress >= 1:
+            self.fade = None
+            return self._load_level
+        return start + (self._load_level - start) * progress
+
+    @load_level.setter
+    def load_level(self, level: float):
+        self._load_level = level
+        self.fade = None
+
+    @property
+    def is_fading(self) -> bool:
+        if self.fade is None:
+            return False
+        _, started, duration = self.fade
+        return time.monotonic() - started < duration
+
+    @property
+    def target_load_level(self) -> float:
+        """The level the device is at, or fading to."""
+        return self._load_level
+
+    def fade_to(self, level: float, fade_time=0):
+        """Fade linearly from the current level to `level` over fade_time centiseconds."""
+
+        start = self.load_level
+        self.load_level = level
+
+        duration = fade_seconds(fade_time)
+        if duration > 0 and start != level:
+            self.fade = (start, time.monotonic(), duration)
+
     def _get_states(self):
         states = {}
 
@@ -103,7 +183,7 @@ class Device(Subscribable):
         else:
             return True
 
-    async def _set_level(self, level: float):
+    async def _set_level(self, level: float, fade_time=0):
         if not self.is_load:
             return
 
@@ -115,7 +195,7 @@ class Device(Subscribable):
         if level == 0 and self.load_level > 0:
             self.last_load_level = float(self.load_level)
 
-        self.load_level = float(level)
+        self.fade_to(float(level), fade_time)
 
     async def set_scene_level(self, scene_address: SceneAddress):
 
@@ -149,7 +229,8 @@ class Device(Subscribable):
 
     def get_level_for_scene(self, scene_address: SceneAddress):
 
-        if self.levels is None or not self.is_load:
+        if not self.levels or not self.is_load:
+            # Scene table not known (yet).
             return None
 
         try:
@@ -170,6 +251,8 @@ class Device(Subscribable):
         if raw_type > (2**32) or raw_type < 0:
             raise TypeError
 
+        self.raw_type = raw_type
+
         bytes = [raw_type >> shift & 0xFF for shift in [0, 8, 16, 24]]
 
         try:
@@ -210,13 +293,122 @@ class Device(Subscribable):
         # TODO: Decode other device types.
 
 
+def type_key(device_type):
+    """Index key for a device type. DIGIDIM types are keyed by name, DALI types are already strings."""
+    if isinstance(device_type, DigidimType):
+        return device_type.name
+    return device_type
+
+
+class DeviceIndex:
+    """
+    Secondary indexes over registered devices.
+
+    Keeps an address set for every value of protocol, type, subnet and is_load, so
+    queries intersect precomputed sets instead of scanning every device. Sets are
+    dicts so results keep registration order.
+    """
+
+    KEYS = ("protocol", "type", "subnet", "is_load")
+
+    def __init__(self):
+        self._index = {key: {} for key in self.KEYS}
+        self._entries = {}
+
+    @staticmethod
+    def _keys_for(device):
+        return (
+            device.protocol,
+            type_key(device.type),
+            device.address.subnet,
+            device.is_load,
+        )
+
+    def add(self, device):
+        self.remove(device.address)
+
+        values = self._keys_for(device)
+        self._entries[device.address] = values
+
+        for key, value in zip(self.KEYS, values):
+            self._index[key].setdefault(value, {})[device.address] = None
+
+    def remove(self, address):
+        values = self._entries.pop(address, None)
+        if values is None:
+            return
+
+        for key, value in zip(self.KEYS, values):
+            addresses = self._index[key][value]
+            del addresses[address]
+            if not addresses:
+                del self._index[key][value]
+
+    def query(self, **criteria):
+        """
+        Return the addresses matching every given criterion, e.g.
+        query(protocol="DALI", subnet=2). No criteria returns every address.
+        """
+
+        unknown = set(criteria) - set(self.KEYS)
+        if unknown:
+            raise KeyError(f"Can't query devices by {', '.join(sorted(unknown))}.")
+
+        if "type" in criteria:
+            criteria["type"] = type_key(criteria["type"])
+
+        candidate_sets = [
+            self._index[key].get(value, {}) for key, value in criteria.items()
+        ]
+
+        if not candidate_sets:
+            return list(self._entries.keys())
+
+        candidate_sets.sort(key=len)
+        smallest, others = candidate_sets[0], candidate_sets[1:]
+
+        return [
+            address
+            for address in smallest
+            if all(address in other for other in others)
+        ]
+
+
 class Devices:
     def __init__(self, router):
         self.router = router
         self.devices = {}
+        self.index = DeviceIndex()
+        # Fingerprints of the last QUERY_DEVICE_TYPES_AND_ADDRESSES result per subnet.
+        self.subnet_fingerprints = {}
+        # In-flight QUERY_SCENE_INFO requests by address, shared by concurrent callers.
+        self._scene_level_fetches = {}
+        # (base level, proportion, predicted level) of devices with a proportion
+        # applied, see predict_proportion().
+        self._proportions = {}
+        self.coalescer = LevelCoalescer(self)
+        self.verifier = FadeVerifier(self)
 
     def register_device(self, device: Device):
         self.devices[device.address] = device
+        self.index.add(device)
+        self.router.groups.membership.resolve_device(device)
+        self.router.snapshots.mark_device(device.address)
+
+    def unregister_device(self, address):
+        device = self.devices.pop(address, None)
+        if device is None:
+            return False
+        self.index.remove(address)
+        self._proportions.pop(address, None)
+        self.verifier.forget(address)
+        self.router.groups.membership.forget_device(address)
+        self.router.snapshots.mark_device(address)
+        return True
+
+    def get_device_groups(self, address):
+        """Return the Group objects the device at this address is a member of."""
+        return self.router.groups.get_groups_for_device(address)
 
     async def update_device_state(self, address, state):
         await self._update_device_param(address, "state", state)
@@ -224,8 +416,25 @@ class Devices:
     async def update_device_load_level(self, address, load_level):
         await self._update_device_param(address, "load_level", float(load_level))
 
+    async def fade_device_load_level(self, address, load_level, fade_time, verify=True):
+        """
+        Record a level written to a device: its load level fades to `load_level`
+        over fade_time, and with verify it's read back once the fade has ended.
+        """
+
+        device = self.devices.get(address)
+        if device is None or not device.is_load:
+            return
+
+        await device._set_level(float(load_level), fade_time)
+        self.router.snapshots.mark_device(address)
+        await device.update_subscribers()
+
+        if verify:
+            self.verifier.schedule(address, fade_seconds(fade_time))
+
     async def update_device_name(self, address, name):
-        await self._update_device_param(address, "name", name)
+        await self._update_device_param(address, "name", intern_string(name))
 
     def unregister_subscription(self, device_address, func):
         device = self.devices.get(device_address)
@@ -247,13 +456,58 @@ class Devices:
         _LOGGER.debug(f"Updating {param} on device {address} to {value}")
         try:
             setattr(self.devices[address], param, value)
+            self.router.snapshots.mark_device(address)
             await self.devices[address].update_subscribers()
         except KeyError:
             _LOGGER.warn(f"Couldn't find device with address: {address}")
             raise
 
+    def predict_proportion(self, device: Device, proportion, modify=False) -> float:
+        """
+        Predict a device's load level after a Direct Proportion command, or with
+        modify a Modify Proportion command, so relative dimming needs no read back.
+
+        The router applies proportions to the level the device had before the first
+        one. That base is kept for as long as the device stays at the predicted
+        level; any other change (a scene, a direct level) starts afresh.
+        """
+
+        level = device.target_load_level
+        entry = self._proportions.get(device.address)
+        if entry is None or entry[2] != level:
+            entry = (level, 0.0, level)
+
+        base, current, _ = entry
+        proportion = float(proportion) + (current if modify else 0.0)
+        proportion = max(-100.0, min(100.0, proportion))
+
+        level = proportion_level(base, proportion)
+        self._proportions[device.address] = (base, proportion, level)
+        return level
+
+    def query(self, protocol=None, type=None, subnet=None, is_load=None):
+        """
+        Return devices matching every given attribute, using the secondary indexes.
+
+        e.g. all DALI LED modules on subnet 2:
+            devices.query(protocol="DALI", type="LED modules", subnet=2)
+        """
+
+        criteria = {
+            key: value
+            for key, value in (
+                ("protocol", protocol),
+                ("type", type),
+                ("subnet", subnet),
+                ("is_load", is_load),
+            )
+            if value is not None
+        }
+
+        return [self.devices[address] for address in self.index.query(**criteria)]
+
     def get_light_devices(self):
-        return [device for device in self.devices.values() if device.is_light is True]
+        return self.query(is_load=True)
 
     def update_device_scene_level(self, address, scene_levels):
 
@@ -261,7 +515,85 @@ class Devices:
         if len(levels) != 136:
             raise ParserError(None, f"Expecting 136 scene levels, got {len(levels)}.")
 
-        self.devices[address].set_scene_levels(levels)
+        # Scene tables are mostly the same handful of values ("0", "100", "*"), so
+        # share the strings between devices.
+        self.devices[address].set_scene_levels(
+            tuple(intern_string(level) for level in levels)
+        )
+        self.router.snapshots.mark_device(address)
+
+    async def _fetch_scene_levels(self, address):
+        try:
+            response = await self.router._send_command_task(
+                Command(CommandType.QUERY_SCENE_INFO, command_address=address)
+            )
+            if address in self.devices:
+                self.update_device_scene_level(address, response.result)
+        finally:
+            del self._scene_level_fetches[address]
+
+    async def fetch_scene_levels(self, devices):
+        """
+        Fetch the scene tables of the given devices that don't have one yet.
+
+        Scene tables (136 levels per device) aren't fetched during discovery; they're
+        fetched here when a scene recall first needs them, or by
+        prefetch_scene_levels(). Concurrent requests for the same device share one
+        query. Failures are logged, and leave the device without a table.
+        """
+
+        addresses, tasks = [], []
+        for device in devices:
+            if device.levels or not device.is_load:
+                continue
+            task = self._scene_level_fetches.get(device.address)
+            if task is None:
+                task = asyncio.create_task(self._fetch_scene_levels(device.address))
+                self._scene_level_fetches[device.address] = task
+            addresses.append(device.address)
+            tasks.append(task)
+
+        if not tasks:
+            return
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for address, result in zip(addresses, results):
+            if isinstance(result, Exception):
+                _LOGGER.error(
+                    f"Couldn't fetch scene levels for device {address}: {result!r}"
+                )
+
+    async def prefetch_scene_levels(self, budget: TrafficBudget):
+        """
+        Fetch missing scene tables in the background, no faster than the budget
+        allows. Devices in groups with named scenes are fetched first.
+        """
+
+        named_groups = {
+            scene.address.group
+            for scene in self.router.scenes.scenes.values()
+            if scene.name is not None
+        }
+
+        def in_named_group(device):
+            return bool(
+                self.router.groups.membership.groups_for_device(device.address)
+                & named_groups
+            )
+
+        devices = sorted(
+            (device for device in self.get_light_devices() if not device.levels),
+            key=lambda device: not in_named_group(device),
+        )
+        _LOGGER.info(f"Prefetching scene levels for {len(devices)} devices.")
+
+        for device in devices:
+            if device.levels or device.address not in self.devices:
+                continue
+            await budget.acquire()
+            await self.fetch_scene_levels([device])
+
+        _LOGGER.info("Finished prefetching scene levels.")
 
     async def set_device_brightness(self, address, brightness: int, fade_time=100):
 
@@ -270,38 +602,73 @@ class Devices:
         await self.set_device_load_level(address, load_level, fade_time)
 
     async def set_device_load_level(self, address, load_level: str, fade_time=100):
+        """
+        Set a device's load level. The write goes through the coalescer, so only
+        the latest of several rapid changes to one device is sent.
+        """
+
         _LOGGER.info(
-            f"Updating device {address} load level to {load_level} over {fade_time}ms..."
+            f"Updating device {address} load level to {load_level} over {fade_seconds(fade_time)}s..."
         )
 
-        async def task(devices, address, load_level):
-            # Routers don't seem to respond to these messages.
-            await devices.router._send_command_task(
-                Command(
-                    CommandType.DIRECT_LEVEL_DEVICE,
-                    [
-                        CommandParameter(CommandParameterType.LEVEL, load_level),
-                        CommandParameter(CommandParameterType.FADE_TIME, str(fade_time)),
-                    ],
-                    command_address=address,
-                )
-            )
-            _LOGGER.debug(f"Updated device {address} load level to {load_level}.")
+        # The load level fades once the write has gone out, and is read back after
+        # the fade has ended, see FadeVerifier.
+        self.coalescer.submit(address, load_level, fade_time)
+
+    async def set_device_proportion(
+        self, address, proportion, fade_time=DEFAULT_FADE_TIME, modify=False
+    ):
+        """
+        Dim a device relative to its level with one Direct Proportion Device command
+        (-100 to 100), or with modify change its proportion by that much with Modify
+        Proportion Device. The new load level is predicted locally (see
+        predict_proportion()), so no read back is needed.
+        """
+
+        # A pending level write must reach the router before the proportion.
+        if self.coalescer.is_pending(address):
+            await self.coalescer.flush()
+
+        await self.router.send_command(
+            proportion_command(address, proportion, fade_time, modify)
+        )
 
-            await devices.update_device_load_level(address, load_level)
+        device = self.devices.get(address)
+        if device is None or not device.is_load:
+            return
+
+        await self.fade_device_load_level(
+            address, self.predict_proportion(device, proportion, modify), fade_time
+        )
+
+    async def modify_device_proportion(
+        self, address, proportion, fade_time=DEFAULT_FADE_TIME
+    ):
+        """Change the proportion of a device by `proportion`, e.g. 10 to dim up."""
+        await self.set_device_proportion(address, proportion, fade_time, modify=True)
 
-            # This is causing a race condition. We should really wait for the
-            # the fade to finish.
-            # TODO: add a delay == length of transition before calling update.
-            # response = await self.router._send_command_task(
-            #     Command(CommandType.QUERY_DEVICE_LOAD_LEVEL, command_address=address)
-            # )
-            # await devices.update_device_load_level(address, response.result)
+    async def set_levels(self, levels, fade_time=DEFAULT_FADE_TIME) -> BatchReport:
+        """
+        Set the load levels of many devices as one batch, given {address: level}.
 
-        asyncio.create_task(task(self, address, load_level))
+        The writes are queued together and sent straight away (coalesced and
+        aggregated into group commands where possible, see LevelCoalescer). Returns
+        once all of them are on the wire, with a BatchReport of which addresses
+        were sent and which failed.
+        """
+
+        loop = asyncio.get_running_loop()
+        waiters = {}
+        for address, load_level in levels.items():
+            waiters[address] = loop.create_future()
+            self.coalescer.submit(address, load_level, fade_time, waiters[address])
+
+        await self.coalescer.flush()
+        return await wait_for_writes(waiters)
 
     async def update_device(self, address):
-        # Update name, state and load.
+        # Update name, state and load. Scene levels are fetched on demand, see
+        # fetch_scene_levels().
 
         device = self.devices[address]
 
@@ -313,11 +680,25 @@ class Devices:
             )
             await self.update_device_name(device.address, response.result)
 
+        self.router.discovery.spawn(
+            f"device name {address}", update_name(device), DiscoveryPhase.NAMES
+        )
+        self.refresh_device_state(address)
+
+    def refresh_device_state(self, address):
+        """
+        Re-read a device's state and, for a load, its load level, as discovery
+        steps in the CONTROL phase. A device removed meanwhile is skipped.
+        """
+
+        device = self.devices[address]
+
         async def update_state(device):
             response = await self.router._send_command_task(
                 Command(CommandType.QUERY_DEVICE_STATE, command_address=device.address)
             )
-            await self.update_device_state(device.address, response.result)
+            if self.devices.get(device.address) is device:
+                await self.update_device_state(device.address, response.result)
 
         async def update_load_level(device):
             response = await self.router._send_command_task(
@@ -325,25 +706,83 @@ class Devices:
                     CommandType.QUERY_DEVICE_LOAD_LEVEL, command_address=device.address
                 )
             )
-            await self.update_device_load_level(device.address, response.result)
+            if self.devices.get(device.address) is device:
+                await self.update_device_load_level(device.address, response.result)
 
-        async def update_scene_level(device):
-            response = await self.router._send_command_task(
-                Command(CommandType.QUERY_SCENE_INFO, command_address=device.address)
+        discovery = self.router.discovery
+        discovery.spawn(
+            f"device state {address}", update_state(device), DiscoveryPhase.CONTROL
+        )
+
+        if device.is_load:
+            discovery.spawn(
+                f"device load level {address}",
+                update_load_level(device),
+                DiscoveryPhase.CONTROL,
             )
-            self.update_device_scene_level(device.address, response.result)
 
-        asyncio.create_task(update_name(device))
-        asyncio.create_task(update_state(device))
 
-        if device.is_load:
-            asyncio.create_task(update_load_level(device))
-            asyncio.create_task(update_scene_level(device))
+def parse_device_list(result):
+    """Parse a QUERY_DEVICE_TYPES_AND_ADDRESSES result into (raw type, device id) pairs."""
+
+    entries = []
+    for device_result in result.split(","):
+        if not device_result:
+            continue
+        parts = device_result.split("@")
+        if len(parts) != 2:
+            _LOGGER.warning(f"Invalid device result format: {device_result}")
+            continue
+        entries.append(tuple(parts))
+    return entries
+
+
+def register_subnet_devices(router, subnet_address: HelvarAddress, result):
+    """
+    Reconcile the registered devices on a subnet with a QUERY_DEVICE_TYPES_AND_ADDRESSES
+    result.
+
+    New devices, and devices whose type has changed, are (re)registered. Known devices
+    are kept so their subscribers survive a refresh, and devices no longer listed are
+    unregistered. Returns (added, removed, unchanged) address lists.
+    """
+
+    added, unchanged = [], []
+    listed = set()
+
+    for device_type, device_address in parse_device_list(result):
+        address = copy(subnet_address)
+        address.device = device_address
+        listed.add(address)
+
+        existing = router.devices.devices.get(address)
+        if existing is None or str(existing.raw_type) != device_type:
+            router.devices.register_device(Device(address, device_type))
+            added.append(address)
+        else:
+            unchanged.append(address)
+
+    removed = [
+        address
+        for address in router.devices.index.query(subnet=subnet_address.subnet)
+        if address.block == subnet_address.block
+        and address.router == subnet_address.router
+        and address not in listed
+    ]
+    for address in removed:
+        router.devices.unregister_device(address)
+
+    return added, removed, unchanged
 
 
 async def receive_and_register_devices(router, command):
 
     command = await router._send_command_task(command)
+
+    router.devices.subnet_fingerprints[command.command_address.subnet] = fingerprint(
+        command.result
+    )
+
     if command.result is None:
         _LOGGER.info("No devices found.")
         return
@@ -352,25 +791,19 @@ async def receive_and_register_devices(router, command):
         _LOGGER.info(f"Not able to split, '{command.result}' does not contain @")
         return
 
-    device_results = command.result.split(",")
-    for device_result in device_results:
-        parts = device_result.split("@")
-        if len(parts) != 2:
-            _LOGGER.warning(f"Invalid device result format: {device_result}")
-            continue
-        device_type, device_address = parts
+    added, _, unchanged = register_subnet_devices(
+        router, command.command_address, command.result
+    )
 
-        address = copy(command.command_address)
-        address.device = device_address
-
-        router.devices.register_device(Device(address, device_type))
+    for address in added + unchanged:
         await router.devices.update_device(address)
 
 
 async def get_devices(router):
 
     [
-        asyncio.create_task(
+        router.discovery.spawn(
+            f"subnet devices {subnet_id}",
             receive_and_register_devices(
                 router,
                 Command(
@@ -379,7 +812,8 @@ async def get_devices(router):
                         router.cluster_id, router.router_id, subnet_id
                     ),
                 ),
-            )
+            ),
+            DiscoveryPhase.TOPOLOGY,
         )
         for subnet_id in range(1, 5)
     ]
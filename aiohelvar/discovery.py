@@ -0,0 +1,222 @@
+from collections import namedtuple
+from enum import IntEnum
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# Discovery queries allowed in flight at once. The router answers in order, so more
+# than this only lengthens its queue (and our reply timeouts).
+DEFAULT_DISCOVERY_CONCURRENCY = 16
+
+
+class DiscoveryPhase(IntEnum):
+    """
+    Discovery work in the order it's most useful. Once a phase is ready, everything
+    it (and the phases before it) provides is available.
+    """
+
+    # Group and device lists, group membership: devices and groups can be controlled.
+    TOPOLOGY = 0
+    # Load levels, device states and last scenes: current status is known.
+    CONTROL = 1
+    # Device, group and scene names.
+    NAMES = 2
+
+
+DiscoveryReport = namedtuple(
+    "DiscoveryReport",
+    ["complete", "completed", "failed", "pending", "elapsed", "phases"],
+)
+
+
+class Discovery:
+    """
+    Plans and tracks discovery work as a graph of prioritised steps.
+
+    Every discovery step is spawned through spawn() with a DiscoveryPhase, including
+    the steps that other steps start. Steps are queued as coroutines and started in
+    phase order: a step only starts once every step of an earlier phase has finished,
+    so the router answers the queries that make control and status usable first.
+    At most `concurrency` steps run as tasks at once, so a large site doesn't hold
+    thousands of idle tasks.
+
+    wait() returns once the whole graph has finished, or when a deadline passes, with
+    a report naming anything still outstanding and the time each phase became ready.
+    An optional progress callback is called as progress(done, total, name) whenever
+    a step finishes.
+    """
+
+    def __init__(self, concurrency=DEFAULT_DISCOVERY_CONCURRENCY, progress=None):
+        self.concurrency = concurrency
+        self.progress = progress
+
+        # Only failures and outstanding steps are kept by name; successes are counted.
+        self.completed = 0
+        self.failed = {}
+
+        # Seconds from the start of discovery until each phase was ready.
+        self.phase_times = {}
+
+        # A TrafficBudget each step takes a token from before it starts, see throttle().
+        self._budget = None
+
+        self._queue = []
+        self._sequence = itertools.count()
+        self._running = {}
+        self._start_scheduled = False
+        self._outstanding = {phase: 0 for phase in DiscoveryPhase}
+        self._started = time.monotonic()
+
+    @property
+    def total(self):
+        return self.completed + len(self.failed) + len(self._running) + len(self._queue)
+
+    @property
+    def pending(self):
+        return [name for name, _ in self._running.values()] + [
+            name for _, _, name, _ in sorted(self._queue)
+        ]
+
+    @property
+    def idle(self):
+        return not self._running and not self._queue
+
+    def spawn(self, name, coro, phase=DiscoveryPhase.TOPOLOGY):
+        """Queue a discovery step. It runs once its phase is up and a slot is free."""
+
+        heapq.heappush(self._queue, (phase, next(self._sequence), name, coro))
+        self._outstanding[phase] += 1
+
+        # Start on the next loop iteration, so steps spawned together are started
+        # in phase order rather than the order they were spawned in.
+        if not self._start_scheduled:
+            self._start_scheduled = True
+            asyncio.get_running_loop().call_soon(self._start_queued)
+
+    def _start_queued(self):
+        self._start_scheduled = False
+        while self._queue and len(self._running) < self.concurrency:
+            phase = self._queue[0][0]
+            if any(p < phase for _, p in self._running.values()):
+                # An earlier phase is still in flight.
+                return
+
+            phase, _, name, coro = heapq.heappop(self._queue)
+            if self._budget is not None:
+                coro = _budgeted(coro, self._budget)
+            task = asyncio.create_task(coro)
+            self._running[task] = (name, phase)
+            task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        name, phase = self._running.pop(task)
+        self._outstanding[phase] -= 1
+        self._record_ready_phases()
+        self._start_queued()
+
+        if task.cancelled():
+            self.failed[name] = asyncio.CancelledError()
+        elif task.exception() is not None:
+            _LOGGER.error(f"Discovery step {name} failed: {task.exception()!r}")
+            self.failed[name] = task.exception()
+        else:
+            self.completed += 1
+
+        if self.progress is not None:
+            try:
+                self.progress(self.completed + len(self.failed), self.total, name)
+            except Exception as e:
+                _LOGGER.error(f"Discovery progress callback raised: {e!r}")
+
+    def _record_ready_phases(self):
+        outstanding = 0
+        for phase in DiscoveryPhase:
+            outstanding += self._outstanding[phase]
+            if outstanding:
+                return
+            if phase.name not in self.phase_times:
+                self.phase_times[phase.name] = time.monotonic() - self._started
+                _LOGGER.info(
+                    f"Discovery phase {phase.name} ready after {self.phase_times[phase.name]:.2f}s."
+                )
+
+    def throttle(self, budget):
+        """
+        Have every step started from now on wait for a token from `budget` (a
+        TrafficBudget), so background rediscovery keeps to its query rate. None
+        lifts the limit.
+        """
+        self._budget = budget
+
+    def scoped(self, prefix):
+        """A view of this discovery that prefixes the names of the steps it spawns."""
+        return DiscoveryScope(self, prefix)
+
+    def report(self) -> DiscoveryReport:
+        return DiscoveryReport(
+            self.idle,
+            self.completed,
+            dict(self.failed),
+            self.pending,
+            time.monotonic() - self._started,
+            dict(self.phase_times),
+        )
+
+    async def wait(self, timeout=None) -> DiscoveryReport:
+        """
+        Wait until every step, including ones spawned while waiting, has finished.
+        With a timeout, return when it passes instead; the report's pending list
+        says what's still missing. Outstanding steps carry on running.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while not self.idle:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+            if not self._running:
+                # Queued steps start on the next loop iteration.
+                await asyncio.sleep(0)
+                continue
+            await asyncio.wait(list(self._running), timeout=remaining)
+
+        report = self.report()
+        if not report.complete:
+            _LOGGER.warning(
+                f"Discovery deadline passed with {len(report.pending)} steps outstanding."
+            )
+        return report
+
+
+async def _budgeted(coro, budget):
+    try:
+        await budget.acquire()
+    except BaseException:
+        coro.close()
+        raise
+    return await coro
+
+
+class DiscoveryScope:
+    """
+    Spawns into a shared Discovery under a name prefix, so several routers can share
+    one discovery (and its concurrency budget) without their step names colliding.
+    """
+
+    def __init__(self, discovery: Discovery, prefix):
+        self.discovery = discovery
+        self.prefix = prefix
+
+    def spawn(self, name, coro, phase=DiscoveryPhase.TOPOLOGY):
+        self.discovery.spawn(f"{self.prefix} {name}", coro, phase)
+
+    def __getattr__(self, name):
+        return getattr(self.discovery, name)
@@ -1,16 +1,29 @@
-from aiohelvar.lib import Subscribable
+from aiohelvar.lib import Subscribable, fingerprint, intern_string, settle
 from aiohelvar.static import DEFAULT_FADE_TIME
 from aiohelvar.parser.address import HelvarAddress, SceneAddress
-import asyncio
 from aiohelvar.parser.command_parameter import CommandParameter, CommandParameterType
 from .parser.command_type import CommandType, MessageType
 from .parser.command import Command
-
+from .control import (
+    BatchReport,
+    direct_level_group_command,
+    recall_scene_command,
+    wait_for_writes,
+)
+from .discovery import DiscoveryPhase
+
+from collections import namedtuple
+import asyncio
 import logging
 
 _LOGGER = logging.getLogger(__name__)
 
 
+# Groups whose levels were rebuilt, groups whose last scene couldn't be found, and
+# member loads the last scenes didn't give a level for.
+ResyncReport = namedtuple("ResyncReport", ["groups", "failed", "unknown_devices"])
+
+
 def blockscene_to_block_and_scene(block_scene: int):
     scene = block_scene % 16
     block = ((block_scene - scene) / 16) + 1
@@ -18,6 +31,9 @@ def blockscene_to_block_and_scene(block_scene: int):
 
 
 class Group(Subscribable):
+
+    __slots__ = ("group_id", "name", "devices", "last_scene_address")
+
     def __init__(self, group_id: int, name=None):
         super(Group, self).__init__()
         self.group_id: int = group_id
@@ -48,19 +64,136 @@ class Group(Subscribable):
         # return levels
 
 
+class GroupMembership:
+    """
+    Bidirectional index between groups and the devices that belong to them.
+
+    Maps group id -> {address: Device} and address -> {group ids}. Members are
+    resolved to Device objects when they are registered, so lookups don't have to
+    go back through the devices dict. Addresses whose device isn't registered yet
+    are held unresolved (None) until the device turns up.
+    """
+
+    def __init__(self):
+        self._group_members = {}
+        self._device_groups = {}
+
+    def set_members(self, group_id: int, addresses, resolve=None):
+        """
+        Replace the membership of a group. Returns an (added, removed) tuple of
+        address lists relative to the previous membership.
+        """
+
+        old_members = self._group_members.get(group_id, {})
+        new_members = {}
+
+        for address in addresses:
+            device = old_members.get(address)
+            if device is None and resolve is not None:
+                device = resolve(address)
+            new_members[address] = device
+
+        added = [a for a in new_members if a not in old_members]
+        removed = [a for a in old_members if a not in new_members]
+
+        for address in added:
+            self._device_groups.setdefault(address, set()).add(group_id)
+
+        for address in removed:
+            groups = self._device_groups.get(address)
+            if groups is not None:
+                groups.discard(group_id)
+                if not groups:
+                    del self._device_groups[address]
+
+        self._group_members[group_id] = new_members
+
+        return added, removed
+
+    def remove_group(self, group_id: int):
+        return self.set_members(group_id, [])
+
+    def resolve_device(self, device):
+        """Attach a (re)registered device to every group that lists its address."""
+        for group_id in self._device_groups.get(device.address, ()):
+            self._group_members[group_id][device.address] = device
+
+    def forget_device(self, address):
+        """Mark a device as no longer registered, keeping its group memberships."""
+        for group_id in self._device_groups.get(address, ()):
+            self._group_members[group_id][address] = None
+
+    def addresses_for_group(self, group_id: int):
+        return list(self._group_members.get(group_id, {}).keys())
+
+    def devices_for_group(self, group_id: int):
+        """Resolved member devices of a group. Unregistered members are skipped."""
+        return [
+            device
+            for device in self._group_members.get(group_id, {}).values()
+            if device is not None
+        ]
+
+    def unresolved_for_group(self, group_id: int):
+        return [
+            address
+            for address, device in self._group_members.get(group_id, {}).items()
+            if device is None
+        ]
+
+    def groups_for_device(self, address):
+        return set(self._device_groups.get(address, ()))
+
+
 class Groups:
     def __init__(self, router):
         self.router = router
         self.groups = {}
+        self.membership = GroupMembership()
+        # Fingerprint of the last QUERY_GROUPS result, see revalidation.
+        self.fingerprint = None
 
     def register_group(self, group: Group):
         self.groups[int(group.group_id)] = group
+        self.router.snapshots.mark_group(group.group_id)
+
+    def unregister_group(self, group_id: int):
+        group_id = int(group_id)
+        if self.groups.pop(group_id, None) is None:
+            return False
+        self.membership.remove_group(group_id)
+        self.router.snapshots.mark_group(group_id)
+        return True
 
     def update_group_name(self, group_id: int, name):
-        self.groups[int(group_id)].name = name
+        self.groups[int(group_id)].name = intern_string(name)
+        self.router.snapshots.mark_group(group_id)
 
     def update_group_device_members(self, group_id: int, addresses):
-        self.groups[int(group_id)].devices = addresses
+        """
+        Set the member addresses of a group and update the membership index.
+
+        Returns an (added, removed) tuple of addresses.
+        """
+        group_id = int(group_id)
+        self.groups[group_id].devices = addresses
+        self.router.snapshots.mark_group(group_id)
+
+        return self.membership.set_members(
+            group_id, addresses, self.router.devices.devices.get
+        )
+
+    def get_group_devices(self, group_id: int):
+        """Return the registered Device objects that are members of a group."""
+        return self.membership.devices_for_group(int(group_id))
+
+    def get_groups_for_device(self, address):
+        """Return the Group objects a device is a member of."""
+        return [
+            self.groups[group_id]
+            for group_id in self.membership.groups_for_device(address)
+            if group_id in self.groups
+        ]
 
     def unregister_subscription(self, group_id, func):
         group = self.groups.get(group_id)
@@ -86,7 +219,9 @@ class Groups:
         """Force subscription updates for all groups"""
         [await group.update_subscribers() for group in self.groups.values()]
 
-    async def handle_scene_callback(self, scene_address: SceneAddress, fade_time):
+    async def handle_scene_callback(
+        self, scene_address: SceneAddress, fade_time, fetch_scene_levels=True
+    ):
 
         if scene_address.group not in self.groups.keys():
             _LOGGER.info(
@@ -99,23 +234,83 @@ class Groups:
             _LOGGER.error(f"Group {scene_address.group} not found for scene {scene_address}")
             return
         group.last_scene_address = scene_address
+        self.router.snapshots.mark_group(scene_address.group)
 
         _LOGGER.info(
             f"Updating devices in group {group.name} to scene {scene_address}..."
         )
-        for device_address in self.groups[scene_address.group].devices:
-            device = self.router.devices.devices.get(device_address)
-            if device is None:
-                _LOGGER.warning(
-                    f"Can't find device {device_address} registered in group {scene_address.group}."
-                )
-                continue
+        for device_address in self.membership.unresolved_for_group(scene_address.group):
+            _LOGGER.warning(
+                f"Can't find device {device_address} registered in group {scene_address.group}."
+            )
+
+        devices = self.membership.devices_for_group(scene_address.group)
+
+        # Scene tables are fetched the first time a scene needs them.
+        missing = [device for device in devices if device.is_load and not device.levels]
+        if missing and fetch_scene_levels:
+            await self.router.devices.fetch_scene_levels(missing)
+
+        for device in devices:
             await device.set_scene_level(scene_address)
+            self.router.snapshots.mark_device(device.address)
 
         await group.update_subscribers()
 
         _LOGGER.info(f"Updated devices in scene {scene_address}.")
 
+    async def resync(self, group_ids=None, fetch_scene_levels=False) -> ResyncReport:
+        """
+        Rebuild the load levels of group members from each group's last scene, e.g.
+        after a reconnect or missed notifications. Costs one query per group (see
+        query_group_last_scene()) instead of one per device.
+
+        Levels come from the members' scene tables. Missing tables are only fetched
+        with fetch_scene_levels; otherwise those members, and members the scene
+        doesn't set, are listed as unknown. Devices in several groups end up with
+        the level of the last group resynced.
+        """
+
+        if group_ids is None:
+            group_ids = list(self.groups)
+        semaphore = asyncio.Semaphore(self.router.discovery_concurrency)
+        scenes = {}
+
+        async def query(group_id):
+            async with semaphore:
+                try:
+                    scenes[group_id] = await query_group_last_scene(self.router, group_id)
+                except Exception as e:
+                    _LOGGER.error(f"Couldn't query last scene of group {group_id}: {e!r}")
+
+        await asyncio.gather(*[query(int(group_id)) for group_id in group_ids])
+
+        resynced, failed = [], []
+        known, unknown = set(), {}
+        for group_id in [int(g) for g in group_ids]:
+            scene_address = scenes.get(group_id)
+            if scene_address is None or group_id not in self.groups:
+                failed.append(group_id)
+                continue
+
+            await self.handle_scene_callback(scene_address, 0, fetch_scene_levels)
+            resynced.append(group_id)
+
+            for device in self.membership.devices_for_group(group_id):
+                if not device.is_load:
+                    continue
+                if device.get_level_for_scene(scene_address) in (None, "*"):
+                    unknown[device.address] = None
+                else:
+                    known.add(device.address)
+
+        unknown = [address for address in unknown if address not in known]
+        _LOGGER.info(
+            f"Resynced {len(resynced)} groups, {len(failed)} failed, "
+            f"{len(unknown)} devices unknown."
+        )
+        return ResyncReport(resynced, failed, unknown)
+
     async def set_scene(self, scene_address: SceneAddress, fade_time=DEFAULT_FADE_TIME):
         """
         Set the scene with the router.
@@ -125,100 +320,282 @@ class Groups:
 
         """
 
+        await self.router.send_command(recall_scene_command(scene_address, fade_time))
+
+    async def set_scenes(self, scene_addresses, fade_time=DEFAULT_FADE_TIME) -> BatchReport:
+        """
+        Recall several scenes, typically in different groups, as one batch. Returns
+        once every recall is on the wire, with a BatchReport keyed by scene address.
+        Device levels are updated from the router's recall notifications.
+        """
+
+        loop = asyncio.get_running_loop()
+        waiters = {}
+        for scene_address in scene_addresses:
+            written = waiters[scene_address] = loop.create_future()
+            try:
+                await self.router._send_command_task(
+                    recall_scene_command(scene_address, fade_time), written
+                )
+            except Exception as e:
+                settle(written, e)
+
+        return await wait_for_writes(waiters)
+
+    async def _update_member_levels(self, group_id, level_for, fade_time=0):
+        """
+        Fade every member load to level_for(device), and verify it once the fade
+        has ended, like any other level write (see Devices.fade_device_load_level()).
+        """
+
+        devices = self.router.devices
+        for device in self.membership.devices_for_group(int(group_id)):
+            if not device.is_load:
+                continue
+            await devices.fade_device_load_level(
+                device.address, level_for(device), fade_time
+            )
+
+    async def set_group_level(self, group_id: int, load_level, fade_time=DEFAULT_FADE_TIME):
+        """
+        Set every device in a group to a load level with one Direct Level Group
+        command. It replaces any level writes still pending for the members. The
+        router doesn't reply or notify, so member levels are updated here.
+        """
+
+        _LOGGER.info(
+            f"Updating group {group_id} load level to {load_level} over {fade_time}..."
+        )
+
+        members = [
+            device.address
+            for device in self.membership.devices_for_group(int(group_id))
+        ]
+        await self.router.devices.coalescer.supersede(
+            direct_level_group_command(group_id, load_level, fade_time), members
+        )
+
+        await self._update_member_levels(
+            group_id, lambda device: float(load_level), fade_time
+        )
+
+    async def set_group_proportion(
+        self, group_id: int, proportion, fade_time=DEFAULT_FADE_TIME, modify=False
+    ):
+        """
+        Set the proportion (-100 to 100) of every device in a group with one Direct
+        Proportion Group command, or with modify change it by that much with Modify
+        Proportion Group. Member levels are predicted locally, see
+        Devices.predict_proportion().
+        """
+
+        # Pending member level writes must reach the router before the proportion.
+        coalescer = self.router.devices.coalescer
+        if any(
+            coalescer.is_pending(device.address)
+            for device in self.membership.devices_for_group(int(group_id))
+        ):
+            await coalescer.flush()
+
+        command_type = (
+            CommandType.MODIFY_PROPORTION_GROUP
+            if modify
+            else CommandType.DIRECT_PROPORTION_GROUP
+        )
+
         await self.router.send_command(
             Command(
-                CommandType.RECALL_SCENE,
+                command_type,
                 [
-                    CommandParameter(CommandParameterType.GROUP, scene_address.group),
-                    CommandParameter(CommandParameterType.BLOCK, scene_address.block),
-                    CommandParameter(CommandParameterType.SCENE, scene_address.scene),
+                    CommandParameter(CommandParameterType.GROUP, group_id),
+                    CommandParameter(CommandParameterType.PROPORTION, proportion),
                     CommandParameter(CommandParameterType.FADE_TIME, fade_time),
                 ],
             )
         )
 
+        devices = self.router.devices
+        await self._update_member_levels(
+            group_id,
+            lambda device: devices.predict_proportion(device, proportion, modify),
+            fade_time,
+        )
 
-async def get_groups(router):
+    async def modify_group_proportion(
+        self, group_id: int, proportion, fade_time=DEFAULT_FADE_TIME
+    ):
+        """Change the proportion of every device in a group by `proportion`."""
+        await self.set_group_proportion(group_id, proportion, fade_time, modify=True)
 
-    response = await router._send_command_task(Command(CommandType.QUERY_GROUPS))
 
-    # We expect a comma separated list of group ids.
-    async def update_name(router, group_id):
-        response = await router._send_command_task(
-            Command(
-                CommandType.QUERY_GROUP_DESCRIPTION,
-                [CommandParameter(CommandParameterType.GROUP, group_id)],
-            )
+# We expect a comma separated list of group ids.
+async def update_name(router, group_id):
+    response = await router._send_command_task(
+        Command(
+            CommandType.QUERY_GROUP_DESCRIPTION,
+            [CommandParameter(CommandParameterType.GROUP, group_id)],
         )
-        router.groups.update_group_name(group_id, response.result)
+    )
+    router.groups.update_group_name(group_id, response.result)
 
-    async def update_group_devices(router, group_id):
-        response = await router._send_command_task(
-            Command(
-                CommandType.QUERY_GROUP,
-                [CommandParameter(CommandParameterType.GROUP, group_id)],
-            )
-        )
 
-        if response.result is not None:
-            members = [member.strip("@") for member in response.result.split(",")]
-            _LOGGER.debug(f"members is '{members}'")
+def group_members_query(group_id):
+    return Command(
+        CommandType.QUERY_GROUP,
+        [CommandParameter(CommandParameterType.GROUP, group_id)],
+    )
 
-            addresses = [HelvarAddress(*member.split(".")) for member in members]
-            _LOGGER.debug(f"addresses is '{addresses}'")
 
-            router.groups.update_group_device_members(group_id, addresses)
+def parse_group_members(result):
+    """Parse a QUERY_GROUP result into a list of member addresses."""
 
-    async def update_group_last_scene(router, group_id):
-        response = await router._send_command_task(
-            Command(
-                CommandType.QUERY_LAST_SCENE_IN_GROUP,
-                [CommandParameter(CommandParameterType.GROUP, group_id)],
-            )
-        )
+    members = [member.strip("@") for member in result.split(",")]
+    _LOGGER.debug(f"members is '{members}'")
 
-        if response.command_message_type != MessageType.REPLY:
-            if response.command_message_type != MessageType.ERROR:
-                _LOGGER.error(f"Error reply to command: {response}")
-                return
-            _LOGGER.error(f"Unexpected reply to command: {response}")
+    addresses = [HelvarAddress(*member.split(".")) for member in members]
+    _LOGGER.debug(f"addresses is '{addresses}'")
 
-        try:
-            block_scene = int(response.result)
-        except (ValueError, TypeError):
-            _LOGGER.error(f"Invalid block_scene value: {response.result}")
-            return
-        scene_address = SceneAddress(
-            group_id, *blockscene_to_block_and_scene(block_scene)
+    return addresses
+
+
+async def update_group_devices(router, group_id):
+    response = await router._send_command_task(group_members_query(group_id))
+
+    if response.result is not None:
+        router.groups.update_group_device_members(
+            group_id, parse_group_members(response.result)
         )
-        await router.groups.handle_scene_callback(scene_address, 10)
 
-    if not response.result:
-        _LOGGER.debug(
-            "Response to QUERY_GROUPS command was empty. Assuming no groups defined."
+
+def _last_scene_result(response):
+    if response is None:
+        return None
+    if response.command_message_type == MessageType.ERROR:
+        _LOGGER.error(f"Error reply to command: {response}")
+        return None
+    if response.command_message_type != MessageType.REPLY:
+        _LOGGER.error(f"Unexpected reply to command: {response}")
+
+    try:
+        return int(response.result)
+    except (ValueError, TypeError):
+        _LOGGER.error(f"Invalid last scene value: {response.result}")
+        return None
+
+
+async def query_group_last_scene(router, group_id):
+    """
+    The address of the scene last recalled in a group, from QUERY_LAST_SCENE_IN_GROUP.
+    If that isn't answered, QUERY_LAST_SCENE_IN_BLOCK is tried for the block of the
+    last scene we know of. None if neither gives a scene.
+    """
+
+    response = await router._send_command_task(
+        Command(
+            CommandType.QUERY_LAST_SCENE_IN_GROUP,
+            [CommandParameter(CommandParameterType.GROUP, group_id)],
+        )
+    )
+    block_scene = _last_scene_result(response)
+    if block_scene is not None:
+        return SceneAddress(group_id, *blockscene_to_block_and_scene(block_scene))
+
+    group = router.groups.groups.get(int(group_id))
+    if group is None or group.last_scene_address is None:
+        return None
+
+    block = group.last_scene_address.block
+    response = await router._send_command_task(
+        Command(
+            CommandType.QUERY_LAST_SCENE_IN_BLOCK,
+            [
+                CommandParameter(CommandParameterType.GROUP, group_id),
+                CommandParameter(CommandParameterType.BLOCK, block),
+            ],
         )
+    )
+    scene = _last_scene_result(response)
+    if scene is None:
+        return None
+    return SceneAddress(group_id, block, scene)
+
+
+async def update_group_last_scene(router, group_id):
+    scene_address = await query_group_last_scene(router, group_id)
+    if scene_address is None:
         return
 
+    # Load levels are queried directly during discovery; don't pull in scene tables.
+    await router.groups.handle_scene_callback(
+        scene_address, 10, fetch_scene_levels=False
+    )
+
+
+def parse_group_ids(result):
+    """Parse a QUERY_GROUPS result into a list of group ids. None if it can't be parsed."""
+
     # TODO: Validate input - Regex for comma separated ints would do
 
     try:
-        group_ids = response.result.split(",")
-        groups = []
-        for group_id in group_ids:
+        group_ids = []
+        for group_id in result.split(","):
             group_id = group_id.strip()
             if group_id:  # Skip empty strings
                 try:
                     # Validate that group_id is numeric
                     int(group_id)
-                    groups.append(Group(group_id))
+                    group_ids.append(group_id)
                 except ValueError:
                     _LOGGER.warning(f"Invalid group ID: {group_id}")
     except AttributeError:
         _LOGGER.error("Response result is not a string - cannot parse groups")
-        return
+        return None
+
+    return group_ids
+
+
+def refresh_group(router, group_id):
+    """Register a group if it's new, and fetch its name, members and last scene."""
+
+    if int(group_id) not in router.groups.groups:
+        router.groups.register_group(Group(group_id))
+    discovery = router.discovery
+    discovery.spawn(
+        f"group name {group_id}", update_name(router, group_id), DiscoveryPhase.NAMES
+    )
+    discovery.spawn(
+        f"group members {group_id}",
+        update_group_devices(router, group_id),
+        DiscoveryPhase.TOPOLOGY,
+    )
+    discovery.spawn(
+        f"group last scene {group_id}",
+        update_group_last_scene(router, group_id),
+        DiscoveryPhase.CONTROL,
+    )
+
+
+async def get_groups(router):
+
+    response = await router._send_command_task(Command(CommandType.QUERY_GROUPS))
+
+    router.groups.fingerprint = fingerprint(response.result)
+
+    if not response.result:
+        _LOGGER.debug(
+            "Response to QUERY_GROUPS command was empty. Assuming no groups defined."
+        )
+        group_ids = []
+    else:
+        group_ids = parse_group_ids(response.result)
+        if group_ids is None:
+            return
+
+    # Groups the router no longer lists are gone, along with their scenes.
+    listed = {int(group_id) for group_id in group_ids}
+    for group_id in [g for g in router.groups.groups if g not in listed]:
+        router.groups.unregister_group(group_id)
+        router.scenes.unregister_group_scenes(group_id)
 
-    for group in groups:
-        router.groups.register_group(group)
-        asyncio.create_task(update_name(router, group.group_id))
-        asyncio.create_task(update_group_devices(router, group.group_id))
-        asyncio.create_task(update_group_last_scene(router, group.group_id))
+    for group_id in group_ids:
+        refresh_group(router, group_id)
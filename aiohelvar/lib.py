@@ -1,4 +1,69 @@
 import asyncio
+import hashlib
+import sys
+import time
+
+
+# Shared by every Subscribable that has no subscribers, so idle entities don't each
+# carry their own empty list.
+NO_SUBSCRIBERS = ()
+
+
+def intern_string(value):
+    """Intern strings that repeat across many entities (names, scene levels)."""
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def fingerprint(result):
+    """Short, stable digest of a query result, used to spot changes without keeping the result."""
+    if result is None:
+        result = ""
+    return hashlib.blake2b(result.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def settle(future, error=None):
+    """Complete a future, if there is one and it's still pending, with an optional error."""
+    if future is None or future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+class TrafficBudget:
+    """
+    Token bucket limiting background queries to `rate` per second, in bursts of at
+    most `burst`. Keeps optional traffic from crowding out control of the router.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        if rate <= 0:
+            raise ValueError("Traffic budget rate must be positive.")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available, without waiting."""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        """Wait until a token is available and take it."""
+        while not self.try_acquire():
+            await asyncio.sleep((1 - self._tokens) / self.rate)
 
 
 class Subscribable:
@@ -8,15 +73,21 @@ class Subscribable:
 
     """
 
+    __slots__ = ("subscriptions",)
+
     def __init__(self) -> None:
-        self.subscriptions = []
+        self.subscriptions = NO_SUBSCRIBERS
 
     def add_subscriber(self, func):
+        if self.subscriptions is NO_SUBSCRIBERS:
+            self.subscriptions = []
         self.subscriptions.append(func)
 
     def remove_subscriber(self, func):
         if func in self.subscriptions:
             self.subscriptions.remove(func)
+            if not self.subscriptions:
+                self.subscriptions = NO_SUBSCRIBERS
 
     async def update_subscribers(self):
         for sub in self.subscriptions:
@@ -19,6 +19,8 @@ class HelvarAddress:
 
     """
 
+    __slots__ = ("__block", "__router", "__subnet", "__device")
+
     def __init__(self, block: int, router: int, subnet = None, device = None):
 
         self.subnet = subnet
@@ -115,6 +117,45 @@ class HelvarAddress:
         return not (self == other)
 
 
+class ClusterAddress:
+    """
+    Represents a Helvar cluster address, @c. Used by QUERY_ROUTERS.
+
+    c - cluster: 0-253
+    """
+
+    __slots__ = ("__cluster",)
+
+    def __init__(self, cluster: int):
+        self.cluster = cluster
+
+    def __str__(self):
+        return f"@{self.cluster}"
+
+    @property
+    def cluster(self):
+        return self.__cluster
+
+    @cluster.setter
+    def cluster(self, var):
+
+        var = int(var)
+        if var < 0 or var > 253:
+            raise TypeError("Cluster must be between 0 and 253.")
+        self.__cluster = var
+
+    def __eq__(self, other):
+        if not isinstance(other, ClusterAddress):
+            return False
+        return self.cluster == other.cluster
+
+    def __hash__(self):
+        return hash(self.cluster)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+
 class SceneAddress:
     """Represents a Helvar scene address.
 
@@ -128,6 +169,8 @@ class SceneAddress:
 
     """
 
+    __slots__ = ("__group", "__block", "__scene")
+
     def __init__(self, group: int, block: int, scene: int):
 
         self.group = group
@@ -15,6 +15,14 @@ class Command:
 
     """
 
+    __slots__ = (
+        "command_type",
+        "command_parameters",
+        "command_message_type",
+        "command_address",
+        "result",
+    )
+
     def __init__(
         self,
         command_type: CommandType,
@@ -27,6 +27,9 @@ class CommandParameterType(Enum):
 
 
 class CommandParameter:
+
+    __slots__ = ("command_parameter_type", "argument")
+
     def __init__(self, command_parameter_type: CommandParameterType, argument: str):
         self.command_parameter_type = command_parameter_type
         self.argument = argument
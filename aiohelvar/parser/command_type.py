@@ -5,6 +5,7 @@ class CommandType(Enum):
 
     # Queries
     QUERY_CLUSTERS = (101, "Query Clusters.")
+    QUERY_ROUTERS = (102, "Query Routers in a cluster.")
     QUERY_GROUP_DESCRIPTION = (105, "Query group description.")
     QUERY_DEVICE_DESCRIPTION = (106, "Query device description.")
     QUERY_DEVICE_TYPES_AND_ADDRESSES = (100, "Query Device Types and Addresses")
@@ -15,6 +16,8 @@ class CommandType(Enum):
     QUERY_ROUTER_TIME = (185, "Query Router Time")
     QUERY_LAST_SCENE_IN_GROUP = (109, "Query last scene selected in a group.")
     QUERY_LAST_SCENE_IN_BLOCK = (103, "Query last scene selected in a group block.")
+    QUERY_POWER_CONSUMPTION = (160, "Query device power consumption.")
+    QUERY_GROUP_POWER_CONSUMPTION = (161, "Query group power consumption.")
     QUERY_GROUP = (164, "Query devices in group.")
     QUERY_GROUPS = (165, "Query all groups.")
     QUERY_SCENE_NAMES = (166, "Query all scene names in group.")
@@ -23,6 +26,11 @@ class CommandType(Enum):
 
     # Commands
     DIRECT_LEVEL_DEVICE = (14, "Direct Level, Device")
+    DIRECT_LEVEL_GROUP = (13, "Direct Level, Group")
+    DIRECT_PROPORTION_DEVICE = (16, "Direct Proportion, Device")
+    MODIFY_PROPORTION_DEVICE = (18, "Modify Proportion, Device")
+    DIRECT_PROPORTION_GROUP = (15, "Direct Proportion, Group")
+    MODIFY_PROPORTION_GROUP = (17, "Modify Proportion, Group")
     RECALL_SCENE = (11, "Recall Scene")
 
     def __init__(self, command_id, description):
@@ -43,6 +51,11 @@ class CommandType(Enum):
 COMMAND_TYPES_DONT_LISTEN_FOR_RESPONSE = [
     CommandType.RECALL_SCENE,
     CommandType.DIRECT_LEVEL_DEVICE,
+    CommandType.DIRECT_LEVEL_GROUP,
+    CommandType.DIRECT_PROPORTION_DEVICE,
+    CommandType.MODIFY_PROPORTION_DEVICE,
+    CommandType.DIRECT_PROPORTION_GROUP,
+    CommandType.MODIFY_PROPORTION_GROUP,
 ]
 
 
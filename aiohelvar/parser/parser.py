@@ -1,6 +1,6 @@
 from aiohelvar.exceptions import UnrecognizedCommand
 from .command_type import CommandType, MessageType
-from .address import HelvarAddress
+from .address import ClusterAddress, HelvarAddress
 from .command_parameter import CommandParameter, CommandParameterType
 from .command import Command
 
@@ -64,9 +64,10 @@ class CommandParser:
 
         if match.group("address"):
             try:
-                return HelvarAddress(
-                    *list(map(int, match.group("address").replace("@", "").split(".")))
-                )
+                parts = list(map(int, match.group("address").replace("@", "").split(".")))
+                if len(parts) == 1:
+                    return ClusterAddress(*parts)
+                return HelvarAddress(*parts)
             except ValueError as e:
                 _LOGGER.error(f"Invalid address format: {match.group('address')}")
                 return None
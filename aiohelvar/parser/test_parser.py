@@ -1,7 +1,7 @@
 from aiohelvar.parser.parser import CommandParser
 from aiohelvar.parser.command_parameter import CommandParameter, CommandParameterType
 from aiohelvar.parser.command import Command, CommandType
-from aiohelvar.parser.address import HelvarAddress, SceneAddress
+from aiohelvar.parser.address import ClusterAddress, HelvarAddress, SceneAddress
 import logging
 
 _LOGGER = logging.getLogger(__name__)
@@ -408,6 +408,17 @@ def test_parse_command_with_address():
     assert str(parsed.command_address) == "@1.2.3.4", "Address should match"
 
 
+def test_parse_command_with_cluster_address():
+    """Test parsing a QUERY_ROUTERS reply addressed to a cluster"""
+    command_string = "?V:2,C:102,@253=1,2,3#"
+    parser = CommandParser()
+    
+    parsed = parser.parse_command(bytes(command_string, "utf8"))
+    assert parsed.command_type == CommandType.QUERY_ROUTERS
+    assert parsed.command_address == ClusterAddress(253), "Cluster address should be parsed"
+    assert parsed.result == "1,2,3"
+
+
 def test_parse_command_with_result():
     """Test parsing command with result"""
     command_string = ">V:2,C:101,G:2=result_data#"
@@ -487,6 +498,7 @@ def test_scenes_none_response_handling():
     """Test that scenes.py handles None response.result gracefully"""
     from aiohelvar.scenes import Scenes
     from aiohelvar.groups import Groups
+    from aiohelvar.snapshot import Snapshots
     
     # Create a mock response with None result
     class MockResponse:
@@ -497,6 +509,7 @@ def test_scenes_none_response_handling():
         def __init__(self):
             self.scenes = Scenes(self)
             self.groups = Groups(self)
+            self.snapshots = Snapshots(self)
         
         async def _send_command_task(self, command):
             return MockResponse(None)  # Simulate None response
@@ -0,0 +1,380 @@
+from .control import WritePriority
+from .lib import TrafficBudget
+from .parser.command import Command
+from .parser.command_parameter import CommandParameter, CommandParameterType
+from .parser.command_type import CommandType
+
+from array import array
+from collections import namedtuple
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# Share of a router's write capacity background polling may use.
+DEFAULT_POLL_SHARE = 0.1
+
+# Seconds between polls of an active device, and the most an idle one backs off to.
+MIN_POLL_INTERVAL = 10
+MAX_POLL_INTERVAL = 600
+
+# Seconds between power consumption samples, and samples kept per group or device.
+DEFAULT_TELEMETRY_INTERVAL = 60
+DEFAULT_TELEMETRY_SAMPLES = 1440
+
+# Summary of a power series: sample count, min, max and mean watts, the latest
+# sample, and the energy used over the series in watt hours.
+Rollup = namedtuple(
+    "Rollup", ["samples", "minimum", "maximum", "mean", "latest", "energy"]
+)
+
+
+def needs_attention(device) -> bool:
+    """Whether a device reports a fault, lamp failure or as missing."""
+    try:
+        return device.is_faulty or device.is_lamp_failure or device.is_missing
+    except (ValueError, TypeError):
+        # State not known (yet).
+        return False
+
+
+class StatePoller:
+    """
+    Polls device states and load levels in the background, so changes made by wall
+    panels or other clients are seen. The router only notifies us of scene recalls.
+
+    Each device has its own interval, between `min_interval` and `max_interval`.
+    A device whose state or level had changed, or that reports a fault, is polled
+    again after `min_interval`; an unchanged one backs off, doubling its interval.
+    Polls are written at WritePriority.POLL, behind control and other queries, and
+    at no more than `rate` queries per second overall, or within `budget` if
+    given, a TrafficBudget shared with other background polling.
+
+    Devices with a fade, a pending write or a verification in progress are left to
+    those; polling them would race our own writes.
+    """
+
+    def __init__(
+        self,
+        router,
+        rate,
+        min_interval=MIN_POLL_INTERVAL,
+        max_interval=MAX_POLL_INTERVAL,
+        budget: TrafficBudget = None,
+    ):
+        self.router = router
+        self.budget = budget if budget is not None else TrafficBudget(rate)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        # Devices polled, and polls that found a change.
+        self.polled = 0
+        self.changed = 0
+
+        self._intervals = {}
+        # (due time, sequence, address)
+        self._due = []
+        self._sequence = itertools.count()
+        self._synced_at = None
+
+    def interval(self, address):
+        return self._intervals.get(address)
+
+    def _sync(self):
+        """Start polling newly registered devices, and stop polling removed ones."""
+
+        devices = self.router.devices.devices
+        now = time.monotonic()
+
+        for address in devices:
+            if address not in self._intervals:
+                self._intervals[address] = self.min_interval
+                heapq.heappush(self._due, (now, next(self._sequence), address))
+
+        for address in [a for a in self._intervals if a not in devices]:
+            del self._intervals[address]
+
+        self._synced_at = now
+
+    async def _query(self, command_type, address):
+        await self.budget.acquire()
+        response = await self.router._send_command_task(
+            Command(command_type, command_address=address),
+            priority=WritePriority.POLL,
+        )
+        return response.result if response else None
+
+    async def poll(self, address) -> bool:
+        """Poll one device. Returns whether its state or level had changed."""
+
+        devices = self.router.devices
+        device = devices.devices.get(address)
+        if device is None:
+            return False
+
+        changed = False
+
+        state = await self._query(CommandType.QUERY_DEVICE_STATE, address)
+        if state is not None and str(state) != str(device.state):
+            await devices.update_device_state(address, state)
+            changed = True
+
+        # A level read mid fade, or with a write still to go out, would be stale by
+        # the time it's back, so it isn't worth a query. Check again once it's back
+        # in case a write was made meanwhile.
+        if device.is_load and not self._busy(device):
+            level = await self._query(CommandType.QUERY_DEVICE_LOAD_LEVEL, address)
+            try:
+                level = float(level)
+            except (ValueError, TypeError):
+                level = None
+            if (
+                level is not None
+                and not self._busy(device)
+                and level != device.target_load_level
+            ):
+                await devices.update_device_load_level(address, level)
+                changed = True
+
+        self.polled += 1
+        if changed:
+            self.changed += 1
+        return changed
+
+    def _busy(self, device):
+        devices = self.router.devices
+        return (
+            device.is_fading
+            or devices.coalescer.is_pending(device.address)
+            or devices.verifier.is_due(device.address)
+        )
+
+    def _next_interval(self, address, changed):
+        device = self.router.devices.devices.get(address)
+        if changed or (device is not None and needs_attention(device)):
+            interval = self.min_interval
+        else:
+            interval = min(self._intervals[address] * 2, self.max_interval)
+        self._intervals[address] = interval
+        return interval
+
+    async def run(self):
+        while True:
+            if not self._due or time.monotonic() - self._synced_at > self.max_interval:
+                self._sync()
+            if not self._due:
+                await asyncio.sleep(self.min_interval)
+                continue
+
+            due, _, address = self._due[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(min(delay, self.max_interval))
+                continue
+
+            heapq.heappop(self._due)
+            if address not in self._intervals:
+                continue
+
+            try:
+                changed = await self.poll(address)
+            except Exception as e:
+                _LOGGER.error(f"Couldn't poll device {address}: {e!r}")
+                changed = False
+
+            if address in self._intervals:
+                interval = self._next_interval(address, changed)
+                heapq.heappush(
+                    self._due,
+                    (time.monotonic() + interval, next(self._sequence), address),
+                )
+
+
+class RingBuffer:
+    """Fixed size series of (timestamp, value) samples, oldest dropped first."""
+
+    __slots__ = ("_times", "_values", "_next", "_count")
+
+    def __init__(self, capacity: int):
+        self._times = array("d", bytes(8 * capacity))
+        self._values = array("d", bytes(8 * capacity))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return len(self._times)
+
+    def append(self, timestamp: float, value: float):
+        self._times[self._next] = timestamp
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def samples(self):
+        """The samples, oldest first."""
+        start = (self._next - self._count) % self.capacity
+        return [
+            (self._times[i % self.capacity], self._values[i % self.capacity])
+            for i in range(start, start + self._count)
+        ]
+
+
+def rollup(samples) -> Rollup:
+    """Summarise a list of (timestamp, watts) samples. None if there are none."""
+
+    if not samples:
+        return None
+
+    values = [value for _, value in samples]
+    energy = sum(
+        (v0 + v1) / 2 * (t1 - t0) for (t0, v0), (t1, v1) in zip(samples, samples[1:])
+    )
+    return Rollup(
+        len(values),
+        min(values),
+        max(values),
+        sum(values) / len(values),
+        values[-1],
+        energy / 3600,
+    )
+
+
+class TelemetryPoller:
+    """
+    Samples power consumption every `interval` seconds: QUERY_GROUP_POWER_CONSUMPTION
+    for every group, and with devices, QUERY_POWER_CONSUMPTION for every load.
+
+    Each round's queries are sent together at WritePriority.POLL, within a traffic
+    budget of `rate` queries per second (or `budget`, as for StatePoller), and
+    their results are stored under the round's timestamp in a RingBuffer of
+    `capacity` samples per group and device. rollups() and total() summarise them.
+    """
+
+    def __init__(
+        self,
+        router,
+        rate,
+        interval=DEFAULT_TELEMETRY_INTERVAL,
+        capacity=DEFAULT_TELEMETRY_SAMPLES,
+        devices=False,
+        budget: TrafficBudget = None,
+    ):
+        self.router = router
+        self.budget = budget if budget is not None else TrafficBudget(rate)
+        self.interval = interval
+        self.capacity = capacity
+        self.sample_devices = devices
+
+        self.groups = {}
+        self.devices = {}
+
+    def _queries(self):
+        queries = [
+            (
+                self.groups,
+                group_id,
+                Command(
+                    CommandType.QUERY_GROUP_POWER_CONSUMPTION,
+                    [CommandParameter(CommandParameterType.GROUP, group_id)],
+                ),
+            )
+            for group_id in self.router.groups.groups
+        ]
+        if self.sample_devices:
+            queries += [
+                (
+                    self.devices,
+                    device.address,
+                    Command(
+                        CommandType.QUERY_POWER_CONSUMPTION,
+                        command_address=device.address,
+                    ),
+                )
+                for device in self.router.devices.get_light_devices()
+            ]
+        return queries
+
+    async def _query(self, command):
+        response = await self.router._send_command_task(
+            command, priority=WritePriority.POLL
+        )
+        return float(response.result)
+
+    async def sample(self):
+        """Take one round of samples."""
+
+        timestamp = time.time()
+        queries = self._queries()
+
+        tasks = []
+        for _, _, command in queries:
+            await self.budget.acquire()
+            tasks.append(asyncio.create_task(self._query(command)))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        for (buffers, key, _), result in zip(queries, results):
+            if isinstance(result, Exception):
+                _LOGGER.warning(
+                    f"Couldn't sample power consumption of {key}: {result!r}"
+                )
+                continue
+            buffer = buffers.get(key)
+            if buffer is None:
+                buffer = buffers[key] = RingBuffer(self.capacity)
+            buffer.append(timestamp, result)
+
+        # Stop keeping series for groups and devices that have gone.
+        groups, devices = self.router.groups.groups, self.router.devices.devices
+        for group_id in [g for g in self.groups if g not in groups]:
+            del self.groups[group_id]
+        for address in [a for a in self.devices if a not in devices]:
+            del self.devices[address]
+
+    def rollups(self, since=None):
+        """
+        {group_id: Rollup} and {address: Rollup}, over samples taken at or after
+        `since` (a time.time() timestamp), or every sample kept.
+        """
+
+        def summarise(buffers):
+            summaries = {}
+            for key, buffer in buffers.items():
+                summary = rollup(
+                    [s for s in buffer.samples() if since is None or s[0] >= since]
+                )
+                if summary is not None:
+                    summaries[key] = summary
+            return summaries
+
+        return summarise(self.groups), summarise(self.devices)
+
+    def total(self, since=None) -> Rollup:
+        """
+        The whole site's power, summed round by round over devices if they're
+        sampled, otherwise over groups. Groups can share devices, so a group total
+        counts those devices once per group.
+        """
+
+        buffers = self.devices if self.sample_devices else self.groups
+        rounds = {}
+        for buffer in buffers.values():
+            for timestamp, value in buffer.samples():
+                if since is None or timestamp >= since:
+                    rounds[timestamp] = rounds.get(timestamp, 0.0) + value
+        return rollup(sorted(rounds.items()))
+
+    async def run(self):
+        while True:
+            try:
+                await self.sample()
+            except Exception as e:
+                _LOGGER.error(f"Power consumption sampling failed: {e!r}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,294 @@
+from .devices import register_subnet_devices
+from .discovery import DiscoveryPhase
+from .groups import (
+    group_members_query,
+    parse_group_ids,
+    parse_group_members,
+    refresh_group,
+    update_group_devices,
+)
+from .lib import TrafficBudget, fingerprint
+from .parser.address import HelvarAddress
+from .parser.command import Command
+from .parser.command_type import CommandType
+from .scenes import apply_scene_names
+from .snapshot import topology_state
+
+from collections import namedtuple
+import asyncio
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+
+SUBNETS = range(1, 5)
+
+RevalidationReport = namedtuple(
+    "RevalidationReport",
+    [
+        "changed_subnets",
+        "added_devices",
+        "removed_devices",
+        "added_groups",
+        "removed_groups",
+        "scene_names_changed",
+        "changed_groups",
+    ],
+)
+
+# Raw query results to compare against the recorded fingerprints. subnets and
+# group_members are {subnet: result} and {group_id: result}.
+FingerprintResults = namedtuple(
+    "FingerprintResults", ["subnets", "groups", "scene_names", "group_members"]
+)
+
+# Seconds between checks of a TopologyWatcher.
+DEFAULT_WATCH_INTERVAL = 300
+
+# Queries per second a TopologyWatcher may send, including rediscovery.
+DEFAULT_WATCH_RATE = 1.0
+
+
+def _subnet_query(router, subnet):
+    return Command(
+        CommandType.QUERY_DEVICE_TYPES_AND_ADDRESSES,
+        command_address=HelvarAddress(router.cluster_id, router.router_id, subnet),
+    )
+
+
+async def query_fingerprints(router, budget: TrafficBudget = None, group_ids=()):
+    """
+    Send the fingerprint queries: one per subnet, QUERY_GROUPS and QUERY_SCENE_NAMES,
+    plus QUERY_GROUP for each of group_ids. Without a budget they're sent at once,
+    with one they're sent one at a time as the budget allows.
+    """
+
+    queries = [(("subnet", subnet), _subnet_query(router, subnet)) for subnet in SUBNETS]
+    queries.append((("groups", None), Command(CommandType.QUERY_GROUPS)))
+    queries.append((("scene_names", None), Command(CommandType.QUERY_SCENE_NAMES)))
+    queries += [
+        (("group", group_id), group_members_query(group_id)) for group_id in group_ids
+    ]
+
+    if budget is None:
+        responses = await asyncio.gather(
+            *[router._send_command_task(command) for _, command in queries]
+        )
+    else:
+        responses = []
+        for _, command in queries:
+            await budget.acquire()
+            responses.append(await router._send_command_task(command))
+
+    results = {
+        key: response.result if response else None
+        for (key, _), response in zip(queries, responses)
+    }
+
+    return FingerprintResults(
+        {subnet: results[("subnet", subnet)] for subnet in SUBNETS},
+        results[("groups", None)],
+        results[("scene_names", None)],
+        {group_id: results[("group", group_id)] for group_id in group_ids},
+    )
+
+
+def _changed_members(router, results: FingerprintResults):
+    """{group_id: addresses} for the queried groups whose membership has changed."""
+
+    changed = {}
+    for group_id, result in results.group_members.items():
+        group = router.groups.groups.get(int(group_id))
+        if group is None or result is None:
+            continue
+        addresses = parse_group_members(result)
+        if addresses != list(group.devices):
+            changed[int(group_id)] = addresses
+    return changed
+
+
+def has_changes(router, results: FingerprintResults) -> bool:
+    """Whether any fingerprint query result differs from what's recorded."""
+
+    return (
+        any(
+            router.devices.subnet_fingerprints.get(subnet) != fingerprint(result)
+            for subnet, result in results.subnets.items()
+        )
+        or router.groups.fingerprint != fingerprint(results.groups)
+        or router.scenes.names_fingerprint != fingerprint(results.scene_names)
+        or bool(_changed_members(router, results))
+    )
+
+
+async def revalidate(router) -> RevalidationReport:
+    """
+    Check a (cached) topology against the router and refetch only what has changed.
+
+    Sends one fingerprint query per subnet plus QUERY_GROUPS and QUERY_SCENE_NAMES,
+    and compares digests of the results with the fingerprints recorded at the last
+    discovery. Only subnets, groups and scene tables whose fingerprint differs are
+    refetched, so an unchanged site costs six queries.
+
+    Changes that don't show in those results (a renamed device, a device moved
+    between groups without any device being added) aren't detected.
+    """
+
+    report = await apply_fingerprints(router, await query_fingerprints(router))
+
+    # New devices may have joined existing groups. A TopologyWatcher finds those
+    # as it checks each group in turn; a one off revalidation re-reads them all.
+    if report.added_devices:
+        handled = set(report.added_groups) | set(report.changed_groups)
+        for group_id in list(router.groups.groups):
+            if group_id not in handled:
+                router.discovery.spawn(
+                    f"group members {group_id}",
+                    update_group_devices(router, group_id),
+                    DiscoveryPhase.TOPOLOGY,
+                )
+    return report
+
+
+async def apply_fingerprints(router, results: FingerprintResults) -> RevalidationReport:
+    """Refetch whatever the fingerprint query results show has changed."""
+
+    changed_subnets, added_devices, removed_devices = [], [], []
+
+    for subnet, result in results.subnets.items():
+        digest = fingerprint(result)
+        if router.devices.subnet_fingerprints.get(subnet) == digest:
+            continue
+
+        _LOGGER.info(f"Subnet {subnet} has changed, refreshing its devices.")
+        changed_subnets.append(subnet)
+        router.devices.subnet_fingerprints[subnet] = digest
+
+        added, removed, _ = register_subnet_devices(
+            router,
+            HelvarAddress(router.cluster_id, router.router_id, subnet),
+            result if result and "@" in result else "",
+        )
+        added_devices += added
+        removed_devices += removed
+
+        for address in added:
+            await router.devices.update_device(address)
+
+    added_groups, removed_groups = [], []
+    groups_result = results.groups
+    digest = fingerprint(groups_result)
+
+    if router.groups.fingerprint != digest:
+        group_ids = parse_group_ids(groups_result) if groups_result else []
+        if group_ids is not None:
+            router.groups.fingerprint = digest
+            listed = {int(group_id) for group_id in group_ids}
+
+            added_groups = [g for g in group_ids if int(g) not in router.groups.groups]
+            removed_groups = [g for g in router.groups.groups if g not in listed]
+
+            for group_id in removed_groups:
+                router.groups.unregister_group(group_id)
+                router.scenes.unregister_group_scenes(group_id)
+
+            for group_id in added_groups:
+                refresh_group(router, group_id)
+                router.scenes.register_group_scenes(group_id)
+
+    changed_groups = _changed_members(router, results)
+    for group_id, addresses in changed_groups.items():
+        _LOGGER.info(f"Group {group_id} membership has changed.")
+        router.groups.update_group_device_members(group_id, addresses)
+
+    names_result = results.scene_names
+    digest = fingerprint(names_result)
+    scene_names_changed = router.scenes.names_fingerprint != digest
+
+    if scene_names_changed:
+        router.scenes.names_fingerprint = digest
+        apply_scene_names(router, names_result)
+
+    report = RevalidationReport(
+        changed_subnets,
+        added_devices,
+        removed_devices,
+        [int(g) for g in added_groups],
+        removed_groups,
+        scene_names_changed,
+        list(changed_groups),
+    )
+    _LOGGER.info(f"Revalidated topology: {report}")
+    return report
+
+
+class TopologyWatcher:
+    """
+    Periodically checks a router's topology for changes in the background.
+
+    Every `interval` seconds the fingerprint queries (see revalidate()) are sent,
+    along with QUERY_GROUP for the next `groups_per_check` groups in rotation, so
+    membership changes are picked up too, including devices added to existing
+    groups. Only a changed subnet or group is rediscovered, and the changes are
+    published as a topology diff.
+
+    All of it, rediscovery included, is kept within `rate` queries per second on
+    average, so the watcher never crowds out control traffic.
+    """
+
+    def __init__(
+        self,
+        router,
+        interval=DEFAULT_WATCH_INTERVAL,
+        rate=DEFAULT_WATCH_RATE,
+        groups_per_check=8,
+    ):
+        self.router = router
+        self.interval = interval
+        self.groups_per_check = groups_per_check
+        # Enough burst for the fixed checks to go out together.
+        self.budget = TrafficBudget(rate, burst=len(SUBNETS) + 2)
+        self._group_cursor = 0
+
+    def _next_group_ids(self):
+        group_ids = sorted(self.router.groups.groups)
+        if not group_ids or not self.groups_per_check:
+            return []
+
+        start = self._group_cursor % len(group_ids)
+        selected = (group_ids[start:] + group_ids[:start])[: self.groups_per_check]
+        self._group_cursor = start + len(selected)
+        return selected
+
+    async def check(self):
+        """
+        Run one check. Returns a RevalidationReport if anything had changed,
+        otherwise None.
+        """
+
+        router = self.router
+        results = await query_fingerprints(router, self.budget, self._next_group_ids())
+
+        if not has_changes(router, results):
+            return None
+
+        before = topology_state(router)
+
+        # Rediscovery queries wait for the budget too, one per discovery step.
+        router.discovery.throttle(self.budget)
+        try:
+            report = await apply_fingerprints(router, results)
+            await router.discovery.wait()
+        finally:
+            router.discovery.throttle(None)
+
+        await router.publish_topology_diff(before)
+        return report
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                _LOGGER.error(f"Topology check failed: {e!r}")
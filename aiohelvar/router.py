@@ -2,6 +2,39 @@ from aiohelvar.parser.command_parameter import CommandParameterType
 from .devices import Devices, get_devices
 from .groups import Groups, get_groups
 from .scenes import Scenes, get_scenes
+from .snapshot import (
+    RouterSnapshot,
+    Snapshots,
+    TopologyDiff,
+    TopologyState,
+    topology_diff,
+    topology_state,
+)
+from .cache import TopologyCache
+from .control import DEFAULT_COALESCE_WINDOW, WritePriority
+from .lib import TrafficBudget, settle
+from .polling import (
+    DEFAULT_POLL_SHARE,
+    DEFAULT_TELEMETRY_INTERVAL,
+    DEFAULT_TELEMETRY_SAMPLES,
+    MAX_POLL_INTERVAL,
+    MIN_POLL_INTERVAL,
+    StatePoller,
+    TelemetryPoller,
+)
+from .revalidation import (
+    DEFAULT_WATCH_INTERVAL,
+    DEFAULT_WATCH_RATE,
+    RevalidationReport,
+    TopologyWatcher,
+    revalidate,
+)
+from .discovery import (
+    DEFAULT_DISCOVERY_CONCURRENCY,
+    Discovery,
+    DiscoveryPhase,
+    DiscoveryReport,
+)
 from .parser.parser import CommandParser
 from .parser.command_type import (
     COMMAND_TYPES_DONT_LISTEN_FOR_RESPONSE,
@@ -12,6 +45,7 @@ from .parser.command import Command
 from .exceptions import CommandResponseTimeout, ParserError
 import asyncio
 import datetime
+import itertools
 import logging
 import ipaddress
 
@@ -26,11 +60,26 @@ COMMAND_RESPONSE_TIMEOUT = 30
 
 KEEP_ALIVE_PERIOD = 120
 
+# Pause between writes to one router. Small buffer. It's possible to overload a router.
+WRITE_INTERVAL = 0.01
+
 
 class Router:
     """Control a Helvar Router."""
 
-    def __init__(self, host, port, cluster_id=0, router_id=1, use_specified_ids=False):
+    def __init__(
+        self,
+        host,
+        port,
+        cluster_id=0,
+        router_id=1,
+        use_specified_ids=False,
+        discovery_concurrency=DEFAULT_DISCOVERY_CONCURRENCY,
+        scene_prefetch_rate=None,
+        coalesce_window=DEFAULT_COALESCE_WINDOW,
+        verify_levels=True,
+        elide_writes=False,
+    ):
         self.host = host
         self.port = port
         
@@ -62,15 +111,37 @@ class Router:
 
         self.config = None
 
+        self.snapshots = Snapshots(self)
+
+        self.discovery_concurrency = discovery_concurrency
+        self.discovery = Discovery(discovery_concurrency)
+
         self.groups = Groups(self)
 
         self.devices = Devices(self)
+        # Seconds level writes are held to collapse rapid changes, see LevelCoalescer.
+        self.devices.coalescer.window = coalesce_window
+        # Read written levels back once their fades end, see FadeVerifier.
+        self.devices.verifier.enabled = verify_levels
+        # Drop level writes that wouldn't change anything.
+        self.devices.coalescer.elide = elide_writes
 
         self.lights = None
         self.scenes = Scenes(self)
         self.sensors = None
 
-        self.commands_to_send = asyncio.Queue()
+        # (priority, sequence, data, written): FIFO within each WritePriority.
+        self.commands_to_send = asyncio.PriorityQueue()
+        self._write_sequence = itertools.count()
+
+        # Session resources. A HelvarCluster replaces these with ones shared by all
+        # of its routers: one parser, one write scheduler and one keep alive timer.
+        self.parser = CommandParser()
+        self.scheduler = None
+        self.keep_alive = True
+        self._stream_reader_task = None
+        self._stream_writer_task = None
+        self._keep_alive_task = None
 
         self.commands_received = []
         self.command_received = asyncio.Condition()
@@ -79,6 +150,28 @@ class Router:
 
         self.workgroup_name = None
 
+        self._cache_task = None
+
+        # Called as func(diff) with a TopologyDiff whenever discovery, a refresh or
+        # revalidation changes the topology.
+        self.topology_subscriptions = []
+
+        # Scene tables to prefetch per second once initialised. None only fetches
+        # them when a scene recall needs them.
+        self.scene_prefetch_rate = scene_prefetch_rate
+        self._prefetch_task = None
+
+        # The traffic budget state and telemetry polling share, see _poll_budget().
+        self._polling_budget = None
+        # Background watchers and pollers, kept so reconnect() can restart them.
+        self._watcher = None
+        self._poller = None
+        self._telemetry_poller = None
+        self._watch_task = None
+        self._poll_task = None
+        self._resync_task = None
+        self._telemetry_task = None
+
     @property
     def id(self):
         """Return the ID of the router."""
@@ -87,6 +180,15 @@ class Router:
 
         return self._router_id
 
+    def snapshot(self) -> RouterSnapshot:
+        """
+        Return an immutable view of the router's devices, groups and scenes.
+
+        Cheap to call repeatedly: the same snapshot is returned until something
+        changes, and new versions share unchanged parts with the previous one.
+        """
+        return self.snapshots.snapshot()
+
     async def connect(self):
         _LOGGER.debug("Connecting...")
 
@@ -104,9 +206,10 @@ class Router:
         self._stream_reader_task = asyncio.create_task(
             self._stream_reader(self._reader)
         )
-        self._stream_writer_task = asyncio.create_task(
-            self._stream_writer(self._reader, self._writer)
-        )
+        if self.scheduler is None:
+            self._stream_writer_task = asyncio.create_task(
+                self._stream_writer(self._reader, self._writer)
+            )
 
         # Read the workgroup name:
         response = await self._send_command_task(
@@ -115,23 +218,50 @@ class Router:
         self.workgroup_name = response.result
 
         # Kick off the keepalive task
-        self._keep_alive_task = asyncio.create_task(self._keep_alive())
+        if self.keep_alive:
+            self._keep_alive_task = asyncio.create_task(self._keep_alive())
 
     async def reconnect(self):
         await self.disconnect()
         await self.connect()
 
+        # Levels may have changed while we weren't listening.
+        if self.groups.groups:
+            self._resync_task = asyncio.create_task(self.groups.resync())
+
+        # Pick up background watching and polling where the disconnect left it.
+        if self._watcher is not None:
+            self._watch_task = asyncio.create_task(self._watcher.run())
+        if self._poller is not None:
+            self._poll_task = asyncio.create_task(self._poller.run())
+        if self._telemetry_poller is not None:
+            self._telemetry_task = asyncio.create_task(self._telemetry_poller.run())
+
     async def disconnect(self):
         _LOGGER.info("Disconnecting...")
         tasks = [
             self._stream_reader_task,
             self._stream_writer_task,
             self._keep_alive_task,
+            self._cache_task,
+            self._prefetch_task,
+            self._watch_task,
+            self._poll_task,
+            self._resync_task,
+            self._telemetry_task,
         ]
 
         for task in tasks:
             if task is not None:
                 task.cancel()
+        self.devices.verifier.cancel()
+
+        if self.scheduler is not None:
+            self.scheduler.forget(self)
+
+        while not self.commands_to_send.empty():
+            _, _, _, written = self.commands_to_send.get_nowait()
+            settle(written, ConnectionError("Disconnected before the command was sent."))
 
         self._writer.close()
         await self._writer.wait_closed()
@@ -141,6 +271,13 @@ class Router:
     async def _keep_alive(self):
         """Keep the TCP connection alive. This'll also clean up any stale command futures."""
 
+        while True:
+            await asyncio.sleep(KEEP_ALIVE_PERIOD)
+            await self.ping()
+
+    async def ping(self) -> asyncio.Task:
+        """Send one keep alive query. Reconnects if the router doesn't answer."""
+
         def _keep_alive_callback(task):
 
             if task.exception():
@@ -156,15 +293,13 @@ class Router:
                     raise (task.exception())
             _LOGGER.debug("Keepalive kept the router TCP connection alive.")
 
-        while True:
-            await asyncio.sleep(KEEP_ALIVE_PERIOD)
-            keepalive = await self.send_command(Command(CommandType.QUERY_ROUTER_TIME))
-
-            keepalive.add_done_callback(_keep_alive_callback)
+        keepalive = await self.send_command(Command(CommandType.QUERY_ROUTER_TIME))
+        keepalive.add_done_callback(_keep_alive_callback)
+        return keepalive
 
     async def _stream_reader(self, reader):
         _LOGGER.info("Connected.")
-        parser = CommandParser()
+        parser = self.parser
 
         while True:
             line = await reader.readuntil(COMMAND_TERMINATOR)
@@ -199,40 +334,269 @@ class Router:
     async def _stream_writer(self, reader, writer):
 
         while True:
-            command_string = await self.commands_to_send.get()
+            _, _, command_string, written = await self.commands_to_send.get()
             _LOGGER.info(f"Sending command '{command_string}'...")
-            writer.write(command_string)
-            # Small buffer. It's possible to overload a router.
-            await asyncio.sleep(0.01)
-            await writer.drain()
+            try:
+                writer.write(command_string)
+                # Small buffer. It's possible to overload a router.
+                await asyncio.sleep(WRITE_INTERVAL)
+                await writer.drain()
+            except Exception as e:
+                settle(written, e)
+                raise
+            settle(written)
             self.commands_to_send.task_done()
 
-    async def wait_for_pending_replies(self):
-        while True:
-            if len(self.command_received._waiters) == 0:
-                return
-            await asyncio.sleep(0.1)
+    async def wait_for_pending_replies(self, timeout=None) -> DiscoveryReport:
+        """Wait for outstanding discovery work to finish. See Discovery.wait()."""
+        return await self.discovery.wait(timeout)
 
-    async def initialize(self):
+    async def initialize(
+        self, cache: TopologyCache = None, timeout=None, progress=None
+    ) -> DiscoveryReport:
+        """
+        Discover the router's groups, devices and scenes.
+
+        Returns once every discovery query has been answered, or once `timeout`
+        seconds have passed; the returned report lists anything still outstanding.
+        `progress`, if given, is called as progress(done, total, step_name) as
+        discovery steps finish.
+
+        Per-device scene tables are fetched when first needed. With a
+        `scene_prefetch_rate`, missing tables are also fetched in the background
+        afterwards, at no more than that many queries per second.
+
+        With a cache, a previously saved topology is loaded and the router goes live
+        with it straight away. It's then revalidated in the background (see
+        revalidate()), load levels are resynced from each group's last scene (see
+        Groups.resync()), device states are re-read only on changed subnets, and
+        the cache is re-saved once that has finished.
+        """
 
         # Attempt Connection
         if not self.connected:
             await self.connect()
 
+        self.discovery = Discovery(self.discovery_concurrency, progress)
+
+        before = topology_state(self)
+        if cache is not None and await cache.load(self):
+            await self.publish_topology_diff(before)
+            self._cache_task = asyncio.create_task(self._refresh_cache(cache))
+            self._start_scene_prefetch()
+            return self.discovery.report()
+
+        report = await self._discover(timeout)
+
+        if cache is not None and report.complete:
+            self._cache_task = asyncio.create_task(cache.save(self))
+
+        self._start_scene_prefetch()
+
+        return report
+
+    def _start_scene_prefetch(self):
+        if self.scene_prefetch_rate is None:
+            return
+        if self._prefetch_task is not None:
+            self._prefetch_task.cancel()
+        self._prefetch_task = asyncio.create_task(
+            self.devices.prefetch_scene_levels(TrafficBudget(self.scene_prefetch_rate))
+        )
+
+    async def _refresh_cache(self, cache: TopologyCache):
+        if self.groups.fingerprint is None:
+            # No fingerprints to compare against - rescan everything.
+            report = await self._discover()
+        else:
+            # Fingerprints only cover the structure; cached levels may be stale.
+            # Resync them with one query per group, and only re-read device
+            # states on the subnets that have changed.
+            revalidation = await self.revalidate()
+            self._plan_state_refresh(revalidation)
+            await self.groups.resync()
+            report = await self.discovery.wait()
+
+        if report.complete:
+            await cache.save(self)
+
+    async def revalidate(self) -> RevalidationReport:
+        """
+        Refetch only the subnets, groups and scene names that have changed, and
+        publish the resulting topology changes.
+        """
+
+        before = topology_state(self)
+        report = await revalidate(self)
+        await self.discovery.wait()
+        await self.publish_topology_diff(before)
+        return report
+
+    def watch_topology(
+        self, interval=DEFAULT_WATCH_INTERVAL, rate=DEFAULT_WATCH_RATE
+    ) -> TopologyWatcher:
+        """
+        Start checking for topology changes in the background, see TopologyWatcher.
+        Changes are published like those of refresh(). Stops on disconnect, and
+        restarts on reconnect().
+        """
+
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+
+        self._watcher = TopologyWatcher(self, interval, rate)
+        self._watch_task = asyncio.create_task(self._watcher.run())
+        return self._watcher
+
+    def _poll_budget(self, share):
+        """
+        The one budget all background polling shares, so together it stays within
+        `share` of the router's write capacity. The latest share given applies.
+        """
+
+        rate = share / WRITE_INTERVAL
+        if self._polling_budget is None:
+            self._polling_budget = TrafficBudget(rate)
+        else:
+            self._polling_budget.rate = rate
+        return self._polling_budget
+
+    def poll_state(
+        self,
+        share=DEFAULT_POLL_SHARE,
+        min_interval=MIN_POLL_INTERVAL,
+        max_interval=MAX_POLL_INTERVAL,
+    ) -> StatePoller:
+        """
+        Start polling device states and load levels in the background, see
+        StatePoller. Polling, telemetry included, uses at most `share` of the
+        router's write capacity, and only goes out when no other writes are queued.
+        Stops on disconnect, and restarts on reconnect().
+        """
+
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+
+        budget = self._poll_budget(share)
+        self._poller = StatePoller(
+            self, budget.rate, min_interval, max_interval, budget=budget
+        )
+        self._poll_task = asyncio.create_task(self._poller.run())
+        return self._poller
+
+    def poll_telemetry(
+        self,
+        interval=DEFAULT_TELEMETRY_INTERVAL,
+        share=DEFAULT_POLL_SHARE,
+        capacity=DEFAULT_TELEMETRY_SAMPLES,
+        devices=False,
+    ) -> TelemetryPoller:
+        """
+        Start sampling group (and with devices, device) power consumption in the
+        background, see TelemetryPoller. It shares one budget with state polling,
+        at most `share` of the router's write capacity between them. Stops on
+        disconnect, and restarts on reconnect().
+        """
+
+        if self._telemetry_task is not None:
+            self._telemetry_task.cancel()
+
+        budget = self._poll_budget(share)
+        self._telemetry_poller = TelemetryPoller(
+            self, budget.rate, interval, capacity, devices, budget=budget
+        )
+        self._telemetry_task = asyncio.create_task(self._telemetry_poller.run())
+        return self._telemetry_poller
+
+    async def refresh(self, timeout=None) -> TopologyDiff:
+        """
+        Rediscover the whole router. Known devices and groups are kept, and only
+        what changed is published (see publish_topology_diff()) and returned.
+        """
+
+        before = topology_state(self)
+        self.discovery = Discovery(self.discovery_concurrency)
+        self._plan_discovery()
+        await self.discovery.wait(timeout)
+        return await self.publish_topology_diff(before)
+
+    def register_topology_subscription(self, func):
+        self.topology_subscriptions.append(func)
+
+    def unregister_topology_subscription(self, func):
+        if func in self.topology_subscriptions:
+            self.topology_subscriptions.remove(func)
+
+    async def publish_topology_diff(self, before: TopologyState) -> TopologyDiff:
+        """
+        Work out what has structurally changed since `before`, notify the
+        subscribers of added and changed groups, and pass the diff to topology
+        subscribers. Nothing is notified when nothing has changed.
+        """
+
+        diff = topology_diff(before, topology_state(self))
+        if not diff:
+            return diff
+
+        _LOGGER.info(
+            f"Topology changed: {len(diff.added_devices)} devices added, "
+            f"{len(diff.removed_devices)} removed, {len(diff.changed_devices)} changed; "
+            f"{len(diff.added_groups)} groups added, {len(diff.removed_groups)} removed, "
+            f"{len(diff.changed_groups)} changed; {len(diff.scene_names)} scenes renamed."
+        )
+
+        for group_id in diff.added_groups + diff.changed_groups:
+            group = self.groups.groups.get(group_id)
+            if group is not None:
+                await group.update_subscribers()
+
+        for func in list(self.topology_subscriptions):
+            await func(diff)
+
+        return diff
+
+    async def _discover(self, timeout=None) -> DiscoveryReport:
+        before = topology_state(self)
+        self._plan_discovery()
+
+        report = await self.discovery.wait(timeout)
+
+        await self.publish_topology_diff(before)
+
+        return report
+
+    def _plan_discovery(self):
+        """
+        Plan discovery so control and status are usable as early as possible: group
+        membership and device lists first, then load levels and states, then names.
+        Per-device scene tables aren't part of discovery (see
+        Devices.fetch_scene_levels()). The report's `phases` gives the time to
+        ready of each DiscoveryPhase.
+        """
+
         # Get Groups
-        await self.get_groups()
+        self.discovery.spawn("groups", self.get_groups(), DiscoveryPhase.TOPOLOGY)
 
         # Get Devices
-        await self.get_devices()
+        self.discovery.spawn("devices", self.get_devices(), DiscoveryPhase.TOPOLOGY)
 
         # Get Clusters
         # await self.get_clusters()
 
-        # Get Scenes
-        await self.get_scenes()
+        # Get Scenes. Needs the groups, which the planner guarantees by then.
+        self.discovery.spawn("scene names", self.get_scenes(), DiscoveryPhase.NAMES)
+
+    def _plan_state_refresh(self, revalidation: RevalidationReport):
+        """
+        Plan state and load level reads for the known devices on the subnets that
+        revalidation found changed. Devices it added are read as they're added.
+        """
 
-        # Update group scenes
-        await self.groups.force_update_groups()
+        changed = set(revalidation.changed_subnets)
+        added = set(revalidation.added_devices)
+        for address in list(self.devices.devices):
+            if address.subnet in changed and address not in added:
+                self.devices.refresh_device_state(address)
 
     async def get_groups(self):
 
@@ -253,11 +617,19 @@ class Router:
 
     #     print(response.result())
 
-    async def _send_command_task(self, command: Command):
+    async def _send_command_task(self, command: Command, written=None, priority=None):
 
         start_time = datetime.datetime.now()
 
-        await self.send_string(str(command))
+        if priority is None:
+            # Commands that change levels go ahead of queries.
+            priority = (
+                WritePriority.CONTROL
+                if command.command_type in COMMAND_TYPES_DONT_LISTEN_FOR_RESPONSE
+                else WritePriority.NORMAL
+            )
+
+        await self.send_string(str(command), written, priority)
 
         def check_for_command_response():
             """Task that is scheduled after every command is sent. It checks for incoming messages
@@ -311,8 +683,24 @@ class Router:
         """
         return asyncio.create_task(self._send_command_task(command))
 
-    async def send_string(self, string: str):
-        await self.commands_to_send.put(bytes(string, "utf-8"))
+    async def send_string(
+        self,
+        string: str,
+        written: asyncio.Future = None,
+        priority=WritePriority.NORMAL,
+    ):
+        """
+        Queue a string for the writer, behind anything queued at the same or a
+        higher priority. `written`, if given, is completed once it has been written
+        to the router, or fails if it couldn't be.
+        """
+        data = bytes(string, "utf-8")
+        if self.scheduler is not None:
+            self.scheduler.enqueue(self, data, written, priority)
+            return
+        await self.commands_to_send.put(
+            (priority, next(self._write_sequence), data, written)
+        )
 
     async def handle_scene_recall(self, command: Command):
         """
@@ -1,11 +1,16 @@
 from .parser.address import SceneAddress
 from .parser.command import Command, CommandType
+from .lib import fingerprint, intern_string
+from .static import SCENE_BLOCKS, SCENES_PER_BLOCK
 import logging
 
 _LOGGER = logging.getLogger(__name__)
 
 
 class Scene:
+
+    __slots__ = ("name", "levels", "address")
+
     def __init__(self, scene_address: SceneAddress, levels=None, name=None):
         self.name = name
         self.levels = levels
@@ -25,13 +30,17 @@ class Scenes:
     def __init__(self, router):
         self.router = router
         self.scenes = {}
+        # Fingerprint of the last QUERY_SCENE_NAMES result, see revalidation.
+        self.names_fingerprint = None
 
     def register_scene(self, scene_address, scene):
         self.scenes[scene_address] = scene
+        self.router.snapshots.mark_scene(scene_address)
 
     def update_scene_name(self, scene_address, name):
         try:
-            self.scenes[scene_address].name = name
+            self.scenes[scene_address].name = intern_string(name)
+            self.router.snapshots.mark_scene(scene_address)
         except KeyError:
             _LOGGER.error(
                 f"Cannot update scene name: Scene not found {scene_address} "
@@ -39,6 +48,11 @@ class Scenes:
                 f"Available scenes: {list(self.scenes.keys())}"
             )
 
+    def unregister_group_scenes(self, group_id: int):
+        for scene_address in [a for a in self.scenes if a.group == int(group_id)]:
+            del self.scenes[scene_address]
+            self.router.snapshots.mark_scene(scene_address)
+
     def get_scene(self, scene_address):
         try:
             return self.scenes[scene_address]
@@ -62,6 +76,14 @@ class Scenes:
         except KeyError:
             return default
 
+    def register_group_scenes(self, group_id: int):
+        """Register an (unnamed) Scene for every scene address in a group, keeping existing ones."""
+        for block in SCENE_BLOCKS:
+            for scene in SCENES_PER_BLOCK:
+                scene_address = SceneAddress(int(group_id), block, scene)
+                if scene_address not in self.scenes:
+                    self.register_scene(scene_address, Scene(scene_address))
+
     def get_scenes_for_group(self, group_id: int, only_named=True):
 
         _LOGGER.info(
@@ -93,39 +115,50 @@ async def get_scenes(router, groups):
     response = await router._send_command_task(Command(CommandType.QUERY_SCENE_NAMES))
 
     for group in groups.groups.values():
-        for block in range(1, 254):
-            for scene in range(1, 17):
-                scene = Scene(SceneAddress(int(group.group_id), int(block), int(scene)))
-                router.scenes.register_scene(scene.address, scene)
+        router.scenes.register_group_scenes(group.group_id)
 
-    # Check if response.result is None or empty
-    if not response or not response.result:
-        _LOGGER.warning("No scene names returned from router")
-        return
+    router.scenes.names_fingerprint = fingerprint(response.result if response else None)
 
-    try:
-        parts = response.result.strip("@").split("@")
-    except AttributeError:
-        _LOGGER.error("Response result is not a string - cannot parse scene names, no scenes added.")
-        return
+    apply_scene_names(router, response.result if response else None)
 
-    for part in parts:
-        if not part.strip():  # Skip empty parts
-            continue
-        sub_parts = part.split(":")
 
-        try:
-            if len(sub_parts) < 2:
-                _LOGGER.warning(f"Invalid scene part format: {part}")
-                continue
-            scene_address = SceneAddress(*[int(a) for a in sub_parts[0].split(".")])
-            router.scenes.update_scene_name(scene_address, sub_parts[1])
-        except (KeyError, ValueError, IndexError) as e:
-            _LOGGER.error(f"Error parsing scene address {part}: {e}")
+def apply_scene_names(router, result):
+    """
+    Set scene names from a QUERY_SCENE_NAMES result. Scenes the result no longer
+    names lose their name.
+    """
 
-    # [router.scenes.register_scene(scene.address, scene) for scene in scenes]
+    names = {}
+    if not result:
+        _LOGGER.warning("No scene names returned from router")
+    else:
+        try:
+            parts = result.strip("@").split("@")
+        except AttributeError:
+            _LOGGER.error("Response result is not a string - cannot parse scene names, no scenes added.")
+            return
 
-    # for group in groups:
-    #     router.groups.register_group(group)
-    #     asyncio.create_task(update_name(router, group.group_id))
-    #     asyncio.create_task(update_group_devices(router, group.group_id))
+        for part in parts:
+            if not part.strip():  # Skip empty parts
+                continue
+            sub_parts = part.split(":")
+
+            try:
+                if len(sub_parts) < 2:
+                    _LOGGER.warning(f"Invalid scene part format: {part}")
+                    continue
+                scene_address = SceneAddress(*[int(a) for a in sub_parts[0].split(".")])
+                names[scene_address] = sub_parts[1]
+            except (KeyError, ValueError, IndexError) as e:
+                _LOGGER.error(f"Error parsing scene address {part}: {e}")
+
+    scenes = router.scenes
+    for scene in scenes.scenes.values():
+        if scene.name is not None and scene.address not in names:
+            scene.name = None
+            router.snapshots.mark_scene(scene.address)
+
+    for scene_address, name in names.items():
+        scene = scenes.scenes.get(scene_address)
+        if scene is None or scene.name != name:
+            scenes.update_scene_name(scene_address, name)
@@ -0,0 +1,517 @@
+from .cache import address_from_string, encode_device, encode_group, encode_scene
+from .cluster import HelvarCluster
+from .devices import Device
+from .discovery import DEFAULT_DISCOVERY_CONCURRENCY, DiscoveryReport
+from .groups import Group
+from .parser.address import SceneAddress
+from .router import Router
+from .scenes import Scene
+from .snapshot import ChunkedMapping, device_chunk, diff_mappings, group_chunk, scene_chunk
+from .lib import settle
+from .workgroup import WorkgroupReport
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# Seconds between state deltas sent from a worker to the coordinator.
+DELTA_INTERVAL = 0.2
+
+# Control methods of a router's Devices and Groups. On the coordinator's mirrors
+# they're forwarded to the worker that owns the router, whose deltas then bring
+# the resulting state back.
+WORKER_CALLS = {
+    "devices": (
+        "set_device_brightness",
+        "set_device_load_level",
+        "set_device_proportion",
+        "modify_device_proportion",
+        "set_levels",
+    ),
+    "groups": (
+        "set_scene",
+        "set_scenes",
+        "set_group_level",
+        "set_group_proportion",
+        "modify_group_proportion",
+        "resync",
+    ),
+}
+
+
+def device_changes(old, new, device):
+    """
+    The fields of a device that differ between two of its DeviceStates, encoded as
+    in the topology cache.
+    """
+
+    changes = {}
+    if old.name != new.name:
+        changes["name"] = new.name
+    if old.state != new.state:
+        changes["state"] = new.state
+    if old.load_level != new.load_level:
+        changes["load_level"] = new.load_level
+        changes["last_load_level"] = device.last_load_level
+    if old.last_scene != new.last_scene:
+        changes["last_scene"] = str(new.last_scene) if new.last_scene else None
+    if old.levels != new.levels:
+        changes["levels"] = ",".join(new.levels) if new.levels else None
+    return changes
+
+
+async def _mirror_send(command, written=None, priority=None):
+    raise ConnectionError(
+        f"Mirror routers have no connection of their own; can't send {command}."
+    )
+
+
+class SnapshotDeltas:
+    """
+    Turns successive snapshots of a router into compact deltas.
+
+    Changes are found by comparing snapshot chunks, so unchanged parts of the site
+    cost nothing. New devices (or ones whose type changed), groups and scenes are
+    encoded as positional lists, as in the topology cache; other devices only send
+    the fields that changed (see device_changes()). Unnamed placeholder scenes
+    aren't sent.
+    """
+
+    def __init__(self, router):
+        self.router = router
+        self._devices = ChunkedMapping(device_chunk)
+        self._groups = ChunkedMapping(group_chunk)
+        self._scenes = ChunkedMapping(scene_chunk)
+
+    def delta(self):
+        """The changes since the last call, or None if nothing has changed."""
+
+        snapshot = self.router.snapshot()
+
+        changed_devices, removed_devices = diff_mappings(self._devices, snapshot.devices)
+        groups, removed_groups = diff_mappings(self._groups, snapshot.groups)
+        # Scenes are removed along with their group.
+        scenes, _ = diff_mappings(self._scenes, snapshot.scenes)
+
+        # Scenes only matter to the coordinator once they're (or were) named.
+        scenes = [
+            address
+            for address in scenes
+            if snapshot.scenes[address].name is not None
+            or (address in self._scenes and self._scenes[address].name is not None)
+        ]
+
+        live = self.router
+        devices, changes = [], []
+        for address in changed_devices:
+            old, new = self._devices.get(address), snapshot.devices[address]
+            device = live.devices.devices[address]
+            if old is None or (old.protocol, old.type) != (new.protocol, new.type):
+                devices.append(encode_device(device))
+            else:
+                changes.append([str(address), device_changes(old, new, device)])
+
+        self._devices, self._groups, self._scenes = (
+            snapshot.devices,
+            snapshot.groups,
+            snapshot.scenes,
+        )
+
+        if not (
+            devices or changes or removed_devices or groups or removed_groups or scenes
+        ):
+            return None
+
+        return {
+            "devices": devices,
+            "device_changes": changes,
+            "removed_devices": [str(a) for a in removed_devices],
+            "groups": [encode_group(live.groups.groups[g]) for g in groups],
+            "removed_groups": removed_groups,
+            "scenes": [encode_scene(live.scenes.scenes[a]) for a in scenes],
+        }
+
+
+async def apply_delta(router, delta):
+    """
+    Apply a delta from SnapshotDeltas to a (mirror) router, updating entities in
+    place so subscribers are kept, then notify the subscribers of what changed.
+    """
+
+    changed = []
+
+    for address, raw_type, name, state, load_level, last_load_level, levels in delta[
+        "devices"
+    ]:
+        address = address_from_string(address)
+        device = router.devices.devices.get(address)
+        if device is None or device.raw_type != raw_type:
+            device = Device(address, raw_type)
+            router.devices.register_device(device)
+        device.name = name
+        device.state = state
+        device.load_level = load_level
+        device.last_load_level = last_load_level
+        router.snapshots.mark_device(address)
+        if levels is not None:
+            router.devices.update_device_scene_level(address, levels)
+        changed.append(device)
+
+    for address, changes in delta["device_changes"]:
+        address = address_from_string(address)
+        device = router.devices.devices.get(address)
+        if device is None:
+            continue
+        for field, value in changes.items():
+            if field == "levels":
+                if value is not None:
+                    router.devices.update_device_scene_level(address, value)
+            elif field == "last_scene":
+                device.last_scene = SceneAddress.fromString(value) if value else None
+            else:
+                setattr(device, field, value)
+        router.snapshots.mark_device(address)
+        changed.append(device)
+
+    for address in delta["removed_devices"]:
+        router.devices.unregister_device(address_from_string(address))
+
+    for group_id, name, members, last_scene in delta["groups"]:
+        if group_id not in router.groups.groups:
+            router.groups.register_group(Group(group_id))
+            router.scenes.register_group_scenes(group_id)
+        group = router.groups.groups[group_id]
+        router.groups.update_group_name(group_id, name)
+        router.groups.update_group_device_members(
+            group_id, [address_from_string(a) for a in members]
+        )
+        group.last_scene_address = (
+            SceneAddress.fromString(last_scene) if last_scene is not None else None
+        )
+        changed.append(group)
+
+    for group_id in delta["removed_groups"]:
+        router.groups.unregister_group(group_id)
+        router.scenes.unregister_group_scenes(group_id)
+
+    for address, name in delta["scenes"]:
+        address = SceneAddress.fromString(address)
+        if not router.scenes.has_scene(address):
+            router.scenes.register_scene(address, Scene(address))
+        router.scenes.update_scene_name(address, name)
+
+    for entity in changed:
+        await entity.update_subscribers()
+
+
+def merge_reports(reports) -> DiscoveryReport:
+    """Combine the discovery reports of several workers."""
+
+    phases = {}
+    for report in reports:
+        for phase, seconds in report.phases.items():
+            phases[phase] = max(phases.get(phase, 0), seconds)
+
+    return DiscoveryReport(
+        all(r.complete for r in reports),
+        sum(r.completed for r in reports),
+        {name: error for r in reports for name, error in r.failed.items()},
+        [name for r in reports for name in r.pending],
+        max((r.elapsed for r in reports), default=0),
+        phases,
+    )
+
+
+def _worker_main(specs, conn, concurrency, interval):
+    """Entry point of a worker process."""
+    asyncio.run(_worker(specs, conn, concurrency, interval))
+
+
+async def _worker(specs, conn, concurrency, interval):
+    cluster = HelvarCluster(concurrency)
+    for host, port, cluster_id, router_id in specs:
+        cluster.add_router(Router(host, port, cluster_id, router_id, use_specified_ids=True))
+
+    report = await cluster.initialize()
+
+    # The initial state goes out before "ready", so the coordinator's mirrors are
+    # populated by the time its initialize() returns.
+    trackers = {key: SnapshotDeltas(cluster.routers[key]) for key in report.routers}
+
+    def send_deltas():
+        for key, tracker in trackers.items():
+            delta = tracker.delta()
+            if delta is not None:
+                conn.send(("delta", key, delta))
+
+    send_deltas()
+
+    discovery = report.discovery._replace(
+        failed={name: repr(e) for name, e in report.discovery.failed.items()}
+    )
+    conn.send(
+        (
+            "ready",
+            report.routers,
+            {key: repr(e) for key, e in report.unreachable.items()},
+            discovery,
+            cluster.workgroup_name,
+        )
+    )
+
+    async def publish():
+        while True:
+            await asyncio.sleep(interval)
+            send_deltas()
+
+    async def call(call_id, key, target, method, args, kwargs):
+        try:
+            router = cluster.routers[tuple(key)]
+            result = await getattr(getattr(router, target), method)(*args, **kwargs)
+        except Exception as e:
+            conn.send(("result", call_id, None, repr(e)))
+            return
+        try:
+            conn.send(("result", call_id, result, None))
+        except Exception as e:
+            conn.send(("result", call_id, None, f"Couldn't return the result: {e!r}"))
+
+    publisher = asyncio.create_task(publish())
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            try:
+                message = await loop.run_in_executor(executor, conn.recv)
+            except EOFError:
+                break
+            if message[0] == "stop":
+                break
+            _, call_id, key, target, method, args, kwargs = message
+            if method not in WORKER_CALLS.get(target, ()):
+                conn.send(("result", call_id, None, f"Unknown call {target}.{method}."))
+                continue
+            asyncio.create_task(call(call_id, key, target, method, args, kwargs))
+
+    publisher.cancel()
+    await cluster.disconnect()
+    conn.close()
+
+
+class ShardedCluster(HelvarCluster):
+    """
+    Spreads router sessions across worker processes, for estates too large for one
+    event loop.
+
+    Each worker runs a HelvarCluster for its share of the routers and streams
+    compact state deltas (see SnapshotDeltas) back to this coordinator, which keeps
+    a mirror Router per router. The mirrors' Devices, Groups and Scenes are the
+    normal API, subscribers included. Their control methods (WORKER_CALLS) are
+    forwarded to the worker that owns the router and return its result; anything
+    else a mirror tries to send raises ConnectionError.
+
+    routers is a list of (host, port, cluster_id, router_id).
+    """
+
+    def __init__(
+        self,
+        routers,
+        workers=None,
+        concurrency=DEFAULT_DISCOVERY_CONCURRENCY,
+        interval=DELTA_INTERVAL,
+    ):
+        super().__init__(concurrency)
+        self.interval = interval
+
+        specs = list(routers)
+        workers = max(1, min(workers or os.cpu_count() or 1, len(specs)))
+        self.shards = [specs[n::workers] for n in range(workers)]
+
+        self._owner = {}
+        for shard_index, shard in enumerate(self.shards):
+            for host, port, cluster_id, router_id in shard:
+                key = (cluster_id, router_id)
+                self.routers[key] = self._mirror(
+                    key, Router(host, port, cluster_id, router_id, use_specified_ids=True)
+                )
+                self._owner[key] = shard_index
+
+        self._processes = []
+        self._connections = []
+        self._receivers = []
+        self._executor = None
+        self._ready = []
+        # call_id: (shard index, future)
+        self._calls = {}
+        self._call_ids = itertools.count()
+        self._stopping = False
+
+    def _mirror(self, key, router):
+        """Make a Router a mirror: forward its control calls, and send nothing itself."""
+
+        for target, methods in WORKER_CALLS.items():
+            entities = getattr(router, target)
+            for method in methods:
+                forward = functools.partial(self._call, key, target, method)
+                setattr(entities, method, forward)
+        router._send_command_task = _mirror_send
+        return router
+
+    async def initialize(self, timeout=None, progress=None) -> WorkgroupReport:
+        """
+        Start the workers and wait for each to finish discovering its routers.
+        The report's discovery covers every worker. The routers of a worker that
+        dies are reported unreachable; one still discovering after `timeout` is
+        listed as pending.
+        """
+
+        loop = asyncio.get_running_loop()
+        context = multiprocessing.get_context("spawn")
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards))
+
+        for shard_index, shard in enumerate(self.shards):
+            conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_worker_main,
+                args=(shard, child_conn, self.concurrency, self.interval),
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+
+            ready = loop.create_future()
+            self._processes.append(process)
+            self._connections.append(conn)
+            self._ready.append(ready)
+            self._receivers.append(
+                asyncio.create_task(self._receive(shard_index, conn, ready))
+            )
+
+        try:
+            await asyncio.wait_for(asyncio.wait(self._ready), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        routers, unreachable, reports = [], {}, []
+        for shard_index, ready in enumerate(self._ready):
+            if not ready.done():
+                reports.append(
+                    DiscoveryReport(False, 0, {}, [f"shard {shard_index}"], timeout, {})
+                )
+                continue
+            if ready.exception() is not None:
+                for _, _, cluster_id, router_id in self.shards[shard_index]:
+                    unreachable[(cluster_id, router_id)] = ready.exception()
+                continue
+            worker_routers, worker_unreachable, report, workgroup_name = ready.result()
+            routers += worker_routers
+            unreachable.update(worker_unreachable)
+            reports.append(report)
+            if self.workgroup_name is None:
+                self.workgroup_name = workgroup_name
+
+        for router in self.routers.values():
+            router.workgroup_name = self.workgroup_name
+
+        return WorkgroupReport(routers, unreachable, merge_reports(reports))
+
+    async def _receive(self, shard_index, conn, ready):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                message = await loop.run_in_executor(self._executor, conn.recv)
+            except (EOFError, OSError):
+                if not self._stopping:
+                    self._drop_shard(shard_index, ready)
+                return
+            await self._handle_message(message, ready)
+
+    def _drop_shard(self, shard_index, ready):
+        """
+        Give up on a worker that has gone: fail its readiness and every call
+        waiting on it, and remove its routers from the cluster.
+        """
+
+        _LOGGER.error(f"Worker for shard {shard_index} has exited.")
+        error = ConnectionError(f"The worker for shard {shard_index} has exited.")
+
+        settle(ready, error)
+        for call_id, (owner, future) in list(self._calls.items()):
+            if owner == shard_index:
+                del self._calls[call_id]
+                settle(future, error)
+
+        self._connections[shard_index] = None
+        for key in [k for k, owner in self._owner.items() if owner == shard_index]:
+            del self._owner[key]
+            self.routers.pop(key, None)
+
+    async def _handle_message(self, message, ready):
+        kind = message[0]
+        if kind == "ready":
+            if not ready.done():
+                ready.set_result(message[1:])
+        elif kind == "delta":
+            _, key, delta = message
+            await apply_delta(self.routers[tuple(key)], delta)
+        elif kind == "result":
+            _, call_id, result, error = message
+            _, future = self._calls.pop(call_id, (None, None))
+            if future is None or future.done():
+                return
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(error))
+
+    async def _call(self, key, target, method, *args, **kwargs):
+        shard_index = self._owner.get(key)
+        conn = self._connections[shard_index] if shard_index is not None else None
+        if conn is None:
+            raise ConnectionError(f"No worker for router @{key[0]}.{key[1]}.")
+
+        call_id = next(self._call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = (shard_index, future)
+        try:
+            conn.send(("call", call_id, key, target, method, args, kwargs))
+        except OSError as e:
+            del self._calls[call_id]
+            raise ConnectionError(
+                f"Couldn't reach the worker for router @{key[0]}.{key[1]}."
+            ) from e
+        return await future
+
+    async def disconnect(self):
+        self._stopping = True
+        for conn in self._connections:
+            if conn is None:
+                continue
+            try:
+                conn.send(("stop",))
+            except OSError:
+                pass
+
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, 5)
+            if process.is_alive():
+                process.terminate()
+
+        for receiver in self._receivers:
+            receiver.cancel()
+        for conn in self._connections:
+            if conn is not None:
+                conn.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+        self._processes, self._connections, self._receivers, self._ready = [], [], [], []
+        self._stopping = False
@@ -0,0 +1,385 @@
+from collections import namedtuple
+from collections.abc import Mapping
+
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# Beyond this many pending changes in a collection we stop tracking individual keys
+# and rebuild the whole collection on the next publish (e.g. during discovery).
+MAX_PENDING_CHANGES = 4096
+
+DeviceState = namedtuple(
+    "DeviceState",
+    [
+        "address",
+        "name",
+        "protocol",
+        "type",
+        "state",
+        "load_level",
+        "last_scene",
+        "levels",
+    ],
+)
+
+GroupState = namedtuple(
+    "GroupState", ["group_id", "name", "devices", "last_scene_address"]
+)
+
+SceneState = namedtuple("SceneState", ["address", "name"])
+
+RouterSnapshot = namedtuple(
+    "RouterSnapshot", ["version", "workgroup_name", "devices", "groups", "scenes"]
+)
+
+
+class TopologyDiff(
+    namedtuple(
+        "TopologyDiff",
+        [
+            "added_devices",
+            "removed_devices",
+            "changed_devices",
+            "added_groups",
+            "removed_groups",
+            "changed_groups",
+            "memberships",
+            "scene_names",
+        ],
+    )
+):
+    """
+    Structural changes between two topology states: devices and groups added,
+    removed or changed (name, type, members), membership changes as {group_id:
+    (added, removed)}, and renamed scenes as {scene_address: name}. Falsy when empty.
+    """
+
+    __slots__ = ()
+
+    def __bool__(self):
+        return any(len(field) for field in self)
+
+
+def device_state(device):
+    return DeviceState(
+        device.address,
+        device.name,
+        device.protocol,
+        device.type,
+        device.state,
+        device.target_load_level,
+        device.last_scene,
+        device.levels,
+    )
+
+
+def group_state(group):
+    return GroupState(
+        int(group.group_id),
+        group.name,
+        tuple(group.devices),
+        group.last_scene_address,
+    )
+
+
+def scene_state(scene):
+    return SceneState(scene.address, scene.name)
+
+
+def device_chunk(address):
+    # One chunk per subnet: at most 255 devices.
+    return (address.block, address.router, address.subnet)
+
+
+def group_chunk(group_id):
+    return int(group_id) >> 6
+
+
+def scene_chunk(scene_address):
+    return scene_address.group
+
+
+class ChunkedMapping(Mapping):
+    """
+    Immutable mapping whose entries are split into small chunks.
+
+    evolve() returns a new mapping that copies only the chunks containing changed
+    keys and shares every other chunk with this one, so successive versions are
+    cheap to produce and share most of their structure.
+    """
+
+    __slots__ = ("_chunks", "_chunk_key", "_len")
+
+    def __init__(self, chunk_key, chunks=None, length=0):
+        self._chunk_key = chunk_key
+        self._chunks = chunks if chunks is not None else {}
+        self._len = length
+
+    def __getitem__(self, key):
+        try:
+            return self._chunks[self._chunk_key(key)][key]
+        except (KeyError, AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __iter__(self):
+        for chunk in self._chunks.values():
+            yield from chunk
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return f"ChunkedMapping({self._len} entries in {len(self._chunks)} chunks)"
+
+    def chunks(self):
+        """The (chunk key, chunk) pairs. Chunks shared between versions are identical objects."""
+        return self._chunks.items()
+
+    def evolve(self, changes):
+        """
+        Return a new mapping with changes applied. changes maps key -> value, or
+        key -> None to remove the key.
+        """
+
+        if not changes:
+            return self
+
+        chunks = dict(self._chunks)
+        copied = set()
+        length = self._len
+
+        for key, value in changes.items():
+            chunk_key = self._chunk_key(key)
+            if chunk_key not in copied:
+                chunks[chunk_key] = dict(chunks.get(chunk_key, ()))
+                copied.add(chunk_key)
+            chunk = chunks[chunk_key]
+
+            if value is None:
+                if key in chunk:
+                    del chunk[key]
+                    length -= 1
+            else:
+                if key not in chunk:
+                    length += 1
+                chunk[key] = value
+
+        for chunk_key in copied:
+            if not chunks[chunk_key]:
+                del chunks[chunk_key]
+
+        return ChunkedMapping(self._chunk_key, chunks, length)
+
+    @classmethod
+    def build(cls, chunk_key, items):
+        chunks = {}
+        length = 0
+        for key, value in items:
+            chunks.setdefault(chunk_key(key), {})[key] = value
+            length += 1
+        return cls(chunk_key, chunks, length)
+
+
+def diff_mappings(old: ChunkedMapping, new: ChunkedMapping):
+    """
+    Return (changed, removed) key lists between two versions of a ChunkedMapping.
+    Chunks shared by both versions are skipped without looking inside them.
+    """
+
+    changed, removed = [], []
+    old_chunks = dict(old.chunks())
+
+    for chunk_key, chunk in new.chunks():
+        old_chunk = old_chunks.pop(chunk_key, None)
+        if chunk is old_chunk:
+            continue
+        old_chunk = old_chunk or {}
+        changed += [key for key, value in chunk.items() if old_chunk.get(key) != value]
+        removed += [key for key in old_chunk if key not in chunk]
+
+    for old_chunk in old_chunks.values():
+        removed += list(old_chunk)
+
+    return changed, removed
+
+
+TopologyState = namedtuple("TopologyState", ["devices", "groups", "scene_names"])
+
+
+def topology_state(router) -> TopologyState:
+    """
+    The structure of a router's topology: device names and types, group names and
+    members, and scene names. Built on demand for diffing and not kept, so it costs
+    nothing between refreshes.
+    """
+
+    return TopologyState(
+        {
+            address: (device.name, device.protocol, device.type)
+            for address, device in router.devices.devices.items()
+        },
+        {
+            group_id: (group.name, tuple(group.devices))
+            for group_id, group in router.groups.groups.items()
+        },
+        {
+            address: scene.name
+            for address, scene in router.scenes.scenes.items()
+            if scene.name is not None
+        },
+    )
+
+
+def topology_diff(before: TopologyState, after: TopologyState) -> TopologyDiff:
+    """Compare two topology states. State (load levels, last scenes etc.) isn't included."""
+
+    added_devices = [a for a in after.devices if a not in before.devices]
+    removed_devices = [a for a in before.devices if a not in after.devices]
+    changed_devices = [
+        a
+        for a, structure in after.devices.items()
+        if a in before.devices and before.devices[a] != structure
+    ]
+
+    added_groups = [g for g in after.groups if g not in before.groups]
+    removed_groups = [g for g in before.groups if g not in after.groups]
+    changed_groups, memberships = [], {}
+    for group_id, (name, members) in after.groups.items():
+        old_name, old_members = before.groups.get(group_id, (None, ()))
+        if members != old_members:
+            memberships[group_id] = (
+                [a for a in members if a not in old_members],
+                [a for a in old_members if a not in members],
+            )
+        if group_id in before.groups and (
+            name != old_name or group_id in memberships
+        ):
+            changed_groups.append(group_id)
+
+    scene_names = {
+        address: name
+        for address, name in after.scene_names.items()
+        if before.scene_names.get(address) != name
+    }
+    scene_names.update(
+        {address: None for address in before.scene_names if address not in after.scene_names}
+    )
+
+    return TopologyDiff(
+        added_devices,
+        removed_devices,
+        changed_devices,
+        added_groups,
+        removed_groups,
+        changed_groups,
+        memberships,
+        scene_names,
+    )
+
+
+class _Collection:
+    """Tracks one live collection (devices, groups or scenes) and its last published view."""
+
+    def __init__(self, live, to_state, chunk_key):
+        self._live = live
+        self._to_state = to_state
+        self._chunk_key = chunk_key
+        self.published = ChunkedMapping(chunk_key)
+        self._pending = set()
+        self._rebuild = False
+
+    @property
+    def dirty(self):
+        return self._rebuild or bool(self._pending)
+
+    def mark(self, key):
+        if self._rebuild:
+            return
+        self._pending.add(key)
+        if len(self._pending) > MAX_PENDING_CHANGES:
+            self._pending = set()
+            self._rebuild = True
+
+    def publish(self):
+        live = self._live()
+
+        if self._rebuild:
+            self.published = ChunkedMapping.build(
+                self._chunk_key, ((k, self._to_state(v)) for k, v in live.items())
+            )
+        else:
+            changes = {}
+            for key in self._pending:
+                entity = live.get(key)
+                changes[key] = self._to_state(entity) if entity is not None else None
+            self.published = self.published.evolve(changes)
+
+        self._pending = set()
+        self._rebuild = False
+
+
+class Snapshots:
+    """
+    Publishes immutable, structurally shared snapshots of a router's state.
+
+    Writers (Devices, Groups and Scenes) mark what they change. snapshot() returns
+    the current RouterSnapshot in O(1) when nothing has changed; otherwise it first
+    publishes a new version, copying only the chunks that hold changed entries.
+    Snapshots are never mutated, so readers can hold and walk them freely while
+    the live state moves on.
+    """
+
+    def __init__(self, router):
+        self.router = router
+        self.version = 0
+
+        self._devices = _Collection(
+            lambda: router.devices.devices, device_state, device_chunk
+        )
+        self._groups = _Collection(lambda: router.groups.groups, group_state, group_chunk)
+        self._scenes = _Collection(lambda: router.scenes.scenes, scene_state, scene_chunk)
+
+        self._snapshot = RouterSnapshot(
+            0,
+            None,
+            self._devices.published,
+            self._groups.published,
+            self._scenes.published,
+        )
+
+    def mark_device(self, address):
+        self._devices.mark(address)
+
+    def mark_group(self, group_id):
+        self._groups.mark(int(group_id))
+
+    def mark_scene(self, scene_address):
+        self._scenes.mark(scene_address)
+
+    def snapshot(self) -> RouterSnapshot:
+        collections = (self._devices, self._groups, self._scenes)
+        workgroup_name = self.router.workgroup_name
+
+        if (
+            not any(c.dirty for c in collections)
+            and workgroup_name == self._snapshot.workgroup_name
+        ):
+            return self._snapshot
+
+        for collection in collections:
+            if collection.dirty:
+                collection.publish()
+
+        self.version += 1
+        self._snapshot = RouterSnapshot(
+            self.version,
+            workgroup_name,
+            self._devices.published,
+            self._groups.published,
+            self._scenes.published,
+        )
+        _LOGGER.debug(f"Published state snapshot version {self.version}.")
+
+        return self._snapshot
@@ -1,4 +1,18 @@
-DEFAULT_FADE_TIME = 50  # ms
+DEFAULT_FADE_TIME = 50  # centiseconds, as HelvarNet fade times are
+
+
+def fade_seconds(fade_time) -> float:
+    """A HelvarNet fade time in seconds. Fade times are given in centiseconds."""
+    try:
+        return max(0.0, float(fade_time) / 100)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+# Each group has 8 blocks of 16 scenes. Device scene tables (QUERY_SCENE_INFO) only
+# cover these blocks.
+SCENE_BLOCKS = range(1, 9)
+SCENES_PER_BLOCK = range(1, 17)
 
 
 PROTOCOL = {
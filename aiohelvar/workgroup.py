@@ -0,0 +1,244 @@
+from .discovery import DEFAULT_DISCOVERY_CONCURRENCY, Discovery, DiscoveryReport
+from .parser.address import ClusterAddress
+from .parser.command import Command
+from .parser.command_type import CommandType
+from .router import Router
+from .snapshot import GroupState, topology_state
+
+from collections import namedtuple
+import asyncio
+import ipaddress
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+
+WorkgroupReport = namedtuple("WorkgroupReport", ["routers", "unreachable", "discovery"])
+
+WorkgroupTopology = namedtuple(
+    "WorkgroupTopology", ["workgroup_name", "routers", "devices", "groups", "scenes"]
+)
+
+
+def parse_id_list(result):
+    """Parse a comma separated list of ids, as returned by QUERY_CLUSTERS and QUERY_ROUTERS."""
+
+    ids = []
+    for part in (result or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            ids.append(int(part))
+        except ValueError:
+            _LOGGER.warning(f"Invalid id in list: {part}")
+    return ids
+
+
+def router_host(seed_host, cluster_id: int, router_id: int):
+    """
+    The IP address of a router in the same workgroup as seed_host. HelvarNet routers
+    are addressed as x.x.cluster.router, the convention Router relies on too.
+    """
+
+    ip = ipaddress.ip_address(seed_host)
+    if not isinstance(ip, ipaddress.IPv4Address):
+        raise ValueError(f"Can't derive router addresses from {seed_host}.")
+    octets = str(ip).split(".")
+    return ".".join(octets[:2] + [str(cluster_id), str(router_id)])
+
+
+def workgroup_router(seed: Router, cluster_id: int, router_id: int) -> Router:
+    """A Router for another member of the seed's workgroup."""
+    return Router(
+        router_host(seed.host, cluster_id, router_id),
+        seed.port,
+        cluster_id,
+        router_id,
+        use_specified_ids=True,
+    )
+
+
+async def query_clusters(router):
+    response = await router._send_command_task(Command(CommandType.QUERY_CLUSTERS))
+    return parse_id_list(response.result if response else None)
+
+
+async def query_routers(router, cluster_id: int):
+    response = await router._send_command_task(
+        Command(CommandType.QUERY_ROUTERS, command_address=ClusterAddress(cluster_id))
+    )
+    return parse_id_list(response.result if response else None)
+
+
+def merge_groups(snapshots):
+    """Merge the groups of several router snapshots. Members are the union, in order."""
+
+    groups = {}
+    for snapshot in snapshots:
+        for group_id, group in snapshot.groups.items():
+            merged = groups.get(group_id)
+            if merged is None:
+                groups[group_id] = group
+                continue
+            members = merged.devices + tuple(
+                a for a in group.devices if a not in merged.devices
+            )
+            groups[group_id] = GroupState(
+                group_id,
+                merged.name if merged.name is not None else group.name,
+                members,
+                merged.last_scene_address or group.last_scene_address,
+            )
+    return groups
+
+
+def merge_topology(workgroup_name, routers) -> WorkgroupTopology:
+    """Merge the snapshots of several routers, keyed (cluster_id, router_id), into one view."""
+
+    snapshots = [router.snapshot() for router in routers.values()]
+
+    devices, scenes = {}, {}
+    for snapshot in snapshots:
+        devices.update(snapshot.devices)
+        for address, scene in snapshot.scenes.items():
+            if address not in scenes or scenes[address].name is None:
+                scenes[address] = scene
+
+    return WorkgroupTopology(
+        workgroup_name, list(routers), devices, merge_groups(snapshots), scenes
+    )
+
+
+async def connect_routers(routers):
+    """
+    Connect to every router, keyed (cluster_id, router_id), that isn't already
+    connected. Returns {key: exception} for those that couldn't be reached.
+    """
+
+    unreachable = {}
+
+    async def connect(key, router):
+        if router.connected:
+            return
+        try:
+            await router.connect()
+        except Exception as e:
+            _LOGGER.error(f"Couldn't connect to router @{key[0]}.{key[1]}: {e!r}")
+            unreachable[key] = e
+
+    await asyncio.gather(*[connect(key, router) for key, router in routers.items()])
+    return unreachable
+
+
+async def discover_routers(routers, discovery: Discovery, timeout=None) -> DiscoveryReport:
+    """Discover several connected routers through one shared Discovery."""
+
+    before = {}
+    for (cluster_id, router_id), router in routers.items():
+        before[router] = topology_state(router)
+        router.discovery = discovery.scoped(f"@{cluster_id}.{router_id}")
+        router._plan_discovery()
+
+    report = await discovery.wait(timeout)
+
+    for router in routers.values():
+        await router.publish_topology_diff(before[router])
+
+    return report
+
+
+class Workgroup:
+    """
+    Discovers every router in a HelvarNet workgroup, starting from one seed router.
+
+    enumerate() asks the seed for the workgroup's clusters (QUERY_CLUSTERS) and each
+    cluster's routers (QUERY_ROUTERS). discover() then connects to every router and
+    discovers them all concurrently through one shared Discovery, so `concurrency`
+    bounds the queries in flight across the whole workgroup, and every router's
+    topology phase is done before any router moves on to names.
+
+    Routers other than the seed are created with router_factory(cluster_id,
+    router_id), by default a Router at the seed's network address with the cluster
+    and router ids swapped in.
+    """
+
+    def __init__(
+        self,
+        seed: Router,
+        concurrency=DEFAULT_DISCOVERY_CONCURRENCY,
+        router_factory=None,
+    ):
+        self.seed = seed
+        self.concurrency = concurrency
+        self.router_factory = router_factory or self._default_router
+        self.routers = {(seed.cluster_id, seed.router_id): seed}
+        self.discovery = None
+
+    def _default_router(self, cluster_id, router_id):
+        return workgroup_router(self.seed, cluster_id, router_id)
+
+    async def enumerate(self):
+        """Return the (cluster_id, router_id) of every router in the workgroup."""
+
+        if not self.seed.connected:
+            await self.seed.connect()
+
+        clusters = await query_clusters(self.seed)
+        if not clusters:
+            _LOGGER.warning("No clusters reported, assuming the seed's cluster only.")
+            clusters = [self.seed.cluster_id]
+
+        router_ids = await asyncio.gather(
+            *[query_routers(self.seed, cluster_id) for cluster_id in clusters]
+        )
+
+        members = [
+            (cluster_id, router_id)
+            for cluster_id, routers in zip(clusters, router_ids)
+            for router_id in routers
+        ]
+        if (self.seed.cluster_id, self.seed.router_id) not in members:
+            members.insert(0, (self.seed.cluster_id, self.seed.router_id))
+
+        _LOGGER.info(
+            f"Workgroup has {len(members)} routers in {len(clusters)} clusters."
+        )
+        return members
+
+    async def discover(self, timeout=None, progress=None) -> WorkgroupReport:
+        """
+        Connect to and discover every router in the workgroup.
+
+        Returns once every router has been discovered or `timeout` has passed.
+        Routers that can't be reached are listed in the report and left out of the
+        topology. `progress` is called as in Router.initialize().
+        """
+
+        members = await self.enumerate()
+
+        for key in members:
+            if key not in self.routers:
+                self.routers[key] = self.router_factory(*key)
+
+        unreachable = await connect_routers(self.routers)
+        for key in unreachable:
+            del self.routers[key]
+
+        self.discovery = Discovery(self.concurrency, progress)
+        report = await discover_routers(self.routers, self.discovery, timeout)
+
+        return WorkgroupReport(list(self.routers), unreachable, report)
+
+    def topology(self) -> WorkgroupTopology:
+        """
+        One immutable view of the whole workgroup, merged from each router's
+        snapshot. Groups that several routers know about are merged.
+        """
+
+        return merge_topology(self.seed.workgroup_name, self.routers)
+
+    async def disconnect(self):
+        await asyncio.gather(
+            *[router.disconnect() for router in self.routers.values() if router.connected]
+        )
@@ -0,0 +1,190 @@
+"""
+Memory footprint benchmark for large synthetic sites.
+
+Runs Router.initialize() against synthetic topologies and records, per topology:
+
+    peak_bytes    - tracemalloc peak during discovery
+    steady_bytes  - memory still held once discovery has finished
+    ready_seconds - wall time until all discovery work has completed
+    control_seconds - discovery time until every router's CONTROL phase was ready
+
+Results are compared to benchmarks/baselines.json and the run fails (exit code 1)
+when any figure regresses past the allowed tolerance.
+
+--update-baselines only records topologies that have no baseline yet; existing
+baselines are never regenerated by a run that's meant to be checked against them.
+Re-recording them all (--replace-baselines) belongs in a commit of its own, so
+the change that follows is measured against numbers it didn't produce.
+
+    python -m benchmarks.memory_benchmark                  # all topologies
+    python -m benchmarks.memory_benchmark -t 1k-50         # a single topology
+    python -m benchmarks.memory_benchmark --update-baselines
+    python -m benchmarks.memory_benchmark --replace-baselines
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+from .synthetic_site import build_routers
+
+# name: (devices, groups)
+TOPOLOGIES = {
+    "1k-50": (1000, 50),
+    "1k-500": (1000, 500),
+    "10k-50": (10000, 50),
+    "10k-500": (10000, 500),
+}
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+# Allowed regression before the benchmark fails. Timings are noisy, memory isn't.
+MEMORY_TOLERANCE = 0.10
+TIME_TOLERANCE = 0.50
+
+
+async def _wait_until_idle():
+    """Wait for every other task on the loop, including ones they spawn, to finish."""
+    current = asyncio.current_task()
+    while True:
+        tasks = [t for t in asyncio.all_tasks() if t is not current and not t.done()]
+        if not tasks:
+            return
+        await asyncio.wait(tasks)
+
+
+async def _initialize(routers):
+    reports = await asyncio.gather(*[router.initialize() for router in routers])
+    await _wait_until_idle()
+    return reports
+
+
+def run_topology(device_count: int, group_count: int):
+    gc.collect()
+    tracemalloc.start()
+
+    start = time.perf_counter()
+    routers = build_routers(device_count, group_count)
+    reports = asyncio.run(_initialize(routers))
+    ready_seconds = time.perf_counter() - start
+
+    gc.collect()
+    steady_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "devices": sum(len(r.devices.devices) for r in routers),
+        "groups": sum(len(r.groups.groups) for r in routers),
+        "scenes": sum(len(r.scenes.scenes) for r in routers),
+        "commands": sum(r.commands_sent for r in routers),
+        "peak_bytes": peak_bytes,
+        "steady_bytes": steady_bytes,
+        "ready_seconds": round(ready_seconds, 3),
+        "control_seconds": round(
+            max(report.phases.get("CONTROL", ready_seconds) for report in reports), 3
+        ),
+    }
+
+    del routers
+    gc.collect()
+    return result
+
+
+def check_regressions(name, result, baseline):
+    """Return a list of human readable regressions against a stored baseline."""
+
+    regressions = []
+    limits = (
+        ("peak_bytes", MEMORY_TOLERANCE),
+        ("steady_bytes", MEMORY_TOLERANCE),
+        ("ready_seconds", TIME_TOLERANCE),
+        ("control_seconds", TIME_TOLERANCE),
+    )
+    for key, tolerance in limits:
+        if key not in baseline:
+            continue
+        allowed = baseline[key] * (1 + tolerance)
+        if result[key] > allowed:
+            regressions.append(
+                f"{name}: {key} {result[key]} exceeds baseline {baseline[key]} "
+                f"(+{tolerance:.0%} allowed)"
+            )
+    return regressions
+
+
+def load_baselines():
+    try:
+        with open(BASELINES_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "-t",
+        "--topology",
+        action="append",
+        choices=sorted(TOPOLOGIES),
+        help="Topology to run. May be repeated. Defaults to all.",
+    )
+    record = parser.add_mutually_exclusive_group()
+    record.add_argument(
+        "--update-baselines",
+        action="store_true",
+        help="Store this run's results for topologies without a baseline.",
+    )
+    record.add_argument(
+        "--replace-baselines",
+        action="store_true",
+        help="Overwrite the stored baselines with this run's results.",
+    )
+    args = parser.parse_args(argv)
+
+    # Discovery logs every query; keep the output (and its cost) out of the figures.
+    logging.getLogger("aiohelvar").setLevel(logging.ERROR)
+
+    baselines = load_baselines()
+    regressions = []
+    recorded = []
+
+    for name in args.topology or TOPOLOGIES:
+        result = run_topology(*TOPOLOGIES[name])
+        print(
+            f"{name:>8}: {result['devices']} devices, {result['groups']} groups, "
+            f"{result['scenes']} scenes, {result['commands']} commands | "
+            f"peak {result['peak_bytes'] / 2**20:.1f} MiB, "
+            f"steady {result['steady_bytes'] / 2**20:.1f} MiB, "
+            f"control {result['control_seconds']:.2f}s, "
+            f"ready {result['ready_seconds']:.2f}s"
+        )
+
+        if args.replace_baselines or (args.update_baselines and name not in baselines):
+            baselines[name] = result
+            recorded.append(name)
+        elif name in baselines:
+            regressions += check_regressions(name, result, baselines[name])
+        else:
+            print(f"{name:>8}: no baseline stored.")
+
+    if recorded:
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"Baselines for {', '.join(recorded)} written to {BASELINES_PATH}.")
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
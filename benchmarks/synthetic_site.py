@@ -0,0 +1,157 @@
+"""
+Synthetic Helvar sites for benchmarking.
+
+SyntheticRouter is a Router that answers HelvarNet queries from a generated
+topology instead of a TCP connection. Replies are rendered to HelvarNet strings
+and parsed back, so parsing and state handling costs are included.
+"""
+
+from aiohelvar.parser.command import Command
+from aiohelvar.parser.command_parameter import CommandParameterType
+from aiohelvar.parser.command_type import (
+    COMMAND_TYPES_DONT_LISTEN_FOR_RESPONSE,
+    CommandType,
+    MessageType,
+)
+from aiohelvar.parser.parser import CommandParser
+from aiohelvar.router import Router
+from aiohelvar.static import h_2_d
+
+DEVICES_PER_SUBNET = 250
+SUBNETS = 4
+DEVICES_PER_ROUTER = DEVICES_PER_SUBNET * SUBNETS
+
+# DALI LED module: protocol 1, DALI type 6.
+DALI_LED_RAW_TYPE = 0x01 | (6 << 8)
+# DIGIDIM 124 "5 Button + IR" control panel.
+DIGIDIM_PANEL_RAW_TYPE = 0x02 | (h_2_d(0x00, 0x12, 0x44) << 8)
+
+# One control panel for every PANEL_RATIO devices.
+PANEL_RATIO = 10
+
+SCENE_LEVELS = ",".join(["*"] + ["100", "50", "0", "*"] * 33 + ["0", "0", "0"])
+
+
+class SyntheticSite:
+    """The slice of a synthetic workgroup that one router owns."""
+
+    def __init__(self, cluster_id, router_id, device_count, group_ids):
+        self.cluster_id = cluster_id
+        self.router_id = router_id
+        self.group_ids = list(group_ids)
+
+        self.subnets = {subnet: [] for subnet in range(1, SUBNETS + 1)}
+        for n in range(device_count):
+            subnet = n // DEVICES_PER_SUBNET + 1
+            device = n % DEVICES_PER_SUBNET + 1
+            raw_type = (
+                DIGIDIM_PANEL_RAW_TYPE if n % PANEL_RATIO == 0 else DALI_LED_RAW_TYPE
+            )
+            self.subnets[subnet].append((device, raw_type))
+
+        # Spread devices round robin across this router's groups.
+        self.members = {group_id: [] for group_id in self.group_ids}
+        if self.group_ids:
+            n = 0
+            for subnet, devices in self.subnets.items():
+                for device, _ in devices:
+                    group_id = self.group_ids[n % len(self.group_ids)]
+                    self.members[group_id].append(
+                        f"@{cluster_id}.{router_id}.{subnet}.{device}"
+                    )
+                    n += 1
+
+    def reply(self, command: Command):
+        """Return the result string for a query, or None for an empty reply."""
+
+        command_type = command.command_type
+        address = command.command_address
+        group = command.get_param_value(CommandParameterType.GROUP)
+
+        if command_type == CommandType.QUERY_WORKGROUP_NAME:
+            return "Synthetic"
+        if command_type == CommandType.QUERY_GROUPS:
+            return ",".join(str(g) for g in self.group_ids) or None
+        if command_type == CommandType.QUERY_GROUP_DESCRIPTION:
+            return f"Group {group}"
+        if command_type == CommandType.QUERY_GROUP:
+            return ",".join(self.members.get(int(group), [])) or None
+        if command_type == CommandType.QUERY_LAST_SCENE_IN_GROUP:
+            return "0"
+        if command_type == CommandType.QUERY_SCENE_NAMES:
+            return "".join(
+                f"@{g}.1.1:Bright@{g}.1.2:Dim@{g}.1.3:Off" for g in self.group_ids
+            ) or None
+        if command_type == CommandType.QUERY_DEVICE_TYPES_AND_ADDRESSES:
+            return (
+                ",".join(f"{t}@{d}" for d, t in self.subnets[address.subnet]) or None
+            )
+        if command_type == CommandType.QUERY_DEVICE_DESCRIPTION:
+            return f"Device {address.subnet}.{address.device}"
+        if command_type == CommandType.QUERY_DEVICE_STATE:
+            return "0"
+        if command_type == CommandType.QUERY_DEVICE_LOAD_LEVEL:
+            return "50"
+        if command_type == CommandType.QUERY_SCENE_INFO:
+            return SCENE_LEVELS
+        if command_type == CommandType.QUERY_ROUTER_TIME:
+            return "0"
+        return None
+
+
+class SyntheticRouter(Router):
+    """A Router wired to a SyntheticSite rather than a TCP connection."""
+
+    def __init__(self, site: SyntheticSite):
+        super().__init__(
+            "synthetic",
+            50000,
+            cluster_id=site.cluster_id,
+            router_id=site.router_id,
+            use_specified_ids=True,
+        )
+        self.site = site
+        self.parser = CommandParser()
+        self.commands_sent = 0
+
+    async def connect(self):
+        self.connected = True
+        self.workgroup_name = self.site.reply(Command(CommandType.QUERY_WORKGROUP_NAME))
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def _send_command_task(self, command: Command, *args, **kwargs):
+        self.commands_sent += 1
+
+        # Render the request so its formatting cost is counted.
+        str(command)
+
+        if command.command_type in COMMAND_TYPES_DONT_LISTEN_FOR_RESPONSE:
+            return None
+
+        reply = Command(
+            command.command_type,
+            command.command_parameters,
+            MessageType.REPLY,
+            command.command_address,
+            self.site.reply(command),
+        )
+        return self.parser.parse_command(bytes(str(reply), "utf-8"))
+
+
+def build_routers(device_count: int, group_count: int):
+    """
+    Split a synthetic workgroup across as many routers as the device count needs.
+    Groups are shared out evenly between routers.
+    """
+
+    router_count = max(1, -(-device_count // DEVICES_PER_ROUTER))
+    routers = []
+
+    for n in range(router_count):
+        devices = min(DEVICES_PER_ROUTER, device_count - n * DEVICES_PER_ROUTER)
+        group_ids = range(n + 1, group_count + 1, router_count)
+        routers.append(SyntheticRouter(SyntheticSite(0, n + 1, devices, group_ids)))
+
+    return routers
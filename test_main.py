@@ -27,13 +27,124 @@ from aiohelvar.scenes import Scene, Scenes
 from aiohelvar.static import h_2_d, DigidimType, DeviceStateFlag
 from aiohelvar.parser.address import HelvarAddress, SceneAddress
 from aiohelvar.parser.command import Command, CommandType
+from aiohelvar.parser.command_type import MessageType
 from aiohelvar.parser.command_parameter import CommandParameter, CommandParameterType
 from aiohelvar.router import Router
+from aiohelvar.cache import TopologyCache
+from aiohelvar.lib import TrafficBudget, fingerprint
+from aiohelvar.discovery import Discovery, DiscoveryPhase
 
 # Configure logging for tests
 logging.basicConfig(level=logging.DEBUG)
 
 
+def reply_for(replies, command):
+    """
+    Look up a scripted reply. The most specific key present wins: the subnet for
+    device lists, ("name", group) or ("members", group) for group queries, then the
+    command type. A callable reply is called with the command; a Command is
+    returned as the reply itself.
+    """
+    
+    address = command.command_address
+    group = command.get_param_value(CommandParameterType.GROUP)
+    keys = []
+    if command.command_type == CommandType.QUERY_DEVICE_TYPES_AND_ADDRESSES:
+        keys.append(address.subnet)
+    elif command.command_type == CommandType.QUERY_GROUP_DESCRIPTION:
+        keys.append(("name", int(group)))
+    elif command.command_type == CommandType.QUERY_GROUP:
+        keys.append(("members", int(group)))
+    keys.append(command.command_type)
+    
+    reply = next((replies[key] for key in keys if key in replies), None)
+    if callable(reply):
+        reply = reply(command)
+    if isinstance(reply, Command):
+        return reply
+    return Command(
+        command.command_type,
+        [],
+        MessageType.REPLY,
+        command_address=address,
+        command_result=reply,
+    )
+
+
+def make_site(devices=(), groups=None, replies=None, names=None, **router_kwargs):
+    """
+    A Router for tests. `devices` (Devices or HelvarAddresses) are registered, and
+    `groups` as {group_id: member addresses}, with their scenes. `names` maps group
+    ids and scene addresses to names. With `replies`, commands are answered from
+    them (see reply_for()) instead of being sent.
+    """
+    
+    router = Router(router_kwargs.pop("host", "10.254.0.1"), 50000, **router_kwargs)
+    for device in devices:
+        if isinstance(device, HelvarAddress):
+            device = Device(device)
+        router.devices.register_device(device)
+    for group_id, members in (groups or {}).items():
+        router.groups.register_group(Group(group_id))
+        router.groups.update_group_device_members(group_id, list(members))
+        router.scenes.register_group_scenes(group_id)
+    for key, name in (names or {}).items():
+        if isinstance(key, SceneAddress):
+            router.scenes.update_scene_name(key, name)
+        else:
+            router.groups.update_group_name(key, name)
+    
+    if replies is not None:
+        async def send(command, written=None, priority=None):
+            await asyncio.sleep(0)
+            return reply_for(replies, command)
+        
+        router._send_command_task = AsyncMock(side_effect=send)
+    return router
+
+
+def workgroup_member(cluster_id, router_id, group_ids):
+    """A router in a two-cluster workgroup answering discovery queries."""
+    router = make_site(
+        replies={
+            CommandType.QUERY_CLUSTERS: "0,1",
+            CommandType.QUERY_ROUTERS: lambda c: "1" if c.command_address.cluster == 0 else "2",
+            CommandType.QUERY_GROUPS: ",".join(str(g) for g in group_ids),
+            CommandType.QUERY_GROUP_DESCRIPTION: "Lobby",
+            CommandType.QUERY_GROUP: f"@{cluster_id}.{router_id}.1.1",
+            CommandType.QUERY_DEVICE_LOAD_LEVEL: "10",
+            CommandType.QUERY_DEVICE_STATE: "0",
+            CommandType.QUERY_DEVICE_DESCRIPTION: "Light",
+            1: "1537@1",
+        },
+        cluster_id=cluster_id,
+        router_id=router_id,
+        use_specified_ids=True,
+    )
+
+    async def connect():
+        router.connected = True
+        router.workgroup_name = "Office"
+
+    router.connect = AsyncMock(side_effect=connect)
+    return router
+
+
+def sample_site():
+    """A router with one named, levelled device in a named group with a named scene."""
+    
+    address = HelvarAddress(0, 1, 1, 1)
+    router = make_site(
+        [Device(address, 0x01 | (6 << 8), "Desk")],
+        {3: [address]},
+        names={3: "Kitchen", SceneAddress(3, 1, 2): "Cooking"},
+    )
+    router.workgroup_name = "Office"
+    router.devices.devices[address].load_level = 42.0
+    router.devices.update_device_scene_level(address, ",".join(["50"] * 136))
+    return router
+
+
 # Test Exceptions
 class TestExceptions:
     """Test exception classes and error handling"""
@@ -80,7 +191,7 @@ class TestSubscribable:
     def test_subscribable_init(self):
         """Test Subscribable initialization"""
         sub = Subscribable()
-        assert sub.subscriptions == []
+        assert len(sub.subscriptions) == 0
     
     def test_add_subscriber(self):
         """Test adding subscribers"""
@@ -120,6 +231,19 @@ class TestSubscribable:
         sub.remove_subscriber(callback1)  # Should not raise error
         assert len(sub.subscriptions) == 1
     
+    def test_empty_subscriptions_are_shared(self):
+        """Test entities without subscribers share one empty sentinel"""
+        a = Subscribable()
+        b = Subscribable()
+        assert a.subscriptions is b.subscriptions
+        
+        callback = Mock()
+        a.add_subscriber(callback)
+        assert b.subscriptions == ()
+        
+        a.remove_subscriber(callback)
+        assert a.subscriptions is b.subscriptions
+    
     @pytest.mark.asyncio
     async def test_update_subscribers(self):
         """Test updating subscribers"""
@@ -153,6 +277,15 @@ class TestDevice:
         assert device.state == 0
         assert isinstance(device, Subscribable)
     
+    def test_device_is_slotted(self):
+        """Test devices don't carry a per-instance __dict__"""
+        device = Device(HelvarAddress(1, 2, 3, 4))
+        
+        assert not hasattr(device, "__dict__")
+        assert not hasattr(device.address, "__dict__")
+        with pytest.raises(AttributeError):
+            device.unknown_attribute = 1
+    
     def test_device_creation_with_type(self):
         """Test device creation with raw_type parameter"""
         address = HelvarAddress(1, 2, 3, 4)
@@ -238,6 +371,20 @@ class TestDevice:
             # Device doesn't have set_level method, that's ok
             pass
     
+    def test_load_level_interpolated_during_fade(self):
+        """Test the load level is interpolated while a fade is in progress"""
+        device = Device(HelvarAddress(1, 2, 3, 4))
+        device.load_level = 20.0
+        
+        with patch("aiohelvar.devices.time.monotonic", return_value=100.0):
+            device.fade_to(80.0, 200)
+        
+        for now, level in ((100.0, 20.0), (101.0, 50.0), (102.5, 80.0)):
+            with patch("aiohelvar.devices.time.monotonic", return_value=now):
+                assert device.load_level == pytest.approx(level)
+        assert device.fade is None
+        assert device.target_load_level == 80.0
+    
     def test_device_scene_level_handling(self):
         """Test device scene level functionality"""
         address = HelvarAddress(1, 2, 3, 4)
@@ -285,6 +432,21 @@ class TestDevices:
         assert address in devices.devices
         assert devices.devices[address] == device
     
+    def test_scene_levels_are_interned(self):
+        """Test scene level strings are shared between devices"""
+        mock_router = Mock()
+        devices = Devices(mock_router)
+        
+        for device_id in (1, 2):
+            address = HelvarAddress(1, 2, 3, device_id)
+            device = Device(address)
+            device.protocol = "DALI"
+            devices.register_device(device)
+            devices.update_device_scene_level(address, ",".join(["100"] * 136))
+        
+        a, b = [d.levels for d in devices.devices.values()]
+        assert a[0] is b[0]
+    
     @pytest.mark.asyncio
     async def test_update_device_load_level(self):
         """Test updating device load level"""
@@ -320,8 +482,345 @@ class TestDevices:
         # Verify command was sent
         mock_router._send_command_task.assert_called()
         
-        # Verify device was updated
-        assert device.load_level == 50.0
+        # Verify device was updated. It fades to the new level over fade_time.
+        assert device.target_load_level == 50.0
+        assert device.load_level < 50.0
+    
+    @pytest.mark.asyncio
+    async def test_rapid_level_changes_coalesced(self):
+        """Test only the latest of rapid level changes to a device is sent"""
+        mock_router = Mock()
+        mock_router._send_command_task = AsyncMock()
+        devices = Devices(mock_router)
+        devices.coalescer.window = 0
+        
+        address = HelvarAddress(1, 2, 3, 4)
+        device = Device(address)
+        device.protocol = "DALI"
+        devices.register_device(device)
+        
+        for level in (10, 20, 30):
+            await devices.set_device_load_level(address, level, 50)
+        await devices.set_device_load_level(address, 40, 70)
+        await asyncio.sleep(0.01)
+        
+        mock_router._send_command_task.assert_called_once()
+        command = mock_router._send_command_task.call_args.args[0]
+        assert str(command) == ">V:2,C:14,L:40,F:70,@1.2.3.4#"
+        assert device.target_load_level == 40.0
+        assert devices.coalescer.coalesced == 3
+    
+    @pytest.mark.asyncio
+    async def test_coalescer_flush(self):
+        """Test pending writes can be flushed before the window closes"""
+        router = Router("10.254.0.1", 50000)
+        router._send_command_task = AsyncMock()
+        devices = router.devices
+        devices.coalescer.window = 10
+        
+        addresses = [HelvarAddress(1, 2, 3, d) for d in (1, 2)]
+        for address in addresses:
+            await devices.set_device_load_level(address, 50, 0)
+        assert list(devices.coalescer.pending) == addresses
+        
+        await devices.coalescer.flush()
+        
+        assert router._send_command_task.call_count == 2
+        assert devices.coalescer.pending == {}
+    
+    @pytest.mark.asyncio
+    async def test_group_writes_aggregated(self):
+        """Test same level writes covering a group are sent as one group command"""
+        router = Router("10.254.0.1", 50000)
+        router._send_command_task = AsyncMock()
+        devices = router.devices
+        devices.coalescer.window = 0
+        
+        addresses = [HelvarAddress(0, 1, 1, d) for d in (1, 2, 3, 4)]
+        for address in addresses:
+            device = Device(address)
+            device.protocol = "DALI"
+            devices.register_device(device)
+        router.groups.register_group(Group(1))
+        router.groups.update_group_device_members(1, addresses[:3])
+        router.groups.register_group(Group(2))
+        router.groups.update_group_device_members(2, addresses[2:])
+        
+        for address in addresses[:3]:
+            await devices.set_device_load_level(address, 30, 10)
+        await devices.set_device_load_level(addresses[3], 70, 10)
+        await asyncio.sleep(0.01)
+        
+        sent = [str(c.args[0]) for c in router._send_command_task.call_args_list]
+        # Group 2 is only partly covered at each level, so it's sent per device.
+        assert sent == [">V:2,C:13,G:1,L:30,F:10#", ">V:2,C:14,L:70,F:10,@0.1.1.4#"]
+        assert [devices.devices[a].target_load_level for a in addresses] == [30.0] * 3 + [70.0]
+        assert devices.coalescer.aggregated == 3
+    
+    @pytest.mark.asyncio
+    async def test_set_levels_reports_when_written(self):
+        """Test a bulk level change returns once every write is on the wire"""
+        router = Router("10.254.0.1", 50000)
+        writer = Mock()
+        writer.drain = AsyncMock()
+        task = asyncio.create_task(router._stream_writer(None, writer))
+        
+        addresses = [HelvarAddress(0, 1, 1, d) for d in (1, 2)]
+        for address in addresses:
+            device = Device(address)
+            device.protocol = "DALI"
+            router.devices.register_device(device)
+        
+        report = await router.devices.set_levels({addresses[0]: 10, addresses[1]: 20}, 5)
+        task.cancel()
+        
+        assert report.sent == addresses
+        assert report.failed == {}
+        assert [c.args[0] for c in writer.write.call_args_list] == [
+            b">V:2,C:14,L:10,F:5,@0.1.1.1#",
+            b">V:2,C:14,L:20,F:5,@0.1.1.2#",
+        ]
+        assert router.devices.devices[addresses[1]].target_load_level == 20.0
+    
+    @pytest.mark.asyncio
+    async def test_device_proportion_predicted(self):
+        """Test relative dimming is one proportion command and no reads"""
+        router = Router("10.254.0.1", 50000)
+        router._send_command_task = AsyncMock(return_value=None)
+        address = HelvarAddress(0, 1, 1, 1)
+        device = Device(address)
+        device.protocol = "DALI"
+        device.load_level = 40.0
+        router.devices.register_device(device)
+        
+        await router.devices.modify_device_proportion(address, 50, 10)
+        await asyncio.sleep(0)
+        assert device.target_load_level == 70.0
+        await router.devices.modify_device_proportion(address, 50, 10)
+        assert device.target_load_level == 100.0
+        await router.devices.set_device_proportion(address, -50, 10)
+        assert device.target_load_level == 20.0
+        
+        sent = [str(c.args[0]) for c in router._send_command_task.call_args_list]
+        assert sent == [
+            ">V:2,C:18,P:50,F:10,@0.1.1.1#",
+            ">V:2,C:18,P:50,F:10,@0.1.1.1#",
+            ">V:2,C:16,P:-50,F:10,@0.1.1.1#",
+        ]
+    
+    @pytest.mark.asyncio
+    async def test_proportion_follows_pending_level(self):
+        """Test a pending level write is sent before a proportion for the device"""
+        router = Router("10.254.0.1", 50000)
+        router._send_command_task = AsyncMock(return_value=None)
+        address = HelvarAddress(0, 1, 1, 1)
+        device = Device(address)
+        device.protocol = "DALI"
+        router.devices.register_device(device)
+        
+        await router.devices.set_device_load_level(address, 80, 0)
+        await router.devices.set_device_proportion(address, -50, 0)
+        await asyncio.sleep(0)
+        
+        sent = [c.args[0].command_type for c in router._send_command_task.call_args_list]
+        assert sent == [CommandType.DIRECT_LEVEL_DEVICE, CommandType.DIRECT_PROPORTION_DEVICE]
+        assert device.load_level == 40.0
+    
+    @pytest.mark.asyncio
+    async def test_levels_verified_after_fade(self):
+        """Test written levels are read back in one batch once their fades end"""
+        router = Router("10.254.0.1", 50000)
+        router.devices.coalescer.window = 0
+        router.devices.verifier.delay = 0.02
+        
+        actual = {}
+        
+        async def send(command):
+            if command.command_type == CommandType.QUERY_DEVICE_LOAD_LEVEL:
+                return Command(command.command_type, command_result=actual[command.command_address])
+            return None
+        
+        router._send_command_task = AsyncMock(side_effect=send)
+        
+        addresses = [HelvarAddress(0, 1, 1, d) for d in (1, 2)]
+        for address in addresses:
+            device = Device(address)
+            device.protocol = "DALI"
+            router.devices.register_device(device)
+        actual = {addresses[0]: "30", addresses[1]: "0"}
+        
+        await router.devices.set_device_load_level(addresses[0], 30, 1)
+        await router.devices.set_device_load_level(addresses[1], 60, 0)
+        await asyncio.sleep(0.1)
+        
+        queries = [
+            c.args[0].command_address
+            for c in router._send_command_task.call_args_list
+            if c.args[0].command_type == CommandType.QUERY_DEVICE_LOAD_LEVEL
+        ]
+        assert sorted(queries, key=str) == addresses
+        assert router.devices.verifier.corrected == 1
+        assert router.devices.devices[addresses[0]].load_level == 30.0
+        assert router.devices.devices[addresses[1]].load_level == 0.0
+    
+    @pytest.mark.asyncio
+    async def test_noop_writes_elided(self):
+        """Test writes of the level a device already has are dropped when eliding"""
+        router = Router("10.254.0.1", 50000, elide_writes=True, verify_levels=False)
+        router._send_command_task = AsyncMock(return_value=None)
+        router.devices.coalescer.window = 0
+        address = HelvarAddress(0, 1, 1, 1)
+        device = Device(address)
+        device.protocol = "DALI"
+        device.load_level = 50.0
+        router.devices.register_device(device)
+        callback = AsyncMock()
+        router.devices.register_subscription(address, callback)
+        
+        report = await router.devices.set_levels({address: "50.0"}, 0)
+        await router.devices.set_device_load_level(address, 50, 0)
+        await asyncio.sleep(0.01)
+        assert report.sent == [address]
+        assert router._send_command_task.call_count == 0
+        assert router.devices.coalescer.elided == 2
+        callback.assert_not_called()
+        
+        # A write back to the current level still replaces a pending change.
+        await router.devices.set_device_load_level(address, 60, 0)
+        await router.devices.set_device_load_level(address, 50, 0)
+        await asyncio.sleep(0.01)
+        router._send_command_task.assert_called_once()
+        assert str(router._send_command_task.call_args.args[0]) == ">V:2,C:14,L:50,F:0,@0.1.1.1#"
+    
+    def _scene_info_router(self):
+        router = Router("10.254.0.1", 50000)
+        
+        async def send(command):
+            await asyncio.sleep(0)
+            result = None
+            if command.command_type == CommandType.QUERY_SCENE_INFO:
+                result = ",".join(["*"] + ["42"] * 135)
+            return Command(command.command_type, command_result=result)
+        
+        router._send_command_task = AsyncMock(side_effect=send)
+        
+        address = HelvarAddress(0, 1, 1, 1)
+        device = Device(address)
+        device.protocol = "DALI"
+        router.devices.register_device(device)
+        router.groups.register_group(Group(1))
+        router.groups.update_group_device_members(1, [address])
+        return router, device
+    
+    @pytest.mark.asyncio
+    async def test_scene_levels_fetched_on_first_recall(self):
+        """Test a device's scene table is only fetched when a recall needs it"""
+        router, device = self._scene_info_router()
+        assert device.levels == ()
+        
+        await router.groups.handle_scene_callback(SceneAddress(1, 1, 1), 10)
+        await router.groups.handle_scene_callback(SceneAddress(1, 1, 2), 10)
+        
+        assert device.load_level == 42.0
+        assert router._send_command_task.call_count == 1
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_fetches_share_one_query(self):
+        """Test concurrent requests for a scene table send a single query"""
+        router, device = self._scene_info_router()
+        
+        await asyncio.gather(
+            router.devices.fetch_scene_levels([device]),
+            router.devices.fetch_scene_levels([device]),
+        )
+        
+        assert len(device.levels) == 136
+        assert router._send_command_task.call_count == 1
+    
+    @pytest.mark.asyncio
+    async def test_update_device_skips_scene_table(self):
+        """Test discovery doesn't query scene tables"""
+        router, device = self._scene_info_router()
+        
+        await router.devices.update_device(device.address)
+        await router.discovery.wait()
+        
+        sent = [c.args[0].command_type for c in router._send_command_task.call_args_list]
+        assert CommandType.QUERY_SCENE_INFO not in sent
+        assert device.levels == ()
+    
+    @pytest.mark.asyncio
+    async def test_prefetch_scene_levels(self):
+        """Test background prefetch fills in missing scene tables"""
+        router, device = self._scene_info_router()
+        
+        await router.devices.prefetch_scene_levels(TrafficBudget(1000, burst=10))
+        
+        assert len(device.levels) == 136
+    
+    def test_traffic_budget(self):
+        """Test the traffic budget allows bursts up to its limit"""
+        budget = TrafficBudget(0.001, burst=2)
+        
+        assert budget.try_acquire() is True
+        assert budget.try_acquire() is True
+        assert budget.try_acquire() is False
+
+
+# Test device secondary indexes
+class TestDeviceIndex:
+    """Test indexed device queries"""
+    
+    # DALI LED module, and a DIGIDIM 124 control panel
+    DALI_LED = 0x01 | (6 << 8)
+    DIGIDIM_PANEL = 0x02 | (h_2_d(0x00, 0x12, 0x44) << 8)
+    
+    def _make_devices(self):
+        devices = Devices(Mock())
+        devices.register_device(Device(HelvarAddress(0, 1, 1, 1), self.DALI_LED))
+        devices.register_device(Device(HelvarAddress(0, 1, 2, 1), self.DALI_LED))
+        devices.register_device(Device(HelvarAddress(0, 1, 2, 2), self.DALI_LED))
+        devices.register_device(Device(HelvarAddress(0, 1, 2, 3), self.DIGIDIM_PANEL))
+        return devices
+    
+    def test_query_by_protocol_type_and_subnet(self):
+        """Test combining index keys"""
+        devices = self._make_devices()
+        
+        result = devices.query(protocol="DALI", type="LED modules", subnet=2)
+        assert [d.address for d in result] == [HelvarAddress(0, 1, 2, 1), HelvarAddress(0, 1, 2, 2)]
+    
+    def test_query_control_panels(self):
+        """Test querying non-load DIGIDIM devices"""
+        devices = self._make_devices()
+        
+        result = devices.query(protocol="DIGIDIM", is_load=False)
+        assert [d.address for d in result] == [HelvarAddress(0, 1, 2, 3)]
+        assert devices.query(type=result[0].type) == result
+    
+    def test_get_light_devices_uses_index(self):
+        """Test light devices come from the is_load index"""
+        devices = self._make_devices()
+        
+        assert len(devices.get_light_devices()) == 3
+        assert devices.query() == list(devices.devices.values())
+    
+    def test_reregistration_updates_index(self):
+        """Test replacing a device replaces its index entries"""
+        devices = self._make_devices()
+        address = HelvarAddress(0, 1, 2, 3)
+        
+        devices.register_device(Device(address, self.DALI_LED))
+        
+        assert devices.query(protocol="DIGIDIM") == []
+        assert len(devices.query(subnet=2, is_load=True)) == 3
+    
+    def test_unknown_query_key(self):
+        """Test querying by an unindexed attribute fails loudly"""
+        devices = self._make_devices()
+        
+        with pytest.raises(KeyError):
+            devices.index.query(name="Desk")
 
 
 # Test Group
@@ -400,6 +899,271 @@ class TestGroups:
         # Test subscribing to non-existent group
         result = groups.register_subscription(999, callback)
         assert result == False
+    
+    def _level_router(self):
+        router = Router("10.254.0.1", 50000)
+        router._send_command_task = AsyncMock(return_value=None)
+        
+        addresses = [HelvarAddress(0, 1, 1, d) for d in (1, 2)]
+        for address in addresses:
+            device = Device(address)
+            device.protocol = "DALI"
+            router.devices.register_device(device)
+        router.groups.register_group(Group(1))
+        router.groups.update_group_device_members(1, addresses)
+        return router, [router.devices.devices[a] for a in addresses]
+    
+    @pytest.mark.asyncio
+    async def test_set_group_level(self):
+        """Test a group level is one command and updates every member locally"""
+        router, devices = self._level_router()
+        callback = AsyncMock()
+        router.devices.register_subscription(devices[0].address, callback)
+        
+        await router.groups.set_group_level(1, 60, 20)
+        await asyncio.sleep(0)
+        
+        router._send_command_task.assert_called_once()
+        command = router._send_command_task.call_args.args[0]
+        assert command.command_type == CommandType.DIRECT_LEVEL_GROUP
+        assert str(command) == ">V:2,C:13,G:1,L:60,F:20#"
+        assert [d.target_load_level for d in devices] == [60.0, 60.0]
+        callback.assert_called_once()
+    
+    @pytest.mark.asyncio
+    async def test_group_writes_verified(self):
+        """Test group level and proportion writes are read back after their fade"""
+        router, devices = self._level_router()
+        verifier = router.devices.verifier
+        
+        await router.groups.set_group_level(1, 60, 100)
+        assert all(verifier.is_due(d.address) for d in devices)
+        
+        for device in devices:
+            verifier.forget(device.address)
+        await router.groups.set_group_proportion(1, 20, 100)
+        assert all(verifier.is_due(d.address) for d in devices)
+        verifier.cancel()
+    
+    @pytest.mark.asyncio
+    async def test_group_level_replaces_pending_writes(self):
+        """Test a group level drops the pending level writes of its members"""
+        router, devices = self._level_router()
+        written = asyncio.get_running_loop().create_future()
+        router.devices.coalescer.submit(devices[0].address, 30, 10, written)
+        
+        await router.groups.set_group_level(1, 60, 20)
+        await router.devices.coalescer.flush()
+        
+        sent = [str(c.args[0]) for c in router._send_command_task.call_args_list]
+        assert sent == [">V:2,C:13,G:1,L:60,F:20#"]
+        assert router.devices.coalescer.pending == {}
+        assert router.devices.coalescer.coalesced == 1
+        # The dropped write's waiter completes with the group command.
+        router._send_command_task.call_args.args[1].set_result(None)
+        await asyncio.sleep(0)
+        assert written.done()
+    
+    @pytest.mark.asyncio
+    async def test_group_proportion_flushes_pending_writes(self):
+        """Test pending member level writes are sent before a group proportion"""
+        router, devices = self._level_router()
+        await router.devices.set_device_load_level(devices[0].address, 30)
+        
+        await router.groups.set_group_proportion(1, 50)
+        await asyncio.sleep(0)
+        
+        sent = [c.args[0].command_type for c in router._send_command_task.call_args_list]
+        assert sent == [CommandType.DIRECT_LEVEL_DEVICE, CommandType.DIRECT_PROPORTION_GROUP]
+    
+    @pytest.mark.asyncio
+    async def test_group_proportions_predicted(self):
+        """Test direct and modify proportions are predicted from the base level"""
+        router, devices = self._level_router()
+        devices[0].load_level = 50.0
+        devices[1].load_level = 0.0
+        
+        await router.groups.set_group_proportion(1, 50)
+        assert [d.target_load_level for d in devices] == [75.0, 50.0]
+        
+        # Modify is relative to the current proportion, direct replaces it.
+        await router.groups.modify_group_proportion(1, -100)
+        assert [d.target_load_level for d in devices] == [25.0, 0.0]
+        await router.groups.set_group_proportion(1, 0)
+        assert [d.target_load_level for d in devices] == [50.0, 0.0]
+        
+        # A change from elsewhere becomes the new base.
+        await router.groups.set_group_level(1, 20)
+        await router.groups.set_group_proportion(1, -50)
+        assert [d.target_load_level for d in devices] == [10.0, 10.0]
+        
+        sent = [c.args[0].command_type for c in router._send_command_task.call_args_list]
+        assert CommandType.MODIFY_PROPORTION_GROUP in sent
+    
+    @pytest.mark.asyncio
+    async def test_resync_from_last_scenes(self):
+        """Test a resync rebuilds member levels with one last scene query per group"""
+        from aiohelvar.parser.command_type import MessageType
+        router = Router("10.254.0.1", 50000)
+        
+        async def send(command):
+            group = command.get_param_value(CommandParameterType.GROUP)
+            if command.command_type == CommandType.QUERY_LAST_SCENE_IN_GROUP and str(group) == "2":
+                return Command(command.command_type, [], MessageType.ERROR, command_result="11")
+            if command.command_type == CommandType.QUERY_LAST_SCENE_IN_GROUP:
+                return Command(command.command_type, [], MessageType.REPLY, command_result="1")
+            # Scene 3 of the block asked for.
+            return Command(command.command_type, [], MessageType.REPLY, command_result="3")
+        
+        router._send_command_task = AsyncMock(side_effect=send)
+        
+        levels = ["*", "10", "20", "30"] + ["*"] * 132
+        addresses = [HelvarAddress(0, 1, 1, d) for d in (1, 2, 3)]
+        for address in addresses:
+            device = Device(address)
+            device.protocol = "DALI"
+            router.devices.register_device(device)
+        for address in addresses[:2]:
+            router.devices.devices[address].set_scene_levels(levels)
+        for group_id, members in ((1, addresses[:2]), (2, [addresses[1], addresses[2]])):
+            router.groups.register_group(Group(group_id))
+            router.groups.update_group_device_members(group_id, members)
+        router.groups.groups[2].last_scene_address = SceneAddress(2, 1, 1)
+        
+        report = await router.groups.resync()
+        
+        assert report.groups == [1, 2]
+        assert report.failed == []
+        assert report.unknown_devices == [addresses[2]]
+        assert [router.devices.devices[a].load_level for a in addresses] == [20.0, 30.0, 0.0]
+        assert router.groups.groups[2].last_scene_address == SceneAddress(2, 1, 3)
+        # Group 1 answered, group 2 fell back to its block.
+        assert router._send_command_task.call_count == 3
+    
+    @pytest.mark.asyncio
+    async def test_reconnect_resyncs_groups(self):
+        """Test group levels are resynced after a reconnect"""
+        router = Router("10.254.0.1", 50000)
+        router.groups.register_group(Group(1))
+        router.disconnect = AsyncMock()
+        router.connect = AsyncMock()
+        router.groups.resync = AsyncMock()
+        
+        await router.reconnect()
+        await asyncio.sleep(0)
+        
+        router.groups.resync.assert_called_once()
+    
+    @pytest.mark.asyncio
+    async def test_reconnect_restarts_background_polling(self):
+        """Test the topology watcher and pollers keep running across a reconnect"""
+        router = make_site(replies={})
+        router._writer = Mock(wait_closed=AsyncMock())
+        router.connect = AsyncMock()
+        watcher = router.watch_topology(interval=3600)
+        poller = router.poll_state(min_interval=3600)
+        telemetry = router.poll_telemetry(interval=3600)
+        tasks = [router._watch_task, router._poll_task, router._telemetry_task]
+    
+        await router.reconnect()
+        await asyncio.sleep(0)
+    
+        assert all(task.cancelled() for task in tasks)
+        restarted = [router._watch_task, router._poll_task, router._telemetry_task]
+        assert not any(task.done() or task in tasks for task in restarted)
+        assert (router._watcher, router._poller, router._telemetry_poller) == (
+            watcher, poller, telemetry
+        )
+        for task in restarted:
+            task.cancel()
+    
+    @pytest.mark.asyncio
+    async def test_set_scenes_reports_failures(self):
+        """Test a bulk scene recall reports the recalls that couldn't be written"""
+        from aiohelvar.cluster import WriteScheduler
+        router = Router("10.254.0.1", 50000)
+        router.scheduler = WriteScheduler(interval=0)
+        router.connected = True
+        router._writer = Mock()
+        router._writer.drain = AsyncMock()
+        router._writer.write.side_effect = [None, ConnectionResetError()]
+        task = asyncio.create_task(router.scheduler.run())
+        
+        scenes = [SceneAddress(1, 1, 1), SceneAddress(2, 1, 3)]
+        report = await router.groups.set_scenes(scenes, 0)
+        task.cancel()
+        
+        assert report.sent == [scenes[0]]
+        assert isinstance(report.failed[scenes[1]], ConnectionResetError)
+        assert router._writer.write.call_args_list[0].args[0] == b">V:2,C:11,G:1,B:1,S:1,F:0#"
+
+
+# Test GroupMembership index
+class TestGroupMembership:
+    """Test the bidirectional group membership index"""
+    
+    DEVICES = [HelvarAddress(0, 1, 1, device_id) for device_id in (1, 2, 3)]
+    
+    def test_members_resolved_to_devices(self):
+        """Test group members are resolved to registered Device objects"""
+        router = make_site(self.DEVICES, {1: [], 2: []})
+        a1, a2 = HelvarAddress(0, 1, 1, 1), HelvarAddress(0, 1, 1, 2)
+        
+        router.groups.update_group_device_members(1, [a1, a2])
+        
+        devices = router.groups.get_group_devices(1)
+        assert devices == [router.devices.devices[a1], router.devices.devices[a2]]
+    
+    def test_device_to_groups(self):
+        """Test looking up the groups a device belongs to"""
+        router = make_site(self.DEVICES, {1: [], 2: []})
+        a1, a2 = HelvarAddress(0, 1, 1, 1), HelvarAddress(0, 1, 1, 2)
+        
+        router.groups.update_group_device_members(1, [a1, a2])
+        router.groups.update_group_device_members(2, [a2])
+        
+        assert router.devices.get_device_groups(a1) == [router.groups.groups[1]]
+        assert sorted(g.group_id for g in router.devices.get_device_groups(a2)) == [1, 2]
+    
+    def test_membership_diff(self):
+        """Test refreshing a group reports added and removed members"""
+        router = make_site(self.DEVICES, {1: [], 2: []})
+        a1, a2, a3 = [HelvarAddress(0, 1, 1, d) for d in (1, 2, 3)]
+        
+        added, removed = router.groups.update_group_device_members(1, [a1, a2])
+        assert added == [a1, a2]
+        assert removed == []
+        
+        added, removed = router.groups.update_group_device_members(1, [a2, a3])
+        assert added == [a3]
+        assert removed == [a1]
+        assert router.devices.get_device_groups(a1) == []
+    
+    def test_late_device_registration(self):
+        """Test members registered after the group membership are resolved"""
+        router = make_site(self.DEVICES, {1: [], 2: []})
+        address = HelvarAddress(0, 1, 2, 9)
+        
+        router.groups.update_group_device_members(1, [address])
+        assert router.groups.get_group_devices(1) == []
+        
+        device = Device(address)
+        router.devices.register_device(device)
+        assert router.groups.get_group_devices(1) == [device]
+    
+    @pytest.mark.asyncio
+    async def test_scene_callback_uses_index(self):
+        """Test scene recalls fan out to the indexed member devices"""
+        router = make_site(self.DEVICES, {1: [], 2: []})
+        address = HelvarAddress(0, 1, 1, 1)
+        device = router.devices.devices[address]
+        device.protocol = "DALI"
+        device.set_scene_levels(["*"] + ["42"] * 135)
+        router.groups.update_group_device_members(1, [address])
+        
+        await router.groups.handle_scene_callback(SceneAddress(1, 1, 1), 10)
+        
+        assert device.load_level == 42.0
 
 
 # Test Scene
@@ -511,6 +1275,598 @@ class TestScenes:
         assert len(all_scenes) == 3
 
 
+# Test state snapshots
+class TestSnapshots:
+    """Test immutable, structurally shared router snapshots"""
+    
+    DEVICES = [HelvarAddress(0, 1, s, d) for s in (1, 2) for d in (1, 2, 3)]
+    
+    def test_snapshot_contents(self):
+        """Test a snapshot reflects the registered state"""
+        router = make_site(self.DEVICES, {1: []})
+        snapshot = router.snapshot()
+        
+        assert len(snapshot.devices) == 6
+        assert snapshot.devices[HelvarAddress(0, 1, 2, 3)].address == HelvarAddress(0, 1, 2, 3)
+        assert list(snapshot.groups) == [1]
+        assert SceneAddress(1, 1, 1) in snapshot.scenes
+    
+    def test_unchanged_snapshot_is_reused(self):
+        """Test snapshots are returned as-is when nothing has changed"""
+        router = make_site(self.DEVICES, {1: []})
+        
+        assert router.snapshot() is router.snapshot()
+    
+    @pytest.mark.asyncio
+    async def test_snapshot_is_isolated_from_writes(self):
+        """Test a held snapshot doesn't see later changes"""
+        router = make_site(self.DEVICES, {1: []})
+        address = HelvarAddress(0, 1, 1, 1)
+        
+        before = router.snapshot()
+        await router.devices.update_device_load_level(address, 80)
+        after = router.snapshot()
+        
+        assert before.devices[address].load_level == 0.0
+        assert after.devices[address].load_level == 80.0
+        assert after.version == before.version + 1
+    
+    @pytest.mark.asyncio
+    async def test_unchanged_chunks_are_shared(self):
+        """Test new versions share untouched chunks with the previous one"""
+        router = make_site(self.DEVICES, {1: []})
+        
+        before = dict(router.snapshot().devices.chunks())
+        await router.devices.update_device_name(HelvarAddress(0, 1, 1, 1), "Desk")
+        after = dict(router.snapshot().devices.chunks())
+        
+        assert after[(0, 1, 2)] is before[(0, 1, 2)]
+        assert after[(0, 1, 1)] is not before[(0, 1, 1)]
+    
+    def test_snapshot_is_immutable(self):
+        """Test snapshots can't be modified by readers"""
+        router = make_site(self.DEVICES, {1: []})
+        snapshot = router.snapshot()
+        
+        with pytest.raises(TypeError):
+            snapshot.devices[HelvarAddress(0, 1, 1, 1)] = None
+        with pytest.raises(AttributeError):
+            snapshot.devices[HelvarAddress(0, 1, 1, 1)].load_level = 10
+    
+    @pytest.mark.asyncio
+    async def test_diff_mappings(self):
+        """Test snapshot diffs list changed and removed keys"""
+        from aiohelvar.snapshot import diff_mappings
+        router = make_site(self.DEVICES, {1: []})
+        
+        before = router.snapshot().devices
+        await router.devices.update_device_name(HelvarAddress(0, 1, 1, 1), "Desk")
+        router.devices.unregister_device(HelvarAddress(0, 1, 2, 3))
+        after = router.snapshot().devices
+        
+        changed, removed = diff_mappings(before, after)
+        assert changed == [HelvarAddress(0, 1, 1, 1)]
+        assert removed == [HelvarAddress(0, 1, 2, 3)]
+
+
+# Test topology cache
+class TestTopologyCache:
+    """Test saving and warm-starting from the topology cache"""
+    
+    @pytest.mark.asyncio
+    async def test_round_trip(self, tmp_path):
+        """Test a saved cache restores devices, groups and scenes"""
+        cache = TopologyCache(str(tmp_path / "topology.json.gz"))
+        await cache.save(sample_site())
+        
+        router = Router("10.254.0.1", 50000)
+        assert await cache.load(router) is True
+        
+        device = router.devices.devices[HelvarAddress(0, 1, 1, 1)]
+        assert device.name == "Desk"
+        assert device.protocol == "DALI"
+        assert device.type == "LED modules"
+        assert device.load_level == 42.0
+        assert device.get_level_for_scene(SceneAddress(3, 1, 1)) == "50"
+        assert router.groups.groups[3].name == "Kitchen"
+        assert router.groups.get_group_devices(3) == [device]
+        assert router.scenes.get_scene(SceneAddress(3, 1, 2)).name == "Cooking"
+        assert router.workgroup_name == "Office"
+    
+    @pytest.mark.asyncio
+    async def test_fingerprints_round_trip(self, tmp_path):
+        """Test revalidation fingerprints are cached, and used on warm start"""
+        cache = TopologyCache(str(tmp_path / "topology.json.gz"))
+        source = sample_site()
+        source.devices.subnet_fingerprints = {1: fingerprint("1537@1")}
+        source.groups.fingerprint = fingerprint("3")
+        await cache.save(source)
+        
+        from aiohelvar.revalidation import RevalidationReport
+        router = Router("10.254.0.1", 50000)
+        router.connected = True
+        router.revalidate = AsyncMock(
+            return_value=RevalidationReport([], [], [], [], [], False, [])
+        )
+        router.groups.resync = AsyncMock()
+        await router.initialize(cache)
+        await router._cache_task
+        
+        assert router.devices.subnet_fingerprints == {1: fingerprint("1537@1")}
+        assert router.groups.fingerprint == fingerprint("3")
+        router.revalidate.assert_awaited_once()
+    
+    async def _warm_start(self, tmp_path, revalidation):
+        cache = TopologyCache(str(tmp_path / "topology.json.gz"))
+        source = sample_site()
+        source.groups.fingerprint = fingerprint("3")
+        await cache.save(source)
+        
+        router = make_site(
+            replies={
+                CommandType.QUERY_DEVICE_STATE: "0",
+                CommandType.QUERY_DEVICE_LOAD_LEVEL: "7",
+            }
+        )
+        router.connected = True
+        router.revalidate = AsyncMock(return_value=revalidation)
+        router.groups.resync = AsyncMock()
+        await router.initialize(cache)
+        assert router.devices.devices[HelvarAddress(0, 1, 1, 1)].load_level == 42.0
+        await router._cache_task
+        return router
+    
+    @pytest.mark.asyncio
+    async def test_warm_start_resyncs_levels(self, tmp_path):
+        """Test a warm start of an unchanged site resyncs levels per group only"""
+        from aiohelvar.revalidation import RevalidationReport
+        router = await self._warm_start(
+            tmp_path, RevalidationReport([], [], [], [], [], False, [])
+        )
+        
+        router.groups.resync.assert_awaited_once_with()
+        router._send_command_task.assert_not_called()
+        assert router.devices.devices[HelvarAddress(0, 1, 1, 1)].load_level == 42.0
+    
+    @pytest.mark.asyncio
+    async def test_warm_start_rereads_changed_subnets(self, tmp_path):
+        """Test a warm start re-reads device states on subnets that have changed"""
+        from aiohelvar.revalidation import RevalidationReport
+        router = await self._warm_start(
+            tmp_path, RevalidationReport([1], [], [], [], [], False, [])
+        )
+        
+        sent = [c.args[0].command_type for c in router._send_command_task.call_args_list]
+        assert set(sent) == {CommandType.QUERY_DEVICE_STATE, CommandType.QUERY_DEVICE_LOAD_LEVEL}
+        assert router.devices.devices[HelvarAddress(0, 1, 1, 1)].load_level == 7.0
+    
+    @pytest.mark.asyncio
+    async def test_cache_for_other_router_ignored(self, tmp_path):
+        """Test a cache saved for another router isn't loaded"""
+        cache = TopologyCache(str(tmp_path / "topology.json.gz"))
+        await cache.save(sample_site())
+        
+        assert await cache.load(Router("10.254.0.2", 50000)) is False
+    
+    @pytest.mark.asyncio
+    async def test_malformed_payload_restores_nothing(self, tmp_path):
+        """Test a payload missing its ids, or corrupt partway through, registers nothing"""
+        cache = TopologyCache(str(tmp_path / "topology.json.gz"))
+        payload = cache.dump(sample_site())
+        
+        missing_ids = dict(payload)
+        del missing_ids["router_id"]
+        cache.write(missing_ids)
+        assert await cache.load(Router("10.254.0.1", 50000)) is False
+        
+        # Devices are fine, but a group member isn't an address.
+        payload["groups"][0][2] = ["not an address"]
+        cache.write(payload)
+        router = Router("10.254.0.1", 50000)
+        assert await cache.load(router) is False
+        assert router.devices.devices == {}
+        assert router.groups.groups == {}
+    
+    @pytest.mark.asyncio
+    async def test_missing_or_corrupt_cache(self, tmp_path):
+        """Test missing and unreadable caches are ignored"""
+        path = tmp_path / "topology.json.gz"
+        cache = TopologyCache(str(path))
+        assert await cache.load(Router("10.254.0.1", 50000)) is False
+        
+        path.write_bytes(b"not a cache")
+        assert await cache.load(Router("10.254.0.1", 50000)) is False
+    
+    @pytest.mark.asyncio
+    async def test_warm_start_initialize(self, tmp_path):
+        """Test initialize goes live from the cache and revalidates in the background"""
+        cache = TopologyCache(str(tmp_path / "topology.json.gz"))
+        await cache.save(sample_site())
+        
+        router = Router("10.254.0.1", 50000)
+        router.connected = True
+        router._discover = AsyncMock()
+        
+        await router.initialize(cache)
+        
+        assert HelvarAddress(0, 1, 1, 1) in router.devices.devices
+        await router._cache_task
+        router._discover.assert_awaited_once()
+
+
+# Test incremental revalidation
+class TestRevalidation:
+    """Test fingerprint based revalidation of a cached topology"""
+    
+    SUBNET_1 = "1537@1,1537@2"
+    
+    def _fingerprinted_site(self, replies):
+        router = make_site(
+            [Device(HelvarAddress(0, 1, 1, d), "1537") for d in (1, 2)],
+            {1: [], 2: []},
+            replies,
+        )
+        router.devices.subnet_fingerprints = {1: fingerprint(self.SUBNET_1)}
+        router.devices.subnet_fingerprints.update({s: fingerprint(None) for s in (2, 3, 4)})
+        router.groups.fingerprint = fingerprint("1,2")
+        router.scenes.names_fingerprint = fingerprint("@1.1.1:Bright")
+        router.devices.update_device = AsyncMock()
+        return router
+    
+    def _unchanged_replies(self):
+        return {
+            1: self.SUBNET_1,
+            CommandType.QUERY_GROUPS: "1,2",
+            CommandType.QUERY_SCENE_NAMES: "@1.1.1:Bright",
+        }
+    
+    @pytest.mark.asyncio
+    async def test_unchanged_site(self):
+        """Test an unchanged site costs only the fingerprint queries"""
+        router = self._fingerprinted_site(self._unchanged_replies())
+        
+        report = await router.revalidate()
+        
+        assert router._send_command_task.await_count == 6
+        assert report.changed_subnets == []
+        assert report.added_groups == [] and report.removed_groups == []
+        assert report.scene_names_changed is False
+        router.devices.update_device.assert_not_awaited()
+    
+    @pytest.mark.asyncio
+    async def test_changed_subnet(self):
+        """Test only new devices on a changed subnet are fetched"""
+        replies = self._unchanged_replies()
+        replies[1] = "1537@2,1537@3"
+        router = self._fingerprinted_site(replies)
+        
+        with patch("aiohelvar.revalidation.update_group_devices", new=AsyncMock()):
+            report = await router.revalidate()
+        
+        assert report.changed_subnets == [1]
+        assert report.added_devices == [HelvarAddress(0, 1, 1, 3)]
+        assert report.removed_devices == [HelvarAddress(0, 1, 1, 1)]
+        assert HelvarAddress(0, 1, 1, 1) not in router.devices.devices
+        router.devices.update_device.assert_awaited_once_with(HelvarAddress(0, 1, 1, 3))
+    
+    @pytest.mark.asyncio
+    async def test_changed_groups_and_scene_names(self):
+        """Test added and removed groups and renamed scenes are picked up"""
+        replies = self._unchanged_replies()
+        replies[CommandType.QUERY_GROUPS] = "1,3"
+        replies[CommandType.QUERY_SCENE_NAMES] = "@1.1.1:Evening"
+        router = self._fingerprinted_site(replies)
+        
+        with patch("aiohelvar.revalidation.refresh_group") as refresh_group:
+            report = await router.revalidate()
+        
+        assert report.added_groups == [3]
+        assert report.removed_groups == [2]
+        assert 2 not in router.groups.groups
+        refresh_group.assert_called_once_with(router, "3")
+        assert router.scenes.get_scene(SceneAddress(1, 1, 1)).name == "Evening"
+        assert not router.scenes.has_scene(SceneAddress(2, 1, 1))
+    
+    @pytest.mark.asyncio
+    async def test_watcher_quiet_when_unchanged(self):
+        """Test a watcher check on an unchanged site only sends fingerprint queries"""
+        from aiohelvar.revalidation import TopologyWatcher
+        replies = self._unchanged_replies()
+        replies[CommandType.QUERY_GROUP] = None
+        router = self._fingerprinted_site(replies)
+        watcher = TopologyWatcher(router, rate=1000, groups_per_check=1)
+        
+        assert await watcher.check() is None
+        assert router._send_command_task.await_count == 7
+    
+    @pytest.mark.asyncio
+    async def test_watcher_detects_membership_change(self):
+        """Test a watcher picks up a changed group and publishes only that change"""
+        from aiohelvar.revalidation import TopologyWatcher
+        router = self._fingerprinted_site(self._unchanged_replies())
+        router.groups.update_group_device_members(1, [HelvarAddress(0, 1, 1, 1)])
+        router.groups.update_group_device_members(2, [HelvarAddress(0, 1, 1, 1)])
+        topology_callback = AsyncMock()
+        router.register_topology_subscription(topology_callback)
+        
+        replies = self._unchanged_replies()
+        replies[CommandType.QUERY_GROUP] = "@0.1.1.1,@0.1.1.2"
+        router._send_command_task.side_effect = make_site(replies=replies)._send_command_task.side_effect
+        watcher = TopologyWatcher(router, rate=1000, groups_per_check=1)
+        
+        report = await watcher.check()
+        
+        assert report.changed_groups == [1]
+        assert report.changed_subnets == []
+        assert router.groups.groups[2].devices == [HelvarAddress(0, 1, 1, 1)]
+        diff = topology_callback.call_args[0][0]
+        assert diff.memberships == {1: ([HelvarAddress(0, 1, 1, 2)], [])}
+        
+        # The next check moves on to the next group.
+        assert watcher._next_group_ids() == [2]
+    
+    @pytest.mark.asyncio
+    async def test_watcher_rediscovery_within_budget(self):
+        """Test rediscovery waits for the watcher's budget and skips unchanged groups"""
+        from aiohelvar.revalidation import TopologyWatcher
+        replies = self._unchanged_replies()
+        replies[1] = "1537@1,1537@2,1537@3"
+        replies[CommandType.QUERY_GROUPS] = "1,2,3"
+        router = self._fingerprinted_site(replies)
+        watcher = TopologyWatcher(router, rate=1000, groups_per_check=0)
+        acquired = []
+        
+        async def acquire():
+            acquired.append(router._send_command_task.await_count)
+        
+        watcher.budget.acquire = acquire
+        
+        report = await watcher.check()
+        
+        assert report.added_devices == [HelvarAddress(0, 1, 1, 3)]
+        assert report.added_groups == [3]
+        # Six fingerprint queries, then group 3's name, members and last scene, each
+        # acquired before it was sent.
+        assert acquired == [0, 1, 2, 3, 4, 5, 6, 7, 8]
+        groups_queried = [
+            c.args[0].get_param_value(CommandParameterType.GROUP)
+            for c in router._send_command_task.call_args_list
+            if c.args[0].command_type == CommandType.QUERY_GROUP
+        ]
+        assert groups_queried == ["3"]
+        assert router.discovery._budget is None
+
+
+# Test topology diff events
+class TestTopologyDiff:
+    """Test refreshes publish only what structurally changed"""
+    
+    def _replies(self):
+        return {
+            1: "1537@1",
+            CommandType.QUERY_GROUPS: "1,2",
+            ("name", 1): "Kitchen",
+            ("name", 2): "Hall",
+            ("members", 1): "@0.1.1.1",
+            CommandType.QUERY_DEVICE_DESCRIPTION: "Light",
+            CommandType.QUERY_SCENE_NAMES: "@1.1.1:Bright",
+        }
+    
+    @pytest.mark.asyncio
+    async def test_unchanged_refresh_is_silent(self):
+        """Test a refresh that finds nothing new notifies nobody"""
+        router = make_site(replies=self._replies())
+        router.connected = True
+        await router.initialize()
+        
+        group_callback, topology_callback = AsyncMock(), AsyncMock()
+        router.groups.register_subscription(1, group_callback)
+        router.register_topology_subscription(topology_callback)
+        
+        diff = await router.refresh()
+        
+        assert not diff
+        group_callback.assert_not_called()
+        topology_callback.assert_not_called()
+    
+    @pytest.mark.asyncio
+    async def test_refresh_emits_changes(self):
+        """Test a refresh reports and notifies only the changed parts"""
+        replies = self._replies()
+        router = make_site(replies=replies)
+        router.connected = True
+        await router.initialize()
+        
+        kitchen, hall, topology_callback = AsyncMock(), AsyncMock(), AsyncMock()
+        router.groups.register_subscription(1, kitchen)
+        router.groups.register_subscription(2, hall)
+        router.register_topology_subscription(topology_callback)
+        
+        replies[1] = "1537@1,1537@2"
+        replies[("members", 1)] = "@0.1.1.1,@0.1.1.2"
+        replies[CommandType.QUERY_SCENE_NAMES] = "@1.1.1:Evening"
+        diff = await router.refresh()
+        
+        assert diff.added_devices == [HelvarAddress(0, 1, 1, 2)]
+        assert diff.changed_groups == [1]
+        assert diff.memberships == {1: ([HelvarAddress(0, 1, 1, 2)], [])}
+        assert diff.scene_names == {SceneAddress(1, 1, 1): "Evening"}
+        assert diff.added_groups == [] and diff.removed_devices == []
+        kitchen.assert_called_once()
+        hall.assert_not_called()
+        topology_callback.assert_called_once_with(diff)
+    
+    @pytest.mark.asyncio
+    async def test_refresh_emits_removals(self):
+        """Test a refresh drops groups and scene names the router no longer lists"""
+        replies = self._replies()
+        replies[CommandType.QUERY_SCENE_NAMES] = "@1.1.1:Bright@2.1.1:Away"
+        router = make_site(replies=replies)
+        router.connected = True
+        await router.initialize()
+        
+        replies[CommandType.QUERY_GROUPS] = "1"
+        replies[CommandType.QUERY_SCENE_NAMES] = ""
+        diff = await router.refresh()
+        
+        assert diff.removed_groups == [2]
+        assert list(router.groups.groups) == [1]
+        assert not router.scenes.has_scene(SceneAddress(2, 1, 1))
+        assert diff.scene_names == {SceneAddress(1, 1, 1): None, SceneAddress(2, 1, 1): None}
+        assert router.scenes.get_scene(SceneAddress(1, 1, 1)).name is None
+    
+    @pytest.mark.asyncio
+    async def test_initial_discovery_adds_everything(self):
+        """Test the first discovery reports everything as added"""
+        router = make_site(replies=self._replies())
+        router.connected = True
+        topology_callback = AsyncMock()
+        router.register_topology_subscription(topology_callback)
+        
+        await router.initialize()
+        
+        diff = topology_callback.call_args[0][0]
+        assert diff.added_devices == [HelvarAddress(0, 1, 1, 1)]
+        assert sorted(diff.added_groups) == [1, 2]
+        assert diff.scene_names == {SceneAddress(1, 1, 1): "Bright"}
+
+
+# Test structured discovery
+class TestDiscovery:
+    """Test the tracked discovery task graph"""
+    
+    @pytest.mark.asyncio
+    async def test_wait_includes_nested_steps(self):
+        """Test wait() covers steps spawned by other steps"""
+        discovery = Discovery()
+        finished = []
+        
+        async def child(n):
+            await asyncio.sleep(0.01)
+            finished.append(n)
+        
+        async def parent():
+            for n in range(3):
+                discovery.spawn(f"child {n}", child(n))
+        
+        discovery.spawn("parent", parent())
+        report = await discovery.wait()
+        
+        assert report.complete is True
+        assert report.completed == 4
+        assert sorted(finished) == [0, 1, 2]
+    
+    @pytest.mark.asyncio
+    async def test_bounded_concurrency(self):
+        """Test no more than `concurrency` steps run at once"""
+        discovery = Discovery(concurrency=2)
+        running = 0
+        peak = 0
+        
+        async def step():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+        
+        for n in range(6):
+            discovery.spawn(f"step {n}", step())
+        await discovery.wait()
+        
+        assert peak == 2
+    
+    @pytest.mark.asyncio
+    async def test_deadline_reports_missing(self):
+        """Test a deadline returns a report naming outstanding steps"""
+        discovery = Discovery()
+        discovery.spawn("quick", asyncio.sleep(0))
+        discovery.spawn("slow", asyncio.sleep(10))
+        
+        report = await discovery.wait(timeout=0.05)
+        
+        assert report.complete is False
+        assert report.pending == ["slow"]
+        for task in list(discovery._running):
+            task.cancel()
+    
+    @pytest.mark.asyncio
+    async def test_progress_and_failures(self):
+        """Test progress callbacks and failed steps"""
+        progress = []
+        discovery = Discovery(progress=lambda done, total, name: progress.append((done, total, name)))
+        
+        async def fail():
+            raise ValueError("no reply")
+        
+        discovery.spawn("ok", asyncio.sleep(0))
+        discovery.spawn("broken", fail())
+        report = await discovery.wait()
+        
+        assert sorted(p[2] for p in progress) == ["broken", "ok"]
+        assert progress[-1][:2] == (2, 2)
+        assert isinstance(report.failed["broken"], ValueError)
+    
+    @pytest.mark.asyncio
+    async def test_phases_run_in_order(self):
+        """Test later-phase steps wait for every earlier-phase step"""
+        discovery = Discovery()
+        order = []
+        
+        async def step(name, delay):
+            await asyncio.sleep(delay)
+            order.append(name)
+        
+        discovery.spawn("name", step("name", 0), DiscoveryPhase.NAMES)
+        discovery.spawn("load level", step("load level", 0), DiscoveryPhase.CONTROL)
+        discovery.spawn("members", step("members", 0.02), DiscoveryPhase.TOPOLOGY)
+        report = await discovery.wait()
+        
+        assert order == ["members", "load level", "name"]
+        assert list(report.phases) == ["TOPOLOGY", "CONTROL", "NAMES"]
+        assert report.phases["TOPOLOGY"] <= report.phases["NAMES"]
+    
+    @pytest.mark.asyncio
+    async def test_nested_earlier_phase_gates_later(self):
+        """Test an earlier-phase step spawned mid-discovery holds back later phases"""
+        discovery = Discovery()
+        order = []
+        
+        async def record(name):
+            await asyncio.sleep(0)
+            order.append(name)
+        
+        async def subnet():
+            discovery.spawn("device state", record("device state"), DiscoveryPhase.CONTROL)
+            discovery.spawn("group members", record("group members"), DiscoveryPhase.TOPOLOGY)
+        
+        discovery.spawn("subnet", subnet())
+        await discovery.wait()
+        
+        assert order == ["group members", "device state"]
+    
+    @pytest.mark.asyncio
+    async def test_initialize_waits_for_discovery(self):
+        """Test initialize returns only once discovered data has arrived"""
+        router = Router("10.254.0.1", 50000)
+        router.connected = True
+        
+        async def send(command):
+            await asyncio.sleep(0)
+            result = {
+                CommandType.QUERY_GROUPS: "1",
+                CommandType.QUERY_GROUP_DESCRIPTION: "Kitchen",
+            }.get(command.command_type)
+            return Command(command.command_type, command_result=result)
+        
+        router._send_command_task = AsyncMock(side_effect=send)
+        
+        report = await router.initialize()
+        
+        assert report.complete is True
+        assert router.groups.groups[1].name == "Kitchen"
+
+
 # Test Static Utilities
 class TestStaticUtilities:
     """Test static utility functions"""
@@ -638,6 +1994,458 @@ class TestIntegration:
         assert result is None  # Should return None gracefully
 
 
+# Test workgroup discovery
+class TestWorkgroup:
+    """Test discovering every router in a workgroup"""
+    
+    @pytest.mark.asyncio
+    async def test_enumerate(self):
+        """Test clusters and their routers are enumerated from the seed"""
+        from aiohelvar.workgroup import Workgroup
+        seed = workgroup_member(0, 1, [1])
+        
+        members = await Workgroup(seed).enumerate()
+        
+        assert members == [(0, 1), (1, 2)]
+    
+    @pytest.mark.asyncio
+    async def test_discover_merges_topology(self):
+        """Test every router is discovered and merged into one topology"""
+        from aiohelvar.workgroup import Workgroup
+        seed = workgroup_member(0, 1, [1])
+        workgroup = Workgroup(
+            seed, concurrency=4, router_factory=lambda c, r: workgroup_member(c, r, [1, 2])
+        )
+        
+        report = await workgroup.discover()
+        topology = workgroup.topology()
+        
+        assert report.discovery.complete is True
+        assert report.routers == [(0, 1), (1, 2)]
+        assert set(topology.devices) == {HelvarAddress(0, 1, 1, 1), HelvarAddress(1, 2, 1, 1)}
+        assert topology.groups[1].devices == (HelvarAddress(0, 1, 1, 1), HelvarAddress(1, 2, 1, 1))
+        assert topology.groups[2].devices == (HelvarAddress(1, 2, 1, 1),)
+        assert all(r._send_command_task.called for r in workgroup.routers.values())
+    
+    @pytest.mark.asyncio
+    async def test_unreachable_router_reported(self):
+        """Test routers that can't be connected to are reported and skipped"""
+        from aiohelvar.workgroup import Workgroup
+        seed = workgroup_member(0, 1, [1])
+        
+        def factory(cluster_id, router_id):
+            router = workgroup_member(cluster_id, router_id, [])
+            router.connect = AsyncMock(side_effect=ConnectionRefusedError())
+            return router
+        
+        report = await Workgroup(seed, router_factory=factory).discover()
+        
+        assert report.routers == [(0, 1)]
+        assert isinstance(report.unreachable[(1, 2)], ConnectionRefusedError)
+    
+    def test_router_host(self):
+        """Test router addresses are derived from the seed's network"""
+        from aiohelvar.workgroup import router_host
+        
+        assert router_host("10.254.1.1", 3, 7) == "10.254.3.7"
+
+
+# Test the multi-router cluster manager
+class TestHelvarCluster:
+    """Test HelvarCluster sharing session resources and routing commands"""
+    
+    class _Writer:
+        def __init__(self):
+            self.written = []
+        
+        def write(self, data):
+            self.written.append((data, asyncio.get_running_loop().time()))
+        
+        async def drain(self):
+            pass
+    
+    @pytest.mark.asyncio
+    async def test_write_scheduler_paces_each_router(self):
+        """Test one scheduler keeps per-router order and pacing without blocking others"""
+        from aiohelvar.cluster import WriteScheduler
+        scheduler = WriteScheduler(interval=0.02)
+        a, b = Router("10.254.0.1", 50000), Router("10.254.0.2", 50000)
+        a._writer, b._writer = self._Writer(), self._Writer()
+        a.connected = b.connected = True
+        
+        task = asyncio.create_task(scheduler.run())
+        for n in range(3):
+            scheduler.enqueue(a, b"a%d" % n)
+        scheduler.enqueue(b, b"b0")
+        await asyncio.sleep(0.1)
+        task.cancel()
+        
+        assert [d for d, _ in a._writer.written] == [b"a0", b"a1", b"a2"]
+        assert [d for d, _ in b._writer.written] == [b"b0"]
+        times = [t for _, t in a._writer.written]
+        assert all(later - earlier >= 0.015 for earlier, later in zip(times, times[1:]))
+        assert b._writer.written[0][1] < times[1]
+    
+    @pytest.mark.asyncio
+    async def test_write_scheduler_survives_router_failures(self):
+        """Test a failing or unconnected router doesn't stop writes to the others"""
+        from aiohelvar.cluster import WriteScheduler
+        scheduler = WriteScheduler(interval=0)
+        a, b, c = (Router(f"10.254.0.{n}", 50000) for n in (1, 2, 3))
+        a.connected = b.connected = True
+        a._writer = Mock(write=Mock(side_effect=RuntimeError("broken")))
+        b._writer = self._Writer()
+        loop = asyncio.get_running_loop()
+        failed, rejected = loop.create_future(), loop.create_future()
+        
+        task = asyncio.create_task(scheduler.run())
+        scheduler.enqueue(a, b"a0", failed)
+        scheduler.enqueue(c, b"c0", rejected)
+        await asyncio.sleep(0.01)
+        scheduler.enqueue(b, b"b0")
+        await asyncio.sleep(0.01)
+        task.cancel()
+        
+        assert isinstance(failed.exception(), RuntimeError)
+        assert isinstance(rejected.exception(), ConnectionError)
+        assert [d for d, _ in b._writer.written] == [b"b0"]
+    
+    def test_add_router_shares_session(self):
+        """Test routers added to a cluster share its parser and scheduler"""
+        from aiohelvar.cluster import HelvarCluster
+        cluster = HelvarCluster()
+        a = cluster.add_router(Router("10.254.0.1", 50000))
+        b = cluster.add_router(Router("10.254.0.2", 50000))
+        
+        assert a.parser is b.parser is cluster.parser
+        assert a.scheduler is b.scheduler is cluster.scheduler
+        assert a.keep_alive is False
+    
+    @pytest.mark.asyncio
+    async def test_commands_routed_by_address(self):
+        """Test device commands go to the router that owns the address"""
+        from aiohelvar.cluster import HelvarCluster
+        cluster = HelvarCluster()
+        a = cluster.add_router(Router("10.254.0.1", 50000))
+        b = cluster.add_router(Router("10.254.0.2", 50000))
+        a.devices.set_device_load_level = AsyncMock()
+        b.devices.set_device_load_level = AsyncMock()
+        
+        await cluster.set_device_load_level(HelvarAddress(0, 2, 1, 5), 50)
+        
+        b.devices.set_device_load_level.assert_called_once()
+        a.devices.set_device_load_level.assert_not_called()
+        with pytest.raises(KeyError):
+            cluster.router_for(HelvarAddress(0, 9, 1, 1))
+    
+    @pytest.mark.asyncio
+    async def test_initialize_aggregates_routers(self):
+        """Test initialize discovers every router into one merged view"""
+        from aiohelvar.cluster import HelvarCluster
+        cluster = HelvarCluster()
+        for router_id in (1, 2):
+            router = cluster.add_router(workgroup_member(0, router_id, [1]))
+            router.disconnect = AsyncMock()
+        
+        report = await cluster.initialize()
+        await cluster.disconnect()
+        
+        assert report.discovery.complete is True
+        assert len(cluster.get_group_devices(1)) == 2
+        assert set(cluster.topology().devices) == {
+            HelvarAddress(0, 1, 1, 1), HelvarAddress(0, 2, 1, 1)
+        }
+
+
+# Test process sharding
+class TestSharding:
+    """Test worker deltas and the sharded coordinator"""
+    
+    def _source(self):
+        address = HelvarAddress(0, 1, 1, 1)
+        return make_site(
+            devices=[Device(address, 1537, "Desk")],
+            groups={1: [address]},
+            names={1: "Office", SceneAddress(1, 1, 1): "Bright"},
+        )
+    
+    @pytest.mark.asyncio
+    async def test_deltas_mirror_router(self):
+        """Test deltas reproduce a router's state on a mirror"""
+        from aiohelvar.sharding import SnapshotDeltas, apply_delta
+        source = self._source()
+        mirror = Router("10.254.0.1", 50000)
+        deltas = SnapshotDeltas(source)
+        
+        delta = deltas.delta()
+        await apply_delta(mirror, delta)
+        
+        assert len(delta["scenes"]) == 1
+        assert mirror.devices.devices[HelvarAddress(0, 1, 1, 1)].name == "Desk"
+        assert mirror.groups.groups[1].name == "Office"
+        assert mirror.groups.get_group_devices(1)[0].address == HelvarAddress(0, 1, 1, 1)
+        assert mirror.scenes.scenes[SceneAddress(1, 1, 1)].name == "Bright"
+        assert deltas.delta() is None
+    
+    @pytest.mark.asyncio
+    async def test_delta_updates_in_place(self):
+        """Test later deltas update mirrored entities and notify their subscribers"""
+        from aiohelvar.sharding import SnapshotDeltas, apply_delta
+        source = self._source()
+        mirror = Router("10.254.0.1", 50000)
+        deltas = SnapshotDeltas(source)
+        await apply_delta(mirror, deltas.delta())
+        
+        address = HelvarAddress(0, 1, 1, 1)
+        device = mirror.devices.devices[address]
+        callback = AsyncMock()
+        device.add_subscriber(callback)
+        
+        await source.devices.update_device_load_level(address, 70)
+        delta = deltas.delta()
+        await apply_delta(mirror, delta)
+        
+        assert delta["groups"] == [] and delta["devices"] == []
+        assert delta["device_changes"] == [
+            ["@0.1.1.1", {"load_level": 70.0, "last_load_level": 0.0}]
+        ]
+        assert mirror.devices.devices[address] is device
+        assert device.load_level == 70.0
+        callback.assert_called_once_with(device)
+    
+    @pytest.mark.asyncio
+    async def test_delta_sends_fetched_scene_table(self):
+        """Test a newly fetched scene table is sent on its own"""
+        from aiohelvar.sharding import SnapshotDeltas, apply_delta
+        source = self._source()
+        mirror = Router("10.254.0.1", 50000)
+        deltas = SnapshotDeltas(source)
+        await apply_delta(mirror, deltas.delta())
+        
+        address = HelvarAddress(0, 1, 1, 1)
+        source.devices.update_device_scene_level(address, ",".join(["30"] * 136))
+        delta = deltas.delta()
+        await apply_delta(mirror, delta)
+        
+        assert list(delta["device_changes"][0][1]) == ["levels"]
+        assert mirror.devices.devices[address].get_level_for_scene(SceneAddress(1, 1, 1)) == "30"
+    
+    @pytest.mark.asyncio
+    async def test_mirror_forwards_control_calls(self):
+        """Test a mirror's control methods go to the worker, and nothing is sent locally"""
+        from aiohelvar.sharding import ShardedCluster
+        cluster = ShardedCluster([("127.0.0.1", 50000, 0, 1)], workers=1)
+        cluster._call = AsyncMock(return_value="report")
+        mirror = cluster.routers[(0, 1)]
+        cluster._mirror((0, 1), mirror)
+        
+        assert await mirror.groups.set_group_level(3, 50, fade_time=0) == "report"
+        cluster._call.assert_awaited_once_with((0, 1), "groups", "set_group_level", 3, 50, fade_time=0)
+        with pytest.raises(ConnectionError):
+            await mirror._send_command_task(Command(CommandType.QUERY_ROUTER_TIME))
+    
+    @pytest.mark.asyncio
+    async def test_worker_process_reports_unreachable(self):
+        """Test a worker process starts, reports back and stops"""
+        from aiohelvar.sharding import ShardedCluster
+        import socket
+        
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        
+        cluster = ShardedCluster([("127.0.0.1", port, 0, 1)], workers=1)
+        report = await cluster.initialize(timeout=30)
+        await cluster.disconnect()
+        
+        assert report.routers == []
+        assert (0, 1) in report.unreachable
+
+    @pytest.mark.asyncio
+    async def test_dead_worker_fails_waiters(self):
+        """Test a worker exiting fails its readiness and calls, and drops its routers"""
+        from aiohelvar.sharding import ShardedCluster
+        from concurrent.futures import ThreadPoolExecutor
+        import multiprocessing
+
+        cluster = ShardedCluster([("127.0.0.1", 50000, 0, 1)], workers=1)
+        cluster._executor = ThreadPoolExecutor(max_workers=1)
+        conn, worker_conn = multiprocessing.Pipe()
+        ready = asyncio.get_running_loop().create_future()
+        cluster._connections.append(conn)
+        cluster._ready.append(ready)
+
+        call = asyncio.create_task(cluster._call((0, 1), "groups", "set_scene", SceneAddress(1, 1, 1), 0))
+        await asyncio.sleep(0)
+        worker_conn.close()
+        await cluster._receive(0, conn, ready)
+
+        with pytest.raises(ConnectionError):
+            await ready
+        with pytest.raises(ConnectionError):
+            await call
+        assert (0, 1) not in cluster.routers
+        with pytest.raises(ConnectionError):
+            await cluster._call((0, 1), "groups", "set_scene", SceneAddress(1, 1, 1), 0)
+        cluster._executor.shutdown()
+
+
+# Test background state polling
+class TestPolling:
+    """Test the priority writer queue and the adaptive state poller"""
+    
+    @pytest.mark.asyncio
+    async def test_pollers_share_one_budget(self):
+        """Test state and telemetry polling together keep to one share"""
+        from aiohelvar.router import WRITE_INTERVAL
+        router = make_site(replies={})
+        state = router.poll_state(share=0.2, min_interval=3600)
+        telemetry = router.poll_telemetry(interval=3600, share=0.1)
+        
+        assert state.budget is telemetry.budget
+        assert telemetry.budget.rate == pytest.approx(0.1 / WRITE_INTERVAL)
+        router._poll_task.cancel()
+        router._telemetry_task.cancel()
+    
+    @pytest.mark.asyncio
+    async def test_writes_go_out_by_priority(self):
+        """Test control writes overtake queued queries, and polls go last"""
+        from aiohelvar.control import WritePriority
+        router = Router("10.254.0.1", 50000)
+        
+        await router.send_string("poll", priority=WritePriority.POLL)
+        await router.send_string("query")
+        await router.groups.set_scene(SceneAddress(1, 1, 1), 0)
+        await asyncio.sleep(0)
+        
+        writer = Mock()
+        writer.drain = AsyncMock()
+        task = asyncio.create_task(router._stream_writer(None, writer))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        
+        written = [c.args[0] for c in writer.write.call_args_list]
+        assert written == [b">V:2,C:11,G:1,B:1,S:1,F:0#", b"query", b"poll"]
+    
+    def _poll_router(self, state="0", level="25"):
+        router = Router("10.254.0.1", 50000)
+        replies = {
+            CommandType.QUERY_DEVICE_STATE: state,
+            CommandType.QUERY_DEVICE_LOAD_LEVEL: level,
+        }
+        
+        async def send(command, written=None, priority=None):
+            return Command(command.command_type, command_result=replies[command.command_type])
+        
+        router._send_command_task = AsyncMock(side_effect=send)
+        device = Device(HelvarAddress(0, 1, 1, 1))
+        device.protocol = "DALI"
+        device.state = "0"
+        device.load_level = 25.0
+        router.devices.register_device(device)
+        return router, device
+    
+    @pytest.mark.asyncio
+    async def test_idle_devices_back_off(self):
+        """Test unchanged devices are polled less and less often, at poll priority"""
+        from aiohelvar.control import WritePriority
+        from aiohelvar.polling import StatePoller
+        router, device = self._poll_router()
+        poller = StatePoller(router, 1000, min_interval=10, max_interval=30)
+        poller._sync()
+        
+        intervals = []
+        for _ in range(3):
+            changed = await poller.poll(device.address)
+            intervals.append(poller._next_interval(device.address, changed))
+        
+        assert intervals == [20, 30, 30]
+        assert poller.changed == 0
+        priorities = {c.kwargs["priority"] for c in router._send_command_task.call_args_list}
+        assert priorities == {WritePriority.POLL}
+    
+    @pytest.mark.asyncio
+    async def test_changes_and_faults_polled_often(self):
+        """Test changed levels are picked up and faulty devices stay at the minimum"""
+        from aiohelvar.polling import StatePoller
+        router, device = self._poll_router(level="80")
+        poller = StatePoller(router, 1000, min_interval=10, max_interval=30)
+        poller._sync()
+        
+        assert await poller.poll(device.address) is True
+        assert device.load_level == 80.0
+        assert poller._next_interval(device.address, True) == 10
+        
+        device.state = "8"  # NSFaulty
+        assert poller._next_interval(device.address, False) == 10
+    
+    @pytest.mark.asyncio
+    async def test_poller_leaves_fading_devices_alone(self):
+        """Test a poll doesn't query or overwrite the level of a fading device"""
+        from aiohelvar.polling import StatePoller
+        router, device = self._poll_router(level="0")
+        device.fade_to(60.0, 1000)
+        poller = StatePoller(router, 1000)
+        
+        assert await poller.poll(device.address) is False
+        assert device.target_load_level == 60.0
+        # Only the state is queried; the level would be stale.
+        sent = [c.args[0].command_type for c in router._send_command_task.call_args_list]
+        assert sent == [CommandType.QUERY_DEVICE_STATE]
+    
+    def test_ring_buffer_drops_oldest(self):
+        """Test a ring buffer keeps the latest samples, oldest first"""
+        from aiohelvar.polling import RingBuffer
+        buffer = RingBuffer(3)
+        for n in range(5):
+            buffer.append(n, n * 10)
+    
+        assert len(buffer) == 3
+        assert buffer.samples() == [(2, 20), (3, 30), (4, 40)]
+    
+    def test_rollup_energy(self):
+        """Test rollups summarise watts and integrate them into watt hours"""
+        from aiohelvar.polling import rollup
+        summary = rollup([(0, 100.0), (1800, 100.0), (3600, 300.0)])
+    
+        assert summary.samples == 3
+        assert summary.minimum == 100.0
+        assert summary.maximum == 300.0
+        assert summary.latest == 300.0
+        assert summary.energy == 150.0
+        assert rollup([]) is None
+    
+    @pytest.mark.asyncio
+    async def test_telemetry_sample_round(self):
+        """Test a telemetry round samples every group and load, skipping bad replies"""
+        from aiohelvar.control import WritePriority
+        from aiohelvar.polling import TelemetryPoller
+        router, device = self._poll_router()
+        router.groups.register_group(Group(1))
+        router.groups.register_group(Group(2))
+        replies = {"1": "40.5", "2": "Unknown"}
+    
+        async def send(command, written=None, priority=None):
+            if command.command_type == CommandType.QUERY_POWER_CONSUMPTION:
+                return Command(command.command_type, command_result="12")
+            group = str(command.get_param_value(CommandParameterType.GROUP))
+            return Command(command.command_type, command_result=replies[group])
+    
+        router._send_command_task = AsyncMock(side_effect=send)
+        poller = TelemetryPoller(router, 1000, devices=True)
+        await poller.sample()
+        await poller.sample()
+    
+        groups, devices = poller.rollups()
+        assert list(groups) == [1]
+        assert groups[1].samples == 2
+        assert groups[1].latest == 40.5
+        assert devices[device.address].mean == 12.0
+        assert poller.total().samples == 2
+        priorities = {c.kwargs["priority"] for c in router._send_command_task.call_args_list}
+        assert priorities == {WritePriority.POLL}
+
+
 # Test Router
 class TestRouter:
     """Test Router class functionality"""
@@ -832,9 +2640,9 @@ def run_all_tests():
     
     # Get all test classes
     test_classes = [
-        TestExceptions, TestSubscribable, TestDevice, TestDevices,
-        TestGroup, TestGroups, TestScene, TestScenes,
-        TestStaticUtilities, TestRouter, TestIntegration
+        TestExceptions, TestSubscribable, TestDevice, TestDevices, TestDeviceIndex,
+        TestGroup, TestGroups, TestGroupMembership, TestScene, TestScenes,
+        TestSnapshots, TestTopologyCache, TestRevalidation, TestTopologyDiff, TestDiscovery, TestWorkgroup, TestHelvarCluster, TestSharding, TestPolling, TestStaticUtilities, TestRouter, TestIntegration
     ]
     
     passed = 0